@@ -0,0 +1,154 @@
+"""
+Fake cb-test, standing in for common_utils.binary_tester and common_utils.poll_sanitizer.
+
+Every cb-test invocation takes a configurable time (sleeping or burning CPU)
+and passes with a configurable probability. install() registers the fakes,
+it needs to be called before test_vm_worker is imported.
+"""
+import random
+import sys
+import time
+import types
+
+# Settings of the fake cb-test, change them before running the jobs.
+CB_TEST_CONFIG = {
+    # mean time (in seconds) of one cb-test invocation.
+    'latency': 0.05,
+    # maximum deviation (in seconds) from the mean time.
+    'jitter': 0.01,
+    # burn CPU instead of sleeping, like a real cb-test.
+    'busy': False,
+    # probability of a pov throw succeeding.
+    'pov_success_rate': 0.5,
+    # probability of a poll passing.
+    'poll_pass_rate': 1.0,
+    # relative noise of the perf numbers.
+    'perf_noise': 0.01,
+}
+
+# function called with (phase name, duration) after every cb-test invocation.
+_phase_recorder = None
+
+
+def set_phase_recorder(phase_recorder):
+    """
+        Set the function to be called with (phase name, duration) after every cb-test invocation.
+    :param phase_recorder: function or None.
+    :return: None
+    """
+    global _phase_recorder
+    _phase_recorder = phase_recorder
+
+
+def _run_cb_test(phase_name):
+    """
+        Pretend to run a cb-test.
+    :param phase_name: name of the phase, reported to the phase recorder.
+    :return: None
+    """
+    start_time = time.time()
+    curr_latency = max(CB_TEST_CONFIG['latency'] + random.uniform(-CB_TEST_CONFIG['jitter'],
+                                                                   CB_TEST_CONFIG['jitter']), 0)
+    if CB_TEST_CONFIG['busy']:
+        while time.time() - start_time < curr_latency:
+            pass
+    else:
+        time.sleep(curr_latency)
+    if _phase_recorder is not None:
+        _phase_recorder(phase_name, time.time() - start_time)
+
+
+def _get_noisy(curr_value):
+    """
+        Add perf noise to the provided value.
+    """
+    return curr_value * (1 + random.uniform(-CB_TEST_CONFIG['perf_noise'], CB_TEST_CONFIG['perf_noise']))
+
+
+class BinaryTester(object):
+    PASS_RESULT = 'pass'
+    FAIL_RESULT = 'fail'
+    CRASH_RESULT = 'crash'
+
+    def __init__(self, bin_folder, xml_file, is_pov=False, is_cfe=False, standalone=False, ids_rules=None,
+                 bitflip_ids=False):
+        self.bin_folder = bin_folder
+        self.xml_file = xml_file
+        self.is_pov = is_pov
+
+    def test_cb_binary(self):
+        _run_cb_test('cb_test')
+        if self.is_pov:
+            if random.random() < CB_TEST_CONFIG['pov_success_rate']:
+                return 0, 'pov ok', ''
+            return 1, 'pov failed', ''
+        if random.random() < CB_TEST_CONFIG['poll_pass_rate']:
+            return 0, BinaryTester.PASS_RESULT, ''
+        return 1, BinaryTester.FAIL_RESULT, ''
+
+    @staticmethod
+    def parse_cb_test_out(output_text):
+        perf_json = {'perf': {'rss': _get_noisy(1024.0), 'flt': _get_noisy(100.0), 'utime': _get_noisy(0.01),
+                              'cpu_clock': _get_noisy(10.0), 'task_clock': _get_noisy(10.0),
+                              'file_size': 4096.0}}
+        return True, output_text, perf_json
+
+
+def generate_poll_from_input(input_data, bin_dir, cs_name, optional_prefix=None, log_suffix=None, afl_input=False):
+    _run_cb_test('poll_generation')
+    if random.random() < CB_TEST_CONFIG['poll_pass_rate']:
+        return '<pov></pov>', BinaryTester.PASS_RESULT, 0
+    return None, BinaryTester.FAIL_RESULT, 1
+
+
+def sanitize_pcap_poll(pcap_blob, bin_dir, optional_prefix=None, log_suffix=None):
+    _run_cb_test('poll_sanitization')
+    if random.random() < CB_TEST_CONFIG['poll_pass_rate']:
+        return '<pov></pov>', BinaryTester.PASS_RESULT, 0
+    return None, BinaryTester.FAIL_RESULT, 1
+
+
+def _log(msg):
+    sys.stderr.write(msg + '\n')
+
+
+def _install_module(module_name, **module_attrs):
+    """
+        Register a module with the provided attributes.
+    """
+    new_module = types.ModuleType(module_name)
+    new_module.__dict__.update(module_attrs)
+    sys.modules[module_name] = new_module
+    return new_module
+
+
+def _is_importable(module_name):
+    try:
+        __import__(module_name)
+        return True
+    except ImportError:
+        return False
+
+
+def install(quiet=True):
+    """
+        Register the fake cb-test as common_utils.binary_tester and common_utils.poll_sanitizer.
+        Other dependencies of the worker, which are not installed, are replaced with empty modules.
+    :param quiet: flag to indicate whether the log messages of the worker should be dropped.
+    :return: None
+    """
+    log_fn = (lambda msg: None) if quiet else _log
+    if not _is_importable('common_utils'):
+        common_utils_module = _install_module('common_utils')
+        common_utils_module.__path__ = []
+    if quiet or not _is_importable('common_utils.simple_logging'):
+        logging_module = _install_module('common_utils.simple_logging', log_info=log_fn, log_success=log_fn,
+                                         log_failure=log_fn, log_error=log_fn)
+        logging_module.__all__ = ['log_info', 'log_success', 'log_failure', 'log_error']
+    _install_module('common_utils.binary_tester', BinaryTester=BinaryTester)
+    _install_module('common_utils.poll_sanitizer', generate_poll_from_input=generate_poll_from_input,
+                    sanitize_pcap_poll=sanitize_pcap_poll)
+    if not _is_importable('compilerex'):
+        _install_module('compilerex')
+    if not _is_importable('dotenv'):
+        _install_module('dotenv', load_dotenv=lambda *args, **kwargs: None)
@@ -0,0 +1,377 @@
+"""
+SQLite backed stand-in for the parts of farnsworth used by the vm worker.
+
+install() registers the stand-in as the farnsworth package, it needs to be
+called before test_vm_worker is imported.
+"""
+import hashlib
+import json
+import os
+import random
+import sys
+import types
+from datetime import datetime
+from peewee import SqliteDatabase, Model, CharField, IntegerField, BooleanField, DateTimeField, TextField, \
+    BlobField, ForeignKeyField
+
+master_db = SqliteDatabase(None)
+_connected_pid = None
+
+
+class JSONField(TextField):
+    """
+    Stand-in for the BinaryJSONField of farnsworth.
+    """
+
+    def db_value(self, value):
+        return None if value is None else json.dumps(value)
+
+    def python_value(self, value):
+        return None if value is None else json.loads(value)
+
+
+class BaseModel(Model):
+    class Meta:
+        database = master_db
+
+
+class Round(BaseModel):
+    num = IntegerField(default=0)
+
+
+class ChallengeSet(BaseModel):
+    name = CharField()
+
+    @property
+    def cbns_original(self):
+        return ChallengeBinaryNode.select().where((ChallengeBinaryNode.cs == self) &
+                                                  (ChallengeBinaryNode.patch_type.is_null(True)))
+
+
+class PatchType(BaseModel):
+    name = CharField(unique=True)
+
+
+class IDSRule(BaseModel):
+    cs = ForeignKeyField(ChallengeSet)
+    rules = TextField(null=True)
+
+
+class ChallengeBinaryNode(BaseModel):
+    cs = ForeignKeyField(ChallengeSet)
+    name = CharField()
+    blob = BlobField()
+    sha256 = CharField()
+    patch_type = ForeignKeyField(PatchType, null=True)
+    ids_rule = ForeignKeyField(IDSRule, null=True)
+
+
+class ChallengeSetFielding(BaseModel):
+    cs = ForeignKeyField(ChallengeSet)
+
+    @property
+    def cbns(self):
+        return ChallengeBinaryNode.select().join(FieldedCBN, on=(FieldedCBN.cbn == ChallengeBinaryNode.id)) \
+                                  .where(FieldedCBN.fielding == self)
+
+
+class FieldedCBN(BaseModel):
+    fielding = ForeignKeyField(ChallengeSetFielding)
+    cbn = ForeignKeyField(ChallengeBinaryNode)
+
+
+class IDSRuleFielding(BaseModel):
+    ids_rule = ForeignKeyField(IDSRule)
+
+
+class Exploit(BaseModel):
+    cs = ForeignKeyField(ChallengeSet)
+    blob = BlobField()
+    c_code = TextField(null=True)
+    pov_type = CharField(default='type1')
+    method = CharField(default='fake')
+    job = IntegerField(null=True)
+    reliability = IntegerField(default=0)
+
+
+class Test(BaseModel):
+    cs = ForeignKeyField(ChallengeSet)
+    blob = BlobField()
+    poll_created = BooleanField(default=False)
+
+
+class ValidPoll(BaseModel):
+    cs = ForeignKeyField(ChallengeSet)
+    test = ForeignKeyField(Test, null=True)
+    round = ForeignKeyField(Round, null=True)
+    is_perf_ready = BooleanField(default=True)
+    blob = BlobField()
+
+
+class RawRoundPoll(BaseModel):
+    cs = ForeignKeyField(ChallengeSet)
+    round = ForeignKeyField(Round, null=True)
+    blob = BlobField()
+    sanitized = BooleanField(default=False)
+    is_crash = BooleanField(default=False)
+    is_failed = BooleanField(default=False)
+
+
+class Job(BaseModel):
+    """
+    Jobs keep their relations in payload, like the jobs of farnsworth.
+    """
+    cs = ForeignKeyField(ChallengeSet)
+    worker = CharField()
+    payload = JSONField(null=True)
+    priority = IntegerField(default=0)
+    started_at = DateTimeField(null=True)
+    completed_at = DateTimeField(null=True)
+
+    @classmethod
+    def unstarted(cls, cs=None):
+        # higher priority first, like farnsworth.
+        unstarted_query = cls.select().where(cls.started_at.is_null(True)).order_by(cls.priority.desc())
+        if cs is not None:
+            unstarted_query = unstarted_query.where(cls.cs == cs)
+        return unstarted_query
+
+    def save(self, *args, **kwargs):
+        is_new = self._get_pk_value() is None
+        num_saved = super(Job, self).save(*args, **kwargs)
+        if is_new:
+            _notify_new_jobs()
+        return num_saved
+
+    def try_start(self):
+        num_updated = type(self).update(started_at=datetime.now()) \
+                                .where((type(self).id == self.id) & (type(self).started_at.is_null(True))).execute()
+        return num_updated == 1
+
+    def completed(self):
+        self.completed_at = datetime.now()
+        self.save()
+
+    def is_completed(self):
+        return self.completed_at is not None
+
+
+class PovTesterJob(Job):
+    @property
+    def target_cs_fielding(self):
+        return ChallengeSetFielding.get(id=self.payload['target_cs_fielding_id'])
+
+    @property
+    def target_ids_fielding(self):
+        if self.payload.get('target_ids_fielding_id') is None:
+            return None
+        return IDSRuleFielding.get(id=self.payload['target_ids_fielding_id'])
+
+    @property
+    def target_exploit(self):
+        return Exploit.get(id=self.payload['target_exploit_id'])
+
+
+class CBTesterJob(Job):
+    @property
+    def target_cs(self):
+        return ChallengeSet.get(id=self.payload['target_cs_id'])
+
+    @property
+    def poll(self):
+        return ValidPoll.get(id=self.payload['poll_id'])
+
+    @property
+    def patch_type(self):
+        return self.payload.get('patch_type')
+
+
+class PollCreatorJob(Job):
+    @property
+    def target_test(self):
+        return Test.get(id=self.payload['target_test_id'])
+
+
+class NetworkPollSanitizerJob(Job):
+    @property
+    def raw_poll(self):
+        return RawRoundPoll.get(id=self.payload['raw_poll_id'])
+
+
+class TesterResult(BaseModel):
+    job = IntegerField()
+    error_code = IntegerField()
+    result = TextField(null=True)
+    stdout_out = TextField(null=True)
+    stderr_out = TextField(null=True)
+    performances = TextField(null=True)
+
+
+class CBPollPerformance(BaseModel):
+    poll = ForeignKeyField(ValidPoll)
+    cs = ForeignKeyField(ChallengeSet)
+    patch_type = ForeignKeyField(PatchType, null=True)
+    is_poll_ok = BooleanField(default=True)
+    performances = TextField(null=True)
+
+
+class PovTestResult(BaseModel):
+    exploit = ForeignKeyField(Exploit)
+    cs_fielding = ForeignKeyField(ChallengeSetFielding)
+    ids_fielding = ForeignKeyField(IDSRuleFielding, null=True)
+    num_success = IntegerField()
+    test_feedback = TextField(null=True)
+
+    @classmethod
+    def best(cls, cs_fielding, ids_fielding):
+        return cls.select().where((cls.cs_fielding == cs_fielding) & (cls.ids_fielding == ids_fielding)) \
+                  .order_by(cls.num_success.desc()).first()
+
+
+ALL_MODELS = [Round, ChallengeSet, PatchType, IDSRule, ChallengeBinaryNode, ChallengeSetFielding, FieldedCBN,
+              IDSRuleFielding, Exploit, Test, ValidPoll, RawRoundPoll, PovTesterJob, CBTesterJob, PollCreatorJob,
+              NetworkPollSanitizerJob, TesterResult, CBPollPerformance, PovTestResult]
+JOB_MODELS = {'pov_tester': PovTesterJob, 'cb_tester': CBTesterJob, 'poll_creator': PollCreatorJob,
+              'network_poll_sanitizer': NetworkPollSanitizerJob}
+
+
+def _notify_new_jobs():
+    """
+        Stand-in for the postgres triggers, which notify new jobs.
+        Wakes up the dispatchers of this process, if the vm worker is loaded.
+    :return: None
+    """
+    job_notifier = sys.modules.get('test_vm_worker.job_notifier')
+    if job_notifier is not None:
+        job_notifier.notify_new_jobs()
+
+
+def connect_dbs():
+    """
+        farnsworth.config.connect_dbs, connections are never shared with forked processes.
+    :return: None
+    """
+    global _connected_pid
+    if _connected_pid != os.getpid() and not master_db.is_closed():
+        # inherited from the parent.
+        try:
+            master_db.close()
+        except Exception:
+            pass
+    if master_db.is_closed():
+        master_db.connect()
+    _connected_pid = os.getpid()
+
+
+def close_dbs():
+    """
+        farnsworth.config.close_dbs
+    :return: None
+    """
+    if not master_db.is_closed():
+        master_db.close()
+
+
+class Write(object):
+    pass
+
+
+class _FakeCFEPoll(object):
+    def __init__(self):
+        self.actions = []
+
+
+def cfe_poll_from_xml(xml_blob):
+    """
+        farnsworth.actions.cfe_poll_from_xml, polls have no actions.
+    """
+    return _FakeCFEPoll()
+
+
+def install():
+    """
+        Register this module as farnsworth, farnsworth.models, farnsworth.config and farnsworth.actions.
+    :return: None
+    """
+    this_module = sys.modules[__name__]
+    farnsworth_module = types.ModuleType('farnsworth')
+    farnsworth_module.__path__ = []
+    for sub_module in ['models', 'config', 'actions']:
+        setattr(farnsworth_module, sub_module, this_module)
+        sys.modules['farnsworth.' + sub_module] = this_module
+    sys.modules['farnsworth'] = farnsworth_module
+
+
+def init_database(db_path):
+    """
+        Create a fresh database at the provided path.
+    :param db_path: path of the sqlite file.
+    :return: None
+    """
+    close_dbs()
+    if os.path.exists(db_path):
+        os.unlink(db_path)
+    # workers write concurrently, wait for the locks instead of failing.
+    master_db.init(db_path, timeout=60)
+    connect_dbs()
+    master_db.create_tables(ALL_MODELS)
+
+
+def _create_blob(blob_size, rand_obj):
+    """
+        Create random contents of the provided size.
+    """
+    return ''.join(chr(rand_obj.randint(0, 255)) for _ in range(blob_size))
+
+
+def populate(num_jobs, num_cs=2, num_cbns=2, blob_size=64 * 1024, job_types=None, seed=0):
+    """
+        Create challenge sets, binaries and the provided number of jobs of each job type.
+    :param num_jobs: number of jobs of each type.
+    :param num_cs: number of challenge sets, jobs are spread over them.
+    :param num_cbns: number of binaries per challenge set and patch type.
+    :param blob_size: size of each binary.
+    :param job_types: list of job types to create, None for all.
+    :param seed: seed of the random contents.
+    :return: list of ChallengeSet
+    """
+    rand_obj = random.Random(seed)
+    job_types = job_types or JOB_MODELS.keys()
+    patch_types = [PatchType.create(name='fake_patch')]
+    all_cs = []
+    with master_db.atomic():
+        curr_round = Round.create(num=1)
+        for cs_index in range(num_cs):
+            curr_cs = ChallengeSet.create(name='CS_' + str(cs_index))
+            all_cs.append(curr_cs)
+            ids_rule = IDSRule.create(cs=curr_cs, rules='alert any any')
+            curr_fielding = ChallengeSetFielding.create(cs=curr_cs)
+            ids_fielding = IDSRuleFielding.create(ids_rule=ids_rule)
+            for curr_patch_type in [None] + patch_types:
+                for cbn_index in range(num_cbns):
+                    curr_blob = _create_blob(blob_size, rand_obj)
+                    curr_cbn = ChallengeBinaryNode.create(cs=curr_cs, name=curr_cs.name + '_' + str(cbn_index),
+                                                          blob=curr_blob, sha256=hashlib.sha256(curr_blob).hexdigest(),
+                                                          patch_type=curr_patch_type, ids_rule=ids_rule)
+                    if curr_patch_type is None:
+                        FieldedCBN.create(fielding=curr_fielding, cbn=curr_cbn)
+            for job_index in range(num_jobs / num_cs + (1 if cs_index < num_jobs % num_cs else 0)):
+                if 'pov_tester' in job_types:
+                    curr_exploit = Exploit.create(cs=curr_cs, blob='fake pov', c_code='//FIXED')
+                    PovTesterJob.create(cs=curr_cs, worker='pov_tester',
+                                        payload={'target_cs_fielding_id': curr_fielding.id,
+                                                 'target_ids_fielding_id': ids_fielding.id,
+                                                 'target_exploit_id': curr_exploit.id})
+                if 'cb_tester' in job_types:
+                    curr_poll = ValidPoll.create(cs=curr_cs, blob='<pov></pov>', round=curr_round)
+                    CBTesterJob.create(cs=curr_cs, worker='cb_tester',
+                                       payload={'target_cs_id': curr_cs.id, 'poll_id': curr_poll.id,
+                                                'patch_type': patch_types[job_index % len(patch_types)].name})
+                if 'poll_creator' in job_types:
+                    curr_test = Test.create(cs=curr_cs, blob='fake input')
+                    PollCreatorJob.create(cs=curr_cs, worker='poll_creator', payload={'target_test_id': curr_test.id})
+                if 'network_poll_sanitizer' in job_types:
+                    curr_raw_poll = RawRoundPoll.create(cs=curr_cs, blob='fake pcap', round=curr_round)
+                    NetworkPollSanitizerJob.create(cs=curr_cs, worker='network_poll_sanitizer',
+                                                   payload={'raw_poll_id': curr_raw_poll.id})
+    return all_cs
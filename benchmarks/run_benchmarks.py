@@ -0,0 +1,265 @@
+#!/usr/bin/env python
+"""
+Benchmarks of the vm worker, against a local SQLite farnsworth stand-in and a fake cb-test.
+
+For each job type, the job handler is run in-process on a fresh set of jobs,
+and the whole daemon (run_daemon) is run on a fresh set of jobs of all types.
+Reports jobs/sec, latency percentiles of each phase of the jobs and peak RSS.
+
+Usage: python benchmarks/run_benchmarks.py [--jobs 50] [--workers 4] [--latency 0.05] [--json] ...
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import fake_farnsworth
+import fake_cb_test
+
+ALL_JOB_TYPES = ['pov_tester', 'cb_tester', 'poll_creator', 'network_poll_sanitizer']
+PERCENTILES = [50, 90, 99]
+
+# phase name -> list of durations, of the current process.
+_phase_durations = {}
+
+
+def _record_phase(phase_name, duration):
+    _phase_durations.setdefault(phase_name, []).append(duration)
+
+
+def _timed(phase_name, target_fn):
+    """
+        Wrap the provided function, so that its duration is recorded as the provided phase.
+    """
+    def timed_fn(*args, **kwargs):
+        start_time = time.time()
+        try:
+            return target_fn(*args, **kwargs)
+        finally:
+            _record_phase(phase_name, time.time() - start_time)
+    return timed_fn
+
+
+def _get_percentile(sorted_vals, percentile):
+    """
+        Nearest rank percentile of already sorted values.
+    """
+    if len(sorted_vals) == 0:
+        return None
+    rank = max(int(round(percentile / 100.0 * len(sorted_vals))), 1)
+    return sorted_vals[min(rank, len(sorted_vals)) - 1]
+
+
+def _get_latency_summary(durations):
+    """
+        Get count, mean, percentiles and max of the provided durations (in ms).
+    """
+    sorted_vals = sorted(map(lambda x: x * 1000.0, durations))
+    summary = {'count': len(sorted_vals)}
+    if len(sorted_vals) > 0:
+        summary['mean_ms'] = sum(sorted_vals) / len(sorted_vals)
+        summary['max_ms'] = sorted_vals[-1]
+        for curr_percentile in PERCENTILES:
+            summary['p' + str(curr_percentile) + '_ms'] = _get_percentile(sorted_vals, curr_percentile)
+    return summary
+
+
+def _get_peak_rss_mb(rusage_who):
+    # ru_maxrss is in KB on linux.
+    return resource.getrusage(rusage_who).ru_maxrss / 1024.0
+
+
+def _run_in_child(target_fn, *args):
+    """
+        Run the provided function in a forked process, so that its peak RSS is its own.
+    :return: return value of the function.
+    """
+    result_queue = multiprocessing.Queue()
+
+    def child_main():
+        try:
+            result_queue.put(target_fn(*args))
+        except Exception as e:
+            result_queue.put({'error': repr(e)})
+    child_process = multiprocessing.Process(target=child_main)
+    child_process.start()
+    child_result = result_queue.get()
+    child_process.join()
+    return child_result
+
+
+def _instrument_worker():
+    """
+        Record the duration of the main phases of the jobs in this process.
+    :return: dict of job type -> timed job handler
+    """
+    from test_vm_worker.farnsworth_api_wrapper import CRSAPIWrapper
+    from test_vm_worker import worker_config
+    for method_name, phase_name in [('_get_job_by_id', 'job_fetch'), ('save_cbn', 'binary_setup'),
+                                    ('flush_results', 'result_write')]:
+        setattr(CRSAPIWrapper, method_name, staticmethod(_timed(phase_name, getattr(CRSAPIWrapper, method_name))))
+    fake_cb_test.set_phase_recorder(_record_phase)
+    return dict(map(lambda curr_config: (curr_config[0], _timed('job_total', curr_config[2])), worker_config))
+
+
+def _benchmark_handler(job_type, db_path, options):
+    """
+        Run the handler of the provided job type on a fresh set of jobs, in this process.
+    :return: dict of results.
+    """
+    job_handlers = _instrument_worker()
+    fake_farnsworth.init_database(db_path)
+    fake_farnsworth.populate(options.jobs, num_cbns=options.cbns, blob_size=options.blob_size,
+                             job_types=[job_type])
+    job_model = fake_farnsworth.JOB_MODELS[job_type]
+    all_job_ids = map(lambda curr_job: curr_job.id, job_model.select(job_model.id).order_by(job_model.id))
+    fake_farnsworth.close_dbs()
+    _phase_durations.clear()
+    start_time = time.time()
+    for curr_job_id in all_job_ids:
+        job_handlers[job_type]((curr_job_id, options.threads, False))
+    elapsed_time = time.time() - start_time
+    fake_farnsworth.connect_dbs()
+    num_completed = job_model.select().where(job_model.completed_at.is_null(False)).count()
+    return {'jobs': len(all_job_ids), 'completed': num_completed, 'seconds': elapsed_time,
+            'jobs_per_sec': num_completed / elapsed_time if elapsed_time > 0 else None,
+            'phases': dict(map(lambda curr_item: (curr_item[0], _get_latency_summary(curr_item[1])),
+                               _phase_durations.items())),
+            'peak_rss_mb': _get_peak_rss_mb(resource.RUSAGE_SELF)}
+
+
+def _benchmark_daemon(job_types, db_path, options):
+    """
+        Run the daemon on a fresh set of jobs of the provided job types, in this process.
+    :return: dict of results.
+    """
+    import test_vm_worker
+    fake_farnsworth.init_database(db_path)
+    target_cs = fake_farnsworth.populate(options.jobs, num_cs=1, num_cbns=options.cbns, blob_size=options.blob_size,
+                                         job_types=job_types)[0]
+    fake_farnsworth.close_dbs()
+    test_vm_worker.NO_OF_PROCESSES = options.workers
+    test_vm_worker.DISPATCH_QUEUE_DEPTH = max(options.workers / 2, 1)
+    daemon_args = ['common_tester', str(target_cs.id)]
+    if len(job_types) == 1:
+        daemon_args.extend([job_types[0], str(options.jobs)])
+    start_time = time.time()
+    test_vm_worker.run_daemon(daemon_args)
+    elapsed_time = time.time() - start_time
+    fake_farnsworth.connect_dbs()
+    daemon_results = {'seconds': elapsed_time, 'workers': options.workers, 'job_types': {},
+                      'peak_rss_mb': _get_peak_rss_mb(resource.RUSAGE_SELF),
+                      'peak_worker_rss_mb': _get_peak_rss_mb(resource.RUSAGE_CHILDREN)}
+    total_completed = 0
+    for curr_job_type in job_types:
+        job_model = fake_farnsworth.JOB_MODELS[curr_job_type]
+        all_completed = list(job_model.select(job_model.started_at, job_model.completed_at)
+                                      .where(job_model.completed_at.is_null(False)))
+        total_completed += len(all_completed)
+        daemon_results['job_types'][curr_job_type] = {
+            'completed': len(all_completed),
+            'jobs_per_sec': len(all_completed) / elapsed_time if elapsed_time > 0 else None,
+            # from claim to completion, including the time spent waiting for a worker.
+            'job_latency': _get_latency_summary(map(lambda curr_job: (curr_job.completed_at -
+                                                                      curr_job.started_at).total_seconds(),
+                                                    all_completed))}
+    daemon_results['completed'] = total_completed
+    daemon_results['jobs_per_sec'] = total_completed / elapsed_time if elapsed_time > 0 else None
+    return daemon_results
+
+
+def _format_latency(curr_summary):
+    if curr_summary.get('count', 0) == 0:
+        return 'n=0'
+    return 'n=' + str(curr_summary['count']) + ' ' + ' '.join(map(lambda curr_percentile: (
+        'p' + str(curr_percentile) + '=' + '%.1fms' % curr_summary['p' + str(curr_percentile) + '_ms']),
+        PERCENTILES)) + ' max=%.1fms' % curr_summary['max_ms']
+
+
+def _print_report(all_results):
+    for job_type, curr_result in sorted(all_results.get('handlers', {}).items()):
+        if 'error' in curr_result:
+            print(job_type + ': failed, ' + curr_result['error'])
+            continue
+        print(job_type + ': %d/%d jobs in %.2fs, %.2f jobs/sec, peak RSS %.1fMB' %
+              (curr_result['completed'], curr_result['jobs'], curr_result['seconds'], curr_result['jobs_per_sec'] or 0,
+               curr_result['peak_rss_mb']))
+        for phase_name, curr_summary in sorted(curr_result['phases'].items()):
+            print('    ' + phase_name.ljust(18) + _format_latency(curr_summary))
+    daemon_result = all_results.get('daemon')
+    if daemon_result is not None:
+        if 'error' in daemon_result:
+            print('daemon: failed, ' + daemon_result['error'])
+            return
+        print('daemon (%d workers): %d jobs in %.2fs, %.2f jobs/sec, peak RSS %.1fMB, peak worker RSS %.1fMB' %
+              (daemon_result['workers'], daemon_result['completed'], daemon_result['seconds'],
+               daemon_result['jobs_per_sec'] or 0, daemon_result['peak_rss_mb'], daemon_result['peak_worker_rss_mb']))
+        for job_type, curr_result in sorted(daemon_result['job_types'].items()):
+            print('    ' + job_type.ljust(24) + '%.2f jobs/sec, latency ' % (curr_result['jobs_per_sec'] or 0) +
+                  _format_latency(curr_result['job_latency']))
+
+
+def main(arg_list):
+    arg_parser = argparse.ArgumentParser(description='Benchmark the vm worker against fake farnsworth and cb-test.')
+    arg_parser.add_argument('--jobs', type=int, default=50, help='number of jobs of each job type')
+    arg_parser.add_argument('--job-types', default=','.join(ALL_JOB_TYPES), help='comma separated job types')
+    arg_parser.add_argument('--workers', type=int, default=multiprocessing.cpu_count(),
+                            help='number of daemon workers')
+    arg_parser.add_argument('--threads', type=int, default=1, help='threads of each job, in handler benchmarks')
+    arg_parser.add_argument('--cbns', type=int, default=2, help='binaries per challenge set and patch type')
+    arg_parser.add_argument('--blob-size', type=int, default=64 * 1024, help='size of each binary in bytes')
+    arg_parser.add_argument('--latency', type=float, default=0.05, help='mean cb-test time in seconds')
+    arg_parser.add_argument('--jitter', type=float, default=0.01, help='maximum deviation of cb-test time')
+    arg_parser.add_argument('--busy', action='store_true', help='burn CPU in cb-test instead of sleeping')
+    arg_parser.add_argument('--pov-success-rate', type=float, default=0.5, help='probability of a pov throw passing')
+    arg_parser.add_argument('--poll-pass-rate', type=float, default=1.0, help='probability of a poll passing')
+    arg_parser.add_argument('--perf-noise', type=float, default=0.01, help='relative noise of perf numbers')
+    arg_parser.add_argument('--skip-handlers', action='store_true', help='do not run the handler benchmarks')
+    arg_parser.add_argument('--skip-daemon', action='store_true', help='do not run the daemon benchmark')
+    arg_parser.add_argument('--work-dir', default=None, help='directory for the databases, workspaces and cache')
+    arg_parser.add_argument('--verbose', action='store_true', help='show log messages of the worker')
+    arg_parser.add_argument('--json', action='store_true', help='print results as json')
+    options = arg_parser.parse_args(arg_list)
+
+    job_types = filter(lambda curr_type: len(curr_type) > 0, map(str.strip, options.job_types.split(',')))
+    for curr_type in job_types:
+        if curr_type not in ALL_JOB_TYPES:
+            arg_parser.error('Unknown job type:' + curr_type)
+    fake_cb_test.CB_TEST_CONFIG.update({'latency': options.latency, 'jitter': options.jitter, 'busy': options.busy,
+                                        'pov_success_rate': options.pov_success_rate,
+                                        'poll_pass_rate': options.poll_pass_rate, 'perf_noise': options.perf_noise})
+    work_dir = options.work_dir or tempfile.mkdtemp(prefix='vm_worker_bench_')
+    # keep workspaces and binaries of the benchmark away from the real ones.
+    os.environ.setdefault('VM_WORKER_WORKSPACE_RAM_ROOT', os.path.join(work_dir, 'workspaces'))
+    os.environ.setdefault('VM_WORKER_WORKSPACE_DISK_ROOT', os.path.join(work_dir, 'workspaces_disk'))
+    os.environ.setdefault('VM_WORKER_BINARY_CACHE_DIR', os.path.join(work_dir, 'binary_cache'))
+    fake_farnsworth.install()
+    fake_cb_test.install(quiet=not options.verbose)
+
+    all_results = {'config': dict(vars(options), job_types=job_types)}
+    try:
+        if not options.skip_handlers:
+            all_results['handlers'] = {}
+            for curr_type in job_types:
+                all_results['handlers'][curr_type] = _run_in_child(_benchmark_handler, curr_type,
+                                                                   os.path.join(work_dir, curr_type + '.db'), options)
+        if not options.skip_daemon:
+            all_results['daemon'] = _run_in_child(_benchmark_daemon, job_types, os.path.join(work_dir, 'daemon.db'),
+                                                  options)
+    finally:
+        if options.work_dir is None:
+            shutil.rmtree(work_dir, ignore_errors=True)
+    if options.json:
+        print(json.dumps(all_results, indent=2, sort_keys=True))
+    else:
+        _print_report(all_results)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
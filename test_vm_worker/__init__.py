@@ -1,26 +1,68 @@
 from common_utils.simple_logging import log_info, log_success, log_failure, log_error
 from farnsworth_api_wrapper import CRSAPIWrapper
-from pov_tester import process_povtester_job
+from farnsworth.models import PovTesterJob, CBTesterJob, PollCreatorJob, NetworkPollSanitizerJob
+from pov_tester import process_povtester_job, filter_obviated_jobs
 from poll_creator import process_poll_creator_job
-from poll_sanitizer import process_sanitizer_job
-from cb_tester import process_cb_tester_job
+from poll_sanitizer import process_sanitizer_job, process_sanitizer_job_group
+from cb_tester import process_cb_tester_job, process_cb_tester_job_group
+from worker_pool import WarmWorkerPool
+from job_dispatcher import JobDispatcher
+from cpu_slots import CPUSlotScheduler, CPU_SLOTS, init_worker_slots
+from cpu_affinity import CorePool, MEASURED_CORES, init_worker_cores
+from workspace import get_workspace_manager
+from metrics import export_metrics
+from profiling import init_process_profiling, get_profiler, create_sampling_state
+from launcher import init_worker_launcher
+from fleet import get_fleet_coordinator, FLEET_MODE
+from job_leases import get_lease_manager
+from job_notifier import get_job_notifier, install_job_triggers, INSTALL_JOB_TRIGGERS
 from multiprocessing import cpu_count
-from concurrent.futures import ProcessPoolExecutor
-import time
+import os
 import sys
 
-worker_config = [('pov_tester', CRSAPIWrapper.get_all_povtester_jobs, process_povtester_job),
-                 ('cb_tester', CRSAPIWrapper.get_all_cb_tester_jobs, process_cb_tester_job),
-                 ('poll_creator', CRSAPIWrapper.get_all_poller_jobs, process_poll_creator_job),
-                 ('network_poll_sanitizer', CRSAPIWrapper.get_all_poll_sanitizer_jobs, process_sanitizer_job)]
+worker_config = [('pov_tester', PovTesterJob, process_povtester_job),
+                 ('cb_tester', CBTesterJob, process_cb_tester_job),
+                 ('poll_creator', PollCreatorJob, process_poll_creator_job),
+                 ('network_poll_sanitizer', NetworkPollSanitizerJob, process_sanitizer_job)]
+
+# Job types whose jobs are run in groups sharing one workspace: worker name -> (job grouper, group processor)
+job_group_config = {'cb_tester': (CRSAPIWrapper.group_cb_tester_jobs, process_cb_tester_job_group),
+                    'network_poll_sanitizer': (CRSAPIWrapper.group_poll_sanitizer_jobs, process_sanitizer_job_group)}
+# Job types, some of whose jobs can be completed without running them: worker name -> job filter
+job_filter_config = {'pov_tester': filter_obviated_jobs}
+# Job types which get free slots before all the other job types.
+strict_priority_job_types = ['pov_tester']
+# Share of the slots, the other job types get when they compete for slots: worker name -> weight
+job_weight_config = {'cb_tester': 4, 'poll_creator': 2, 'network_poll_sanitizer': 2}
 
 NO_OF_PROCESSES = cpu_count()
 POLL_TIME = 1  # Time to sleep, if no jobs are available to run
+# Number of jobs queued up in addition to the running ones, so that workers never wait for the dispatcher.
+DISPATCH_QUEUE_DEPTH = max(NO_OF_PROCESSES / 2, 1)
+# Maximum number of in flight tasks of a job type: worker name -> max tasks
+job_cap_config = {'poll_creator': max(NO_OF_PROCESSES / 2, 1),
+                  'network_poll_sanitizer': max(NO_OF_PROCESSES / 2, 1)}
 # only for testing.
 # Change this to false for testing.
 EXIT_ON_WRONG_CS_ID = True
 
 
+def _init_worker(worker_index, cpu_slot_scheduler, core_pool, sampling_state):
+    """
+        Initializer of the worker processes.
+    :param worker_index: index of the worker in the pool.
+    :param cpu_slot_scheduler: CPUSlotScheduler shared by all the workers.
+    :param core_pool: CorePool shared by all the workers.
+    :param sampling_state: profiling sampling state shared by the daemon and the workers.
+    :return: None
+    """
+    init_worker_slots(worker_index, cpu_slot_scheduler)
+    init_worker_cores(worker_index, core_pool)
+    # before the worker starts any threads, cb-test is started by the launcher from now on.
+    init_worker_launcher()
+    init_process_profiling(sampling_state=sampling_state)
+
+
 def run_daemon(arg_list):
     global NO_OF_PROCESSES
     global POLL_TIME
@@ -67,56 +109,81 @@ def run_daemon(arg_list):
             poll_time = POLL_TIME
         POLL_TIME = poll_time"""
 
-    if EXIT_ON_WRONG_CS_ID and target_cs_id is None:
+    if EXIT_ON_WRONG_CS_ID and target_cs_id is None and not FLEET_MODE:
         log_error("Exiting, without scheduling any jobs as no valid CS ID is provided.")
         return
     elif target_cs_id is None:
         log_info("Will be running infinitely fetching Jobs for all CS.")
-    processed_jobs = 0
-    while True:
+    # CS shared with the other VMs of the fleet, if any.
+    fleet_coordinator = None
+    if target_cs_id is None:
+        fleet_coordinator = get_fleet_coordinator(NO_OF_PROCESSES)
+    # clean up after jobs of previous runs, which crashed.
+    get_workspace_manager().reclaim_stale_workspaces()
+    # one budget of cpu slots, shared by all the jobs.
+    cpu_slot_scheduler = CPUSlotScheduler(CPU_SLOTS, NO_OF_PROCESSES)
+    # cores reserved for measured runs, if any.
+    core_pool = CorePool(MEASURED_CORES, NO_OF_PROCESSES)
+    # whether the stacks are being sampled, workers started later follow it too.
+    sampling_state = create_sampling_state()
+
+    def on_worker_exit(worker_index):
+        cpu_slot_scheduler.release_all(worker_index)
+        core_pool.release_all(worker_index)
+        # workspaces and trash of workers which died, without blocking the dispatch.
+        get_workspace_manager().reclaim_stale_workspaces(in_background=True)
+
+    # workers live as long as the daemon.
+    worker_pool = WarmWorkerPool(NO_OF_PROCESSES, initializer=_init_worker,
+                                 initargs=(cpu_slot_scheduler, core_pool, sampling_state),
+                                 on_worker_exit=on_worker_exit)
+    daemon_pid = os.getpid()
+
+    def on_profile_signal(signum, curr_frame):
+        # workers forked after this inherit the handler, until they install their own.
+        # the shared state is updated before the workers are signalled, they follow it.
+        if os.getpid() == daemon_pid:
+            get_profiler().toggle_sampling()
+            worker_pool.signal_workers(signum)
+
+    init_process_profiling(default_job_type='daemon', signal_handler=on_profile_signal, sampling_state=sampling_state)
+    all_job_types = map(lambda curr_config: curr_config[1], worker_config)
+    has_job_triggers = False
+    if INSTALL_JOB_TRIGGERS:
+        CRSAPIWrapper.open_connection()
+        has_job_triggers = install_job_triggers(all_job_types)
+    # wake up as soon as jobs are created, instead of polling.
+    job_notifier = get_job_notifier(all_job_types, has_job_triggers)
+    if fleet_coordinator is not None:
+        CRSAPIWrapper.open_connection()
+        fleet_coordinator.register()
+    # jobs of workers or VMs that die are run again.
+    lease_manager = get_lease_manager(all_job_types)
+    if lease_manager is not None:
         CRSAPIWrapper.open_connection()
-        no_jobs = True
-        for curr_worker_config in worker_config:
-            worker_name = curr_worker_config[0]
-            if target_job_type is None or worker_name == target_job_type:
-                job_getter = curr_worker_config[1]
-                job_processor = curr_worker_config[2]
-                log_info("Trying to get " + worker_name + " Jobs.")
-                available_jobs = job_getter(target_cs_id=target_cs_id)
-                if len(available_jobs) > 0:
-                    num_jobs_to_get = max_num_jobs - processed_jobs
-                    if num_jobs_to_get <= 0:
-                        break
-                    available_jobs = available_jobs[0:num_jobs_to_get]
-                    processed_jobs += len(available_jobs)
-                    log_info("Got " + str(len(available_jobs)) + " " + worker_name + " Jobs.")
-                    if str(worker_name) == 'pov_tester':
-                        NO_OF_PROCESSES = int(1.25 * NO_OF_PROCESSES)
-                    child_threads = NO_OF_PROCESSES / len(available_jobs)
-                    child_job_args = map(lambda curr_job: (curr_job.id, child_threads), available_jobs)
-                    with ProcessPoolExecutor(max_workers=NO_OF_PROCESSES) as process_pool:
-                        process_pool.map(job_processor, child_job_args)
-                    log_success("Processed " + str(len(available_jobs)) + " " + worker_name + " Jobs.")
-                    no_jobs = False
-                    # start again from beginning.
-                    # This will ensure the if there are any higher priority jobs, we always execute them
-                    # before going to lower priority ones
-                    break
-                else:
-                    log_info("No " + worker_name + " Jobs available to run.")
-
-        # if there are no VM jobs
-        if no_jobs:
-            # If this is supposed to take care of only one CS.
-            # exit the while True loop.
-            # so that the worker knows this VM is done.
-            if target_cs_id is not None:
-                break
-            time.sleep(POLL_TIME)
-        # if we processed sufficient number of jobs? then exit
-        if processed_jobs >= max_num_jobs:
-            log_info("Processed:" + str(processed_jobs) + ", limit:" + str(max_num_jobs) + ". Exiting.")
-            break
+        lease_manager.start()
+    try:
+        job_dispatcher = JobDispatcher(worker_pool, worker_config, cpu_slot_scheduler,
+                                       NO_OF_PROCESSES + DISPATCH_QUEUE_DEPTH, target_cs_id=target_cs_id,
+                                       target_job_type=target_job_type, max_num_jobs=max_num_jobs,
+                                       poll_time=POLL_TIME, job_group_config=job_group_config,
+                                       job_filter_config=job_filter_config,
+                                       strict_priority_job_types=strict_priority_job_types,
+                                       job_weight_config=job_weight_config, job_cap_config=job_cap_config,
+                                       job_notifier=job_notifier, fleet_coordinator=fleet_coordinator,
+                                       lease_manager=lease_manager)
+        job_dispatcher.run()
+    finally:
+        if fleet_coordinator is not None:
+            fleet_coordinator.unregister()
+        if lease_manager is not None:
+            lease_manager.stop()
+        if job_notifier is not None:
+            job_notifier.close()
+        worker_pool.shutdown()
+        # after shutdown, so that the metrics of the exiting workers are included.
+        export_metrics(force=True)
+        get_profiler().stop_sampling()
 
 if __name__ == "__main__":
     # Command line arguments: common_tester <target_cs_id> <job_type_string> <max_num_jobs>
@@ -0,0 +1,218 @@
+import os
+import errno
+import fcntl
+import hashlib
+import shutil
+import tempfile
+from common_utils.simple_logging import log_info, log_error
+from process_lock import open_lock_file
+from workspace import WORKSPACE_DISK_ROOT
+
+# Directory of the cache, on disk next to the disk workspaces, so that it does not take memory from the RAM
+# workspaces. Binaries are copied into the workspaces on another filesystem.
+BINARY_CACHE_DIR = os.environ.get('VM_WORKER_BINARY_CACHE_DIR',
+                                  os.path.join(os.path.dirname(WORKSPACE_DISK_ROOT.rstrip('/')),
+                                               'vm_worker_binary_cache'))
+# Maximum size (in MB) of all the binaries in the cache.
+BINARY_CACHE_MAX_MB = int(os.environ.get('VM_WORKER_BINARY_CACHE_MAX_MB', 512))
+
+
+class BinaryCache(object):
+    """
+    Content addressed on-disk cache of challenge binaries.
+    Entries are named by the sha256 of their contents and are read-only. They are
+    hardlinked into job workspaces, whose binaries are only read, and copied
+    everywhere else, so that a write to a binary never changes the cache.
+    Least recently used entries are evicted once the cache grows beyond its maximum size.
+    """
+
+    ENTRY_SUFFIX = '.cbn'
+    LOCK_FILE_NAME = '.lock'
+    # Number of times we retry linking an entry, which got evicted under our feet.
+    MAX_LINK_TRIES = 3
+    # Mode of the cache entries, executable by cb-test but never written.
+    ENTRY_MODE = 0o555
+
+    def __init__(self, cache_dir, max_size):
+        """
+            Create a binary cache object.
+        :param cache_dir: directory in which the cached binaries are stored.
+        :param max_size: maximum size of the cache in bytes.
+        :return: None
+        """
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        try:
+            os.makedirs(self.cache_dir)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        self.lock_file_path = os.path.join(self.cache_dir, BinaryCache.LOCK_FILE_NAME)
+
+    def _get_entry_path(self, content_hash):
+        """
+            Get path of the cache entry of the provided hash.
+        :param content_hash: sha256 of the binary.
+        :return: path of the entry.
+        """
+        return os.path.join(self.cache_dir, str(content_hash) + BinaryCache.ENTRY_SUFFIX)
+
+    def _lock(self):
+        """
+            Get an exclusive lock on the cache, shared with all processes using the same cache directory.
+        :return: file object holding the lock, close it to release the lock.
+        """
+        lock_fp = open_lock_file(self.lock_file_path)
+        fcntl.flock(lock_fp.fileno(), fcntl.LOCK_EX)
+        return lock_fp
+
+    def _add(self, blob, content_hash=None):
+        """
+            Add the provided blob into the cache.
+        :param blob: contents of the binary.
+        :param content_hash: expected sha256 of the binary, if known.
+        :return: path of the cache entry.
+        """
+        blob = str(blob)
+        actual_hash = hashlib.sha256(blob).hexdigest()
+        if content_hash is not None and content_hash != actual_hash:
+            # the binary is not the one we asked for, tests run on it would be wrong.
+            log_error("Binary hash mismatch, expected:" + str(content_hash) + ", got:" + actual_hash)
+            raise ValueError("Binary hash mismatch, expected:" + str(content_hash) + ", got:" + actual_hash)
+        entry_path = self._get_entry_path(actual_hash)
+        if os.path.exists(entry_path):
+            # some one already cached it.
+            os.utime(entry_path, None)
+            return entry_path
+        # write to a temp file and rename, so that readers never see partial entries.
+        tmp_fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, prefix='.tmp_')
+        try:
+            with os.fdopen(tmp_fd, 'wb') as fp:
+                fp.write(blob)
+            os.chmod(tmp_path, BinaryCache.ENTRY_MODE)
+            os.rename(tmp_path, entry_path)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            raise
+        self._evict()
+        return entry_path
+
+    def _evict(self):
+        """
+            Remove least recently used entries until the cache fits in its maximum size.
+        :return: None
+        """
+        lock_fp = self._lock()
+        try:
+            all_entries = []
+            total_size = 0
+            for curr_file in os.listdir(self.cache_dir):
+                if not curr_file.endswith(BinaryCache.ENTRY_SUFFIX):
+                    continue
+                curr_path = os.path.join(self.cache_dir, curr_file)
+                try:
+                    curr_stat = os.stat(curr_path)
+                except OSError:
+                    continue
+                all_entries.append((curr_stat.st_mtime, curr_stat.st_size, curr_path))
+                total_size += curr_stat.st_size
+            if total_size <= self.max_size:
+                return
+            # oldest first
+            for _, curr_size, curr_path in sorted(all_entries):
+                if total_size <= self.max_size:
+                    break
+                try:
+                    os.unlink(curr_path)
+                    total_size -= curr_size
+                    log_info("Evicted:" + curr_path + " from binary cache.")
+                except OSError:
+                    pass
+        finally:
+            lock_fp.close()
+
+    @staticmethod
+    def _link(entry_path, target_path, is_read_only):
+        """
+            Link the cache entry to the provided target path, if allowed, else copy it.
+            Falls back to copying, if the target is on a different filesystem.
+        :param entry_path: path of the cache entry.
+        :param target_path: path where the binary should be available.
+        :param is_read_only: flag to indicate whether the binary at the target path is only read.
+        :return: None
+        """
+        if os.path.lexists(target_path):
+            os.unlink(target_path)
+        if is_read_only:
+            try:
+                os.link(entry_path, target_path)
+                return
+            except OSError as e:
+                if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+                    raise
+        shutil.copyfile(entry_path, target_path)
+        os.chmod(target_path, 0o777)
+
+    def materialize(self, target_path, blob_getter, content_hash=None, is_read_only=False):
+        """
+            Make the binary available at the provided path.
+            If the content hash is known and cached, the blob is never fetched.
+        :param target_path: path where the binary should be available.
+        :param blob_getter: function returning the contents of the binary.
+        :param content_hash: sha256 of the binary, if known.
+        :param is_read_only: flag to indicate whether the binary at the target path is only read, so that it can
+                             be linked to the cache entry instead of being copied.
+        :return: target_path
+        """
+        for _ in range(BinaryCache.MAX_LINK_TRIES):
+            entry_path = None
+            if content_hash is not None:
+                entry_path = self._get_entry_path(content_hash)
+                try:
+                    # mark as recently used.
+                    os.utime(entry_path, None)
+                except OSError as e:
+                    if e.errno != errno.ENOENT:
+                        raise
+                    entry_path = None
+            if entry_path is None:
+                entry_path = self._add(blob_getter(), content_hash=content_hash)
+                content_hash = os.path.basename(entry_path)[:-len(BinaryCache.ENTRY_SUFFIX)]
+            try:
+                BinaryCache._link(entry_path, target_path, is_read_only)
+                return target_path
+            except (OSError, IOError) as e:
+                # entry got evicted between lookup and link, try again.
+                if e.errno != errno.ENOENT:
+                    raise
+        raise IOError("Unable to materialize binary at:" + str(target_path))
+
+
+_binary_cache = None
+
+
+def get_binary_cache():
+    """
+        Get the binary cache of the current process.
+    :return: BinaryCache
+    """
+    global _binary_cache
+    if _binary_cache is None:
+        _binary_cache = BinaryCache(BINARY_CACHE_DIR, BINARY_CACHE_MAX_MB * 1024 * 1024)
+    return _binary_cache
+
+
+def materialize_cbn(curr_cb, target_path, blob_getter=None, is_read_only=False):
+    """
+        Save the binary of the provided cbn at the target path, through the binary cache.
+    :param curr_cb: ChallengeBinaryNode whose binary needs to be saved.
+    :param target_path: path where the binary should be saved.
+    :param blob_getter: function returning the contents of the binary, defaults to curr_cb.blob
+    :param is_read_only: flag to indicate whether the saved binary is only read, so that it can be linked to the cache.
+    :return: target_path
+    """
+    if blob_getter is None:
+        blob_getter = lambda: curr_cb.blob
+    return get_binary_cache().materialize(target_path, blob_getter, content_hash=getattr(curr_cb, 'sha256', None),
+                                          is_read_only=is_read_only)
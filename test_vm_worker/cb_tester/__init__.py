@@ -1,86 +1,171 @@
-from .patch_tester import PatchTester, get_unique_dir
+from .patch_tester import PatchTester
 import os
 from common_utils.simple_logging import log_failure, log_info, log_success
 from ..farnsworth_api_wrapper import CRSAPIWrapper
+from ..workspace import get_workspace_manager, make_dir
+from ..metrics import job_phase
+from ..time_budget import job_budget, TIMEOUT_RESULT, TIMEOUT_ERROR_CODE
+
+JOB_TYPE = 'cb_tester'
+
+
+def _setup_binaries(target_dir, target_cs, patch_type):
+    """
+        Save all the binaries and ids rules of the provided cs and patch type in the target directory.
+    :param target_dir: directory in which the binaries need to be saved.
+    :param target_cs: CS whose binaries need to be saved.
+    :param patch_type: patch type of the binaries.
+    :return: (bin_dir, ids_rule_fp, isbitflip) tuple
+    """
+    bin_dir = os.path.join(target_dir, "bin")
+    ids_rule_fp = None
+    ids_rule = None
+    isbitflip = False
+
+    make_dir(bin_dir)
+
+    # save all the binaries in bin folder
+    for curr_cb in CRSAPIWrapper.get_cbs_from_patch_type(target_cs, patch_type):
+        bin_path = os.path.join(bin_dir, curr_cb.name)
+        ids_rule = CRSAPIWrapper.get_ids_rule(curr_cb.ids_rule_id)
+        CRSAPIWrapper.save_cbn(curr_cb, bin_path, is_read_only=True)
+
+    # Save IDS rules
+    if ids_rule is not None and ids_rule.rules is not None and len(str(ids_rule.rules).strip()) > 0:
+        ids_dir = os.path.join(target_dir, "ids_dir")
+        make_dir(ids_dir)
+        ids_rule_fp = os.path.join(ids_dir, "ids.rules")
+        fp = open(ids_rule_fp, "w")
+        fp.write(str(ids_rule.rules))
+        isbitflip = 'bitflip' in str(ids_rule.rules)
+        fp.close()
+    return bin_dir, ids_rule_fp, isbitflip
+
+
+def _test_poll(curr_cb_test_job, target_dir, bin_dir, ids_rule_fp, isbitflip, no_process):
+    """
+        Test the poll of the provided cb tester job on already saved binaries and update its performance.
+    :param curr_cb_test_job: cb tester job whose poll needs to be tested.
+    :param target_dir: working directory of the job.
+    :param bin_dir: directory containing the binaries.
+    :param ids_rule_fp: Path to the ids rules file.
+    :param isbitflip: Flag to indicate whether the ids rules are bitflip
+    :param no_process: number of threads that could be used.
+    :return: None
+    """
+    curr_job_id = str(curr_cb_test_job.id)
+    xml_dir = os.path.join(target_dir, "poll_xml")
+    make_dir(xml_dir)
+
+    # save the xml
+    xml_file_path = os.path.join(xml_dir, str(curr_cb_test_job.poll.id) + '.xml')
+    fp = open(xml_file_path, 'w')
+    fp.write(str(curr_cb_test_job.poll.blob))
+    fp.close()
+
+    # Test the poll
+    curr_patch_tester = PatchTester(bin_dir, xml_file_path, ids_rule_fp, num_threads=no_process,
+                                    isbitflip=isbitflip)
+    with job_phase(JOB_TYPE, 'cb_test'), job_budget(JOB_TYPE) as curr_budget:
+        curr_patch_tester.test()
+
+    if curr_budget.is_timed_out():
+        # the poll did not fail on the patch, do not record it as failed.
+        log_failure("CS:" + str(curr_cb_test_job.target_cs.id) + ", Patch Type:" +
+                    str(curr_cb_test_job.patch_type) + " ran out of time for Poll:" + str(curr_cb_test_job.poll.id))
+        with job_phase(JOB_TYPE, 'result'):
+            CRSAPIWrapper.create_tester_result(curr_cb_test_job, TIMEOUT_ERROR_CODE, TIMEOUT_RESULT)
+        return
+
+    # get all perfs if poll is ok.
+    perf_measurements = {}
+    is_poll_ok = False
+    if curr_patch_tester.are_polls_ok():
+        is_poll_ok = True
+        with job_phase(JOB_TYPE, 'parse_output'):
+            perf_measurements = curr_patch_tester.get_perf_measures()
+    else:
+        log_failure("CS:" + str(curr_cb_test_job.target_cs.id) + ", Patch Type:" +
+                    str(curr_cb_test_job.patch_type) + " failed for Poll:" + str(curr_cb_test_job.poll.id))
+    # update performance measurements.
+    with job_phase(JOB_TYPE, 'result'):
+        CRSAPIWrapper.create_poll_performance(curr_cb_test_job.poll, curr_cb_test_job.target_cs,
+                                              curr_cb_test_job.patch_type, is_poll_ok=is_poll_ok,
+                                              perf_json=perf_measurements)
+    log_success("Processed cb-tester Job:" + str(curr_job_id))
 
 
 def process_cb_tester_job(job_args):
     """
         Process the cb tester job
-    :param job_args: Tuple (cb tester job, num process) to be tested.
+    :param job_args: Tuple (cb tester job, num process, is claimed) to be tested.
     :return: None
     """
     CRSAPIWrapper.open_connection()
     job_id = job_args[0]
-    curr_cb_test_job = CRSAPIWrapper.get_cb_tester_job(job_id)
+    with job_phase(JOB_TYPE, 'job_fetch'):
+        curr_cb_test_job = CRSAPIWrapper.get_cb_tester_job(job_id)
     no_process = job_args[1]
     curr_job_id = str(curr_cb_test_job.id)
-    if curr_cb_test_job.try_start():
+    if CRSAPIWrapper.start_job(curr_cb_test_job, job_args):
         log_info("Trying to process cb-tester Job:" + str(curr_job_id))
-        target_dir = get_unique_dir(os.path.expanduser("~"), "cb_tester_" + str(curr_job_id))
+        target_dir = get_workspace_manager().create("cb_tester_" + str(curr_job_id))
         try:
             # save binaries and xml
-            bin_dir = os.path.join(target_dir, "bin")
-            xml_dir = os.path.join(target_dir, "poll_xml")
-            ids_rule_fp = None
-            ids_rule = None
-            isbitflip = False
-
-            os.system('mkdir -p ' + str(bin_dir))
-            os.system('mkdir -p ' + str(xml_dir))
-
-            # save all the binaries in bin folder
-            for curr_cb in CRSAPIWrapper.get_cbs_from_patch_type(curr_cb_test_job.target_cs,
-                                                                 curr_cb_test_job.patch_type):
-                bin_path = os.path.join(bin_dir, curr_cb.name)
-                ids_rule = curr_cb.ids_rule
-                fp = open(bin_path, 'wb')
-                fp.write(curr_cb.blob)
-                fp.close()
-                os.chmod(bin_path, 0o777)
-
-            # Save IDS rules
-            if ids_rule is not None and ids_rule.rules is not None and len(str(ids_rule.rules).strip()) > 0:
-                ids_dir = os.path.join(target_dir, "ids_dir")
-                os.system('mkdir -p ' + ids_dir)
-                ids_rule_fp = os.path.join(ids_dir, "ids.rules")
-                fp = open(ids_rule_fp, "w")
-                fp.write(str(ids_rule.rules))
-                isbitflip = 'bitflip' in str(ids_rule.rules)
-                fp.close()
-
-            # save the xml
-            xml_file_path = os.path.join(xml_dir, str(curr_cb_test_job.poll.id) + '.xml')
-            fp = open(xml_file_path, 'w')
-            fp.write(str(curr_cb_test_job.poll.blob))
-            fp.close()
-
-            # Test the poll
-            curr_patch_tester = PatchTester(bin_dir, xml_file_path, ids_rule_fp, num_threads=no_process,
-                                            isbitflip=isbitflip)
-            curr_patch_tester.test()
-
-            # get all perfs if poll is ok.
-            perf_measurements = {}
-            is_poll_ok = False
-            if curr_patch_tester.are_polls_ok():
-                is_poll_ok = True
-                perf_measurements = curr_patch_tester.get_perf_measures()
-            else:
-                log_failure("CS:" + str(curr_cb_test_job.target_cs.id) + ", Patch Type:" +
-                            str(curr_cb_test_job.patch_type) + " failed for Poll:" + str(curr_cb_test_job.poll.id))
-            # update performance measurements.
-            CRSAPIWrapper.create_poll_performance(curr_cb_test_job.poll, curr_cb_test_job.target_cs,
-                                                  curr_cb_test_job.patch_type, is_poll_ok=is_poll_ok,
-                                                  perf_json=perf_measurements)
-            log_success("Processed cb-tester Job:" + str(curr_job_id))
+            with job_phase(JOB_TYPE, 'setup'):
+                bin_dir, ids_rule_fp, isbitflip = _setup_binaries(target_dir, curr_cb_test_job.target_cs,
+                                                                  curr_cb_test_job.patch_type)
+            _test_poll(curr_cb_test_job, target_dir, bin_dir, ids_rule_fp, isbitflip, no_process)
             # mark job as completed.
         except Exception as e:
             log_failure("Exception occurred while trying to process cb_tester job:" + str(curr_job_id) +
                         ", Exception:" + str(e))
-        curr_cb_test_job.completed()
+        CRSAPIWrapper.complete_job(curr_cb_test_job)
         # clean up
-        os.system('rm -rf ' + target_dir)
+        with job_phase(JOB_TYPE, 'cleanup'):
+            get_workspace_manager().release(target_dir)
     else:
         log_info("Unable to start job:" + str(curr_job_id) + ". Ignoring")
     CRSAPIWrapper.close_connection()
+
+
+def process_cb_tester_job_group(job_args):
+    """
+        Process a group of cb tester jobs, which have the same CS and patch type.
+        Binaries are saved once and all the polls are tested on them.
+    :param job_args: Tuple (list of cb tester job ids, num process, is claimed) to be tested.
+    :return: None
+    """
+    CRSAPIWrapper.open_connection()
+    no_process = job_args[1]
+    with job_phase(JOB_TYPE, 'job_fetch'):
+        all_jobs = filter(lambda curr_job: CRSAPIWrapper.start_job(curr_job, job_args),
+                          CRSAPIWrapper.get_cb_tester_jobs(job_args[0]))
+    if len(all_jobs) > 0:
+        group_str = ",".join(map(lambda curr_job: str(curr_job.id), all_jobs))
+        log_info("Trying to process cb-tester Jobs:" + group_str)
+        target_dir = get_workspace_manager().create("cb_tester_" + str(all_jobs[0].id) + "_group")
+        bin_dir = None
+        ids_rule_fp = None
+        isbitflip = False
+        try:
+            with job_phase(JOB_TYPE, 'setup'):
+                bin_dir, ids_rule_fp, isbitflip = _setup_binaries(target_dir, all_jobs[0].target_cs,
+                                                                  all_jobs[0].patch_type)
+        except Exception as e:
+            log_failure("Exception occurred while trying to setup binaries for cb_tester jobs:" + group_str +
+                        ", Exception:" + str(e))
+        for curr_cb_test_job in all_jobs:
+            if bin_dir is not None:
+                try:
+                    _test_poll(curr_cb_test_job, target_dir, bin_dir, ids_rule_fp, isbitflip, no_process)
+                except Exception as e:
+                    log_failure("Exception occurred while trying to process cb_tester job:" + str(curr_cb_test_job.id) +
+                                ", Exception:" + str(e))
+            CRSAPIWrapper.complete_job(curr_cb_test_job)
+        # clean up
+        with job_phase(JOB_TYPE, 'cleanup'):
+            get_workspace_manager().release(target_dir)
+    else:
+        log_info("Unable to start any of the jobs:" + str(job_args[0]) + ". Ignoring")
+    CRSAPIWrapper.close_connection()
@@ -1,24 +1,25 @@
 import os
+import math
+import tempfile
 from multiprocessing import cpu_count
 from multiprocessing.dummy import Pool as ThreadPool
 from common_utils.simple_logging import log_failure, log_info, log_success
 from common_utils.binary_tester import BinaryTester
+from ...cpu_slots import measured_cpu_slot
+from ...cpu_affinity import get_core_pool
+from ...time_budget import is_budget_expired
+from ...workspace import make_dir
 
 
 def get_unique_dir(base_dir, choice_dir):
     """
-
-    :param base_dir:
-    :param choice_dir
-    :return:
+        Create a new directory in base_dir, whose name starts with choice_dir.
+    :param base_dir: directory in which the new directory should be created.
+    :param choice_dir: prefix of the new directory name.
+    :return: path of the created directory.
     """
-    target_dir = os.path.join(base_dir, choice_dir)
-    curr_count = 1
-    while os.path.exists(target_dir):
-        target_dir = os.path.join(base_dir, choice_dir + '_' + str(curr_count))
-        curr_count += 1
-    os.system('mkdir -p ' + target_dir)
-    return target_dir
+    make_dir(base_dir)
+    return tempfile.mkdtemp(prefix=choice_dir + '_', dir=base_dir)
 
 
 def bin_tester(bin_dir, poll_xml, ids_file_fp, isbitflip):
@@ -31,7 +32,9 @@ def bin_tester(bin_dir, poll_xml, ids_file_fp, isbitflip):
     :return: (poll_xml, ret_code, has_perf, final_result, perf_json)
     """
     tester_obj = BinaryTester(bin_dir, poll_xml, standalone=True, ids_rules=ids_file_fp, bitflip_ids=isbitflip)
-    ret_code, output_text, _ = tester_obj.test_cb_binary()
+    # perf is measured, keep other work off the core(s) it runs on.
+    with measured_cpu_slot():
+        ret_code, output_text, _ = tester_obj.test_cb_binary()
     has_perf, final_result, perf_json = BinaryTester.parse_cb_test_out(output_text)
     return poll_xml, ret_code, has_perf, final_result, perf_json
 
@@ -55,8 +58,16 @@ class PatchTester(object):
     FILE_SIZE_PERF_NAME = "file_size"
     # To get nice median :)
     NUM_TEST_TIME = 5
+    # Adaptive testing: start with MIN_TEST_TIME runs, add runs until perf converges or MAX_TEST_TIME.
+    MIN_TEST_TIME = 2
+    MAX_TEST_TIME = 10
+    # Perf is converged when the 95% confidence interval of the mean is within this fraction of the mean.
+    PERF_CONVERGENCE_TOLERANCE = 0.05
+    CONVERGENCE_PERF_NAMES = [CPU_CLOCK_PERF_NAME, TSK_CLOCK_PERF_NAME, RSS_PERF_NAME, FLT_PERF_NAME]
+    # two sided 95% t values, by degrees of freedom.
+    T_VALUES = {1: 12.706, 2: 4.303, 3: 3.182, 4: 2.776, 5: 2.571, 6: 2.447, 7: 2.365, 8: 2.306, 9: 2.262}
 
-    def __init__(self, bin_directory, poll_xml_path, ids_rule_fp, num_threads=1, isbitflip=False):
+    def __init__(self, bin_directory, poll_xml_path, ids_rule_fp, num_threads=1, isbitflip=False, adaptive=True):
         """
             Create a patch tester object.
         :param bin_directory: directory containing binaries to be tested.
@@ -64,6 +75,8 @@ class PatchTester(object):
         :param ids_rule_fp: Path to the IDS rules for the binary
         :param num_threads: number of threads.
         :param isbitflip: Flag to indicate whether this binary has to be tested with bitflip
+        :param adaptive: Flag to indicate whether the number of runs should adapt to the results,
+                         instead of always running NUM_TEST_TIME times.
         :return: None
         """
         self.bin_directory = bin_directory
@@ -73,8 +86,84 @@ class PatchTester(object):
         # Sanity
         if self.num_threads > cpu_count():
             self.num_threads = cpu_count() - 1
+        # runs do not disturb each other on reserved cores, run as many of them in parallel as there are cores.
+        if get_core_pool().is_enabled():
+            self.num_threads = len(get_core_pool().cores)
         self.test_results = None
         self.isbitflip = isbitflip
+        self.adaptive = adaptive
+
+    def _run_tests(self, num_runs, stop_on_failure):
+        """
+            Run the poll on the binaries the provided number of times.
+        :param num_runs: number of times the poll should be run.
+        :param stop_on_failure: flag to indicate that the runs should stop at the first failure.
+        :return: list of results of bin_tester
+        """
+        thread_args = []
+        for i in range(num_runs):
+            thread_args.append((self.bin_directory, self.poll_xml_path, self.ids_rules_fp, self.isbitflip))
+        curr_results = []
+        if self.num_threads > 1 and num_runs > 1:
+            thread_pool = ThreadPool(processes=min(self.num_threads, num_runs))
+            for curr_result in thread_pool.imap_unordered(bin_tester_wrapper, thread_args):
+                curr_results.append(curr_result)
+                if stop_on_failure and curr_result[3] != BinaryTester.PASS_RESULT:
+                    break
+            # drops the runs which did not start yet.
+            thread_pool.terminate()
+            thread_pool.join()
+        else:
+            for curr_args in thread_args:
+                curr_results.append(bin_tester_wrapper(curr_args))
+                if stop_on_failure and curr_results[-1][3] != BinaryTester.PASS_RESULT:
+                    break
+        return curr_results
+
+    def _is_perf_converged(self):
+        """
+            Check if the perf measures of the runs so far are stable enough.
+        :return: True/False depending on whether the perf measures converged.
+        """
+        num_samples = len(self.test_results)
+        if num_samples < 2:
+            return False
+        t_value = PatchTester.T_VALUES.get(num_samples - 1, 2.0)
+        for curr_perf_key in PatchTester.CONVERGENCE_PERF_NAMES:
+            perf_vals = map(lambda curr_res: float((curr_res[4] or {}).get("perf", {}).get(curr_perf_key, 0.0)),
+                            self.test_results)
+            perf_mean = sum(perf_vals) / num_samples
+            sample_variance = sum(map(lambda x: (x - perf_mean) * (x - perf_mean), perf_vals)) / (num_samples - 1)
+            half_width = t_value * math.sqrt(sample_variance / num_samples)
+            if half_width > PatchTester.PERF_CONVERGENCE_TOLERANCE * abs(perf_mean):
+                return False
+        return True
+
+    def _test_adaptive(self):
+        """
+            Run the poll until it fails, or its perf measures converge, or we ran it MAX_TEST_TIME times.
+        :return: None
+        """
+        log_info("Trying to test:" + self.bin_directory + " with poll xml:" + self.poll_xml_path +
+                 " with " + str(self.num_threads) + " threads, adaptively between " + str(PatchTester.MIN_TEST_TIME) +
+                 " and " + str(PatchTester.MAX_TEST_TIME) + " times")
+        num_runs = PatchTester.MIN_TEST_TIME
+        while num_runs > 0:
+            self.test_results.extend(self._run_tests(num_runs, True))
+            if not self.are_polls_ok():
+                log_failure("Poll xml:" + self.poll_xml_path + " failed on:" + self.bin_directory + " after " +
+                            str(len(self.test_results)) + " runs")
+                return
+            if self._is_perf_converged():
+                break
+            if is_budget_expired():
+                log_failure("Poll xml:" + self.poll_xml_path + " ran out of time on:" + self.bin_directory +
+                            " before its perf measures converged")
+                break
+            # noisy, add more runs.
+            num_runs = min(max(self.num_threads, 1), PatchTester.MAX_TEST_TIME - len(self.test_results))
+        log_success("Tested:" + self.bin_directory + " with poll xml:" + self.poll_xml_path + " for " +
+                    str(len(self.test_results)) + " times")
 
     def test(self):
         """
@@ -83,7 +172,9 @@ class PatchTester(object):
         """
         if self.test_results is None:
             self.test_results = []
-            if os.path.exists(self.poll_xml_path):
+            if os.path.exists(self.poll_xml_path) and self.adaptive:
+                self._test_adaptive()
+            elif os.path.exists(self.poll_xml_path):
                 # if multi-threaded?
                 if self.num_threads > 1:
                     log_info("Trying to test:" + self.bin_directory + " with poll xml:" + self.poll_xml_path +
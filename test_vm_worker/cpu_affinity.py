@@ -0,0 +1,239 @@
+import ctypes
+import ctypes.util
+import multiprocessing
+import os
+from contextlib import contextmanager
+from common_utils.simple_logging import log_info, log_error
+from process_lock import ProcessLock
+
+# Cores reserved for measured runs (perf measurement of polls), e.g. "8-15" or "2,3,6".
+# Each measured run gets one of these cores to itself, all other work runs on the remaining cores.
+# Empty to disable core isolation.
+MEASURED_CORES_SPEC = os.environ.get('VM_WORKER_MEASURED_CORES', '')
+# Maximum number of cores supported in an affinity mask.
+MAX_CORES = 1024
+
+_libc = None
+
+
+def _get_libc():
+    """
+        Get libc, to call sched_*affinity, which are not available in the os module.
+    :return: ctypes.CDLL
+    """
+    global _libc
+    if _libc is None:
+        _libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+    return _libc
+
+
+def _get_mask_type():
+    """
+        Get ctypes type of a cpu mask, which can hold MAX_CORES cores.
+    :return: ctypes array type.
+    """
+    return ctypes.c_ulong * (MAX_CORES / (8 * ctypes.sizeof(ctypes.c_ulong)))
+
+
+def get_thread_affinity():
+    """
+        Get the cores on which the current thread is allowed to run.
+    :return: list of core numbers.
+    """
+    cpu_mask = _get_mask_type()()
+    if _get_libc().sched_getaffinity(0, ctypes.sizeof(cpu_mask), cpu_mask) != 0:
+        curr_errno = ctypes.get_errno()
+        raise OSError(curr_errno, "sched_getaffinity failed:" + os.strerror(curr_errno))
+    bits_per_word = 8 * ctypes.sizeof(ctypes.c_ulong)
+    return filter(lambda curr_core: cpu_mask[curr_core / bits_per_word] & (1 << (curr_core % bits_per_word)),
+                  range(MAX_CORES))
+
+
+def set_thread_affinity(cores):
+    """
+        Restrict the current thread to the provided cores.
+        Only the calling thread is affected, threads and processes it starts afterwards inherit the affinity.
+    :param cores: list of core numbers.
+    :return: None
+    """
+    cpu_mask = _get_mask_type()()
+    bits_per_word = 8 * ctypes.sizeof(ctypes.c_ulong)
+    for curr_core in cores:
+        cpu_mask[curr_core / bits_per_word] |= 1 << (curr_core % bits_per_word)
+    # pid 0 is the calling thread.
+    if _get_libc().sched_setaffinity(0, ctypes.sizeof(cpu_mask), cpu_mask) != 0:
+        curr_errno = ctypes.get_errno()
+        raise OSError(curr_errno, "sched_setaffinity failed:" + os.strerror(curr_errno))
+
+
+def parse_core_list(core_spec):
+    """
+        Parse a core list, in the format used by taskset and cpusets.
+    :param core_spec: core list, like "0-3,8,10-11"
+    :return: sorted list of core numbers.
+    """
+    all_cores = set()
+    for curr_part in core_spec.split(','):
+        curr_part = curr_part.strip()
+        if len(curr_part) == 0:
+            continue
+        if '-' in curr_part:
+            range_start, range_end = curr_part.split('-', 1)
+            all_cores.update(range(int(range_start), int(range_end) + 1))
+        else:
+            all_cores.add(int(curr_part))
+    return sorted(all_cores)
+
+
+def _get_measured_cores():
+    """
+        Get cores reserved for measured runs, which are usable by this process.
+        At least one core is always left for the other work.
+    :return: list of core numbers.
+    """
+    try:
+        measured_cores = parse_core_list(MEASURED_CORES_SPEC)
+        if len(measured_cores) == 0:
+            return []
+        allowed_cores = get_thread_affinity()
+    except (ValueError, OSError) as e:
+        log_error("Unable to use measured cores:" + MEASURED_CORES_SPEC + ", Error:" + str(e))
+        return []
+    measured_cores = filter(lambda curr_core: curr_core in allowed_cores, measured_cores)
+    if len(measured_cores) >= len(allowed_cores):
+        log_error("Measured cores:" + MEASURED_CORES_SPEC + " leave no core for other work, ignoring them.")
+        return []
+    return measured_cores
+
+
+MEASURED_CORES = _get_measured_cores()
+
+
+class CorePool(object):
+    """
+    Cores reserved for measured runs, shared by all worker processes of the daemon.
+    A measured run takes a core to itself and pins its thread (and so the
+    cb-test it starts) to that core, while all the other work is kept on the
+    remaining cores. Cores are accounted per holder (worker), so that cores
+    held by a worker which died can be given back, and the lock of the cores is
+    given back by the kernel, even if the worker died while holding it.
+    """
+
+    def __init__(self, cores, num_holders):
+        """
+            Create a pool of the provided cores.
+        :param cores: list of core numbers reserved for measured runs, empty to disable isolation.
+        :param num_holders: Number of processes that can hold cores.
+        :return: None
+        """
+        self.cores = list(cores)
+        self.num_holders = num_holders
+        self._lock = ProcessLock()
+        # holder index of each core, -1 if free.
+        self._core_holders = multiprocessing.Array('i', [-1] * max(len(self.cores), 1), lock=False)
+        self._holder_index = 0
+
+    def is_enabled(self):
+        """
+            Check if any cores are reserved for measured runs.
+        :return: True/False
+        """
+        return len(self.cores) > 0
+
+    def set_holder(self, holder_index):
+        """
+            Set the holder index of the current process.
+        :param holder_index: index of the current process.
+        :return: None
+        """
+        self._holder_index = holder_index
+
+    def acquire(self):
+        """
+            Wait for a free core and take it.
+        :return: index of the core in the pool.
+        """
+        with self._lock:
+            while True:
+                for i in range(len(self.cores)):
+                    if self._core_holders[i] == -1:
+                        self._core_holders[i] = self._holder_index
+                        return i
+                self._lock.wait()
+
+    def release(self, core_index):
+        """
+            Give back a core taken by the current process.
+        :param core_index: index of the core in the pool.
+        :return: None
+        """
+        with self._lock:
+            self._core_holders[core_index] = -1
+            self._lock.notify_all()
+
+    def release_all(self, holder_index):
+        """
+            Give back all cores held by the provided holder, used when the holder died.
+        :param holder_index: index of the holder.
+        :return: None
+        """
+        with self._lock:
+            for i in range(len(self.cores)):
+                if self._core_holders[i] == holder_index:
+                    self._core_holders[i] = -1
+            self._lock.notify_all()
+
+    def get_shared_cores(self):
+        """
+            Get the cores of the current process, which are not reserved for measured runs.
+        :return: list of core numbers.
+        """
+        return filter(lambda curr_core: curr_core not in self.cores, get_thread_affinity())
+
+    @contextmanager
+    def pinned_core(self):
+        """
+            Context manager to run the current thread alone on one of the reserved cores.
+        """
+        prev_cores = get_thread_affinity()
+        core_index = self.acquire()
+        try:
+            set_thread_affinity([self.cores[core_index]])
+            yield self.cores[core_index]
+        finally:
+            try:
+                set_thread_affinity(prev_cores)
+            finally:
+                self.release(core_index)
+
+
+_core_pool = None
+
+
+def init_worker_cores(worker_index, core_pool):
+    """
+        Worker pool initializer, keeps the worker process off the reserved cores.
+    :param worker_index: index of the worker in the pool.
+    :param core_pool: CorePool shared by all the workers.
+    :return: None
+    """
+    global _core_pool
+    core_pool.set_holder(worker_index)
+    _core_pool = core_pool
+    if core_pool.is_enabled():
+        shared_cores = core_pool.get_shared_cores()
+        set_thread_affinity(shared_cores)
+        log_info("Worker:" + str(os.getpid()) + " runs on cores:" + str(shared_cores) + ", measured runs on cores:" +
+                 str(core_pool.cores))
+
+
+def get_core_pool():
+    """
+        Get the core pool of the current process.
+        If the process is not part of a worker pool, a process local one is created.
+    :return: CorePool
+    """
+    global _core_pool
+    if _core_pool is None:
+        _core_pool = CorePool(MEASURED_CORES, 1)
+    return _core_pool
@@ -0,0 +1,140 @@
+import math
+import multiprocessing
+import os
+from contextlib import contextmanager
+from cpu_affinity import MEASURED_CORES, get_core_pool
+from process_lock import ProcessLock
+
+# Total number of cb-test invocations that can run at the same time across the daemon,
+# excluding measured runs on reserved cores.
+CPU_SLOTS = int(os.environ.get('VM_WORKER_CPU_SLOTS', max(multiprocessing.cpu_count() - len(MEASURED_CORES), 1)))
+
+
+class CPUSlotScheduler(object):
+    """
+    Fixed budget of CPU slots shared by all worker processes of the daemon.
+    Every cb-test invocation holds a slot while it runs, so the total cb-test
+    concurrency never exceeds the budget, however many threads the jobs use.
+    Slots are accounted per holder (worker), so that slots held by a worker
+    which died can be given back, and the lock of the slots is given back by
+    the kernel, even if the worker died while holding it.
+    """
+
+    def __init__(self, num_slots, num_holders):
+        """
+            Create a scheduler with the provided budget.
+        :param num_slots: Total number of slots.
+        :param num_holders: Number of processes that can hold slots.
+        :return: None
+        """
+        self.num_slots = num_slots
+        self.num_holders = num_holders
+        self._lock = ProcessLock()
+        self._held_slots = multiprocessing.Array('i', num_holders, lock=False)
+        self._holder_index = 0
+
+    def set_holder(self, holder_index):
+        """
+            Set the holder index of the current process.
+        :param holder_index: index of the current process.
+        :return: None
+        """
+        self._holder_index = holder_index
+
+    def acquire(self):
+        """
+            Wait for a free slot and take it.
+        :return: None
+        """
+        with self._lock:
+            while sum(self._held_slots) >= self.num_slots:
+                self._lock.wait()
+            self._held_slots[self._holder_index] += 1
+
+    def release(self):
+        """
+            Give back a slot taken by the current process.
+        :return: None
+        """
+        with self._lock:
+            self._held_slots[self._holder_index] -= 1
+            self._lock.notify_all()
+
+    def release_all(self, holder_index):
+        """
+            Give back all slots held by the provided holder, used when the holder died.
+        :param holder_index: index of the holder.
+        :return: None
+        """
+        with self._lock:
+            self._held_slots[holder_index] = 0
+            self._lock.notify_all()
+
+    @contextmanager
+    def slot(self):
+        """
+            Context manager to run something while holding a slot.
+        """
+        self.acquire()
+        try:
+            yield
+        finally:
+            self.release()
+
+    def get_job_threads(self, num_jobs):
+        """
+            Get number of threads a job could use, when sharing the slots with the provided number of jobs.
+        :param num_jobs: Number of jobs sharing the slots.
+        :return: Number of threads.
+        """
+        return max(1, int(math.ceil(float(self.num_slots) / max(num_jobs, 1))))
+
+
+_cpu_slot_scheduler = None
+
+
+def init_worker_slots(worker_index, scheduler):
+    """
+        Worker pool initializer, sets up the slot scheduler of the worker process.
+    :param worker_index: index of the worker in the pool.
+    :param scheduler: CPUSlotScheduler shared by all the workers.
+    :return: None
+    """
+    global _cpu_slot_scheduler
+    scheduler.set_holder(worker_index)
+    _cpu_slot_scheduler = scheduler
+
+
+def get_cpu_slot_scheduler():
+    """
+        Get the slot scheduler of the current process.
+        If the process is not part of a worker pool, a process local one is created.
+    :return: CPUSlotScheduler
+    """
+    global _cpu_slot_scheduler
+    if _cpu_slot_scheduler is None:
+        _cpu_slot_scheduler = CPUSlotScheduler(CPU_SLOTS, 1)
+    return _cpu_slot_scheduler
+
+
+def cpu_slot():
+    """
+        Context manager to run a cb-test while holding a slot.
+    """
+    return get_cpu_slot_scheduler().slot()
+
+
+@contextmanager
+def measured_cpu_slot():
+    """
+        Context manager to run a cb-test whose performance is measured.
+        If cores are reserved for measured runs, the cb-test runs alone on one of them,
+        else it holds a slot like any other cb-test.
+    """
+    core_pool = get_core_pool()
+    if core_pool.is_enabled():
+        with core_pool.pinned_core():
+            yield
+    else:
+        with cpu_slot():
+            yield
@@ -0,0 +1,78 @@
+import collections
+import os
+import time
+
+# Maximum number of entities kept in the cache of a process.
+ENTITY_CACHE_MAX_ENTRIES = int(os.environ.get('VM_WORKER_ENTITY_CACHE_MAX_ENTRIES', 1024))
+# Time (in seconds) after which a cached entity is fetched again, 0 to never expire.
+ENTITY_CACHE_TTL = float(os.environ.get('VM_WORKER_ENTITY_CACHE_TTL', 600))
+
+
+class EntityCache(object):
+    """
+    Process local, bounded, read-through cache of DB entities which do not
+    change once created (challenge sets, patch types, binaries, ids rules).
+    Least recently used entries are evicted once the cache is full.
+    Keys are tuples, whose first element is the kind of the entity.
+    """
+
+    def __init__(self, max_entries, ttl):
+        """
+            Create an entity cache.
+        :param max_entries: Maximum number of cached entities.
+        :param ttl: Time (in seconds) after which a cached entity is fetched again, 0 to never expire.
+        :return: None
+        """
+        self.max_entries = max_entries
+        self.ttl = ttl
+        # key -> (time of fetch, value), least recently used first.
+        self.entries = collections.OrderedDict()
+
+    def get(self, key, loader):
+        """
+            Get the cached value of the provided key, fetch it using the loader if not cached.
+            None and empty lists are never cached, as the entities might be created later.
+        :param key: tuple (kind of entity, ...) identifying the entity.
+        :param loader: function returning the value of the entity.
+        :return: value of the entity.
+        """
+        curr_entry = self.entries.pop(key, None)
+        if curr_entry is not None and (self.ttl <= 0 or time.time() - curr_entry[0] < self.ttl):
+            # mark as recently used.
+            self.entries[key] = curr_entry
+            return curr_entry[1]
+        curr_value = loader()
+        if curr_value is not None and curr_value != []:
+            self.entries[key] = (time.time(), curr_value)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        return curr_value
+
+    def invalidate(self, entity_kind=None, key=None):
+        """
+            Remove cached entities.
+        :param entity_kind: kind of entities to remove, None for all kinds.
+        :param key: key of the entity to remove, takes precedence over entity_kind.
+        :return: None
+        """
+        if key is not None:
+            self.entries.pop(key, None)
+        elif entity_kind is None:
+            self.entries.clear()
+        else:
+            for curr_key in filter(lambda curr_key: curr_key[0] == entity_kind, self.entries.keys()):
+                del self.entries[curr_key]
+
+
+_entity_cache = None
+
+
+def get_entity_cache():
+    """
+        Get the entity cache of the current process.
+    :return: EntityCache
+    """
+    global _entity_cache
+    if _entity_cache is None:
+        _entity_cache = EntityCache(ENTITY_CACHE_MAX_ENTRIES, ENTITY_CACHE_TTL)
+    return _entity_cache
@@ -1,10 +1,19 @@
 import os
+from datetime import datetime
+from peewee import PostgresqlDatabase, BlobField
 from dotenv import load_dotenv
 load_dotenv(os.path.join(os.path.dirname(__file__), '.env'))
 from farnsworth.models import NetworkPollSanitizerJob, CBTesterJob, PollCreatorJob, PovTesterJob, ChallengeSet, \
-                              ValidPoll, CBPollPerformance, PovTestResult, TesterResult, PatchType, PovTestResult
+                              ValidPoll, CBPollPerformance, PovTestResult, TesterResult, PatchType, PovTestResult, \
+                              ChallengeBinaryNode, IDSRule, RawRoundPoll
 import farnsworth.config
 from common_utils.simple_logging import log_error
+from binary_cache import materialize_cbn
+from result_sink import get_result_sink
+from entity_cache import get_entity_cache
+
+# Number of jobs fetched per query, while iterating over unstarted jobs.
+JOB_PAGE_SIZE = int(os.environ.get('VM_WORKER_JOB_PAGE_SIZE', 100))
 
 
 class CRSAPIWrapper:
@@ -12,13 +21,64 @@ class CRSAPIWrapper:
     Wrapper for farnsworth client
     """
 
+    # Flag to indicate that the connection should be kept open across jobs.
+    _persistent_connection = False
+    # pid of the process, which opened the current connection.
+    _connection_pid = None
+
     @staticmethod
     def open_connection():
+        if CRSAPIWrapper._persistent_connection and CRSAPIWrapper._connection_pid == os.getpid():
+            return
         farnsworth.config.connect_dbs()
+        CRSAPIWrapper._connection_pid = os.getpid()
 
     @staticmethod
     def close_connection():
-        farnsworth.config.close_dbs()
+        if CRSAPIWrapper._persistent_connection:
+            return
+        CRSAPIWrapper.flush_results()
+        CRSAPIWrapper.reset_connection()
+
+    @staticmethod
+    def reset_connection():
+        """
+            Close the connection irrespective of whether it is persistent or not.
+            The next open_connection will reconnect.
+        :return: None
+        """
+        if CRSAPIWrapper._connection_pid == os.getpid():
+            try:
+                farnsworth.config.close_dbs()
+            except Exception as e:
+                log_error("Error occurred while closing connection:" + str(e))
+        CRSAPIWrapper._connection_pid = None
+
+    @staticmethod
+    def flush_results(force=True):
+        """
+            Write all the results buffered in this process to the DB.
+        :param force: flag to indicate whether to write even if a failed write is to be retried later.
+        :return: True if all the results are written else False.
+        """
+        return get_result_sink().flush(force=force)
+
+    @staticmethod
+    def flush_results_if_due():
+        """
+            Write the results buffered in this process, if they are waiting for too long.
+        :return: None
+        """
+        get_result_sink().flush_if_due()
+
+    @staticmethod
+    def set_persistent_connection(is_persistent):
+        """
+            Keep the connection of this process open across jobs.
+        :param is_persistent: flag to indicate whether close_connection should be ignored.
+        :return: None
+        """
+        CRSAPIWrapper._persistent_connection = is_persistent
 
     @staticmethod
     def _get_job_by_id(job_id, job_type):
@@ -39,6 +99,33 @@ class CRSAPIWrapper:
         """
         return CRSAPIWrapper._get_job_by_id(job_id, CBTesterJob)
 
+    @staticmethod
+    def get_cb_tester_jobs(job_ids):
+        """
+            Get cb tester jobs of the given ids
+        :param job_ids: list of ids of the jobs to fetch.
+        :return: list of CBTesterJob
+        """
+        return list(CBTesterJob.select().where(CBTesterJob.id << list(job_ids)).order_by(CBTesterJob.id))
+
+    @staticmethod
+    def group_cb_tester_jobs(job_ids, max_group_size):
+        """
+            Group the provided cb tester jobs by their CS and patch type.
+        :param job_ids: ids of the jobs to group.
+        :param max_group_size: maximum number of jobs in a group.
+        :return: list of lists of job ids, jobs in a list share CS and patch type.
+        """
+        job_groups = {}
+        for curr_job in CBTesterJob.select().where(CBTesterJob.id << list(job_ids)).order_by(CBTesterJob.id):
+            job_groups.setdefault((curr_job.payload['target_cs_id'], curr_job.payload.get('patch_type')),
+                                  []).append(curr_job.id)
+        to_ret = []
+        for curr_group in job_groups.values():
+            for i in range(0, len(curr_group), max_group_size):
+                to_ret.append(curr_group[i:i + max_group_size])
+        return to_ret
+
     @staticmethod
     def get_pov_tester_job(job_id):
         """
@@ -67,69 +154,256 @@ class CRSAPIWrapper:
         return CRSAPIWrapper._get_job_by_id(job_id, NetworkPollSanitizerJob)
 
     @staticmethod
-    def get_all_poll_sanitizer_jobs(target_cs_id=None):
+    def get_poll_sanitizer_jobs(job_ids):
         """
-        Get all PollSanitizer Jobs Ready to run.
+            Get network poll sanitizer jobs of the given ids
+        :param job_ids: list of ids of the jobs to fetch.
+        :return: list of NetworkPollSanitizerJob
+        """
+        return list(NetworkPollSanitizerJob.select().where(NetworkPollSanitizerJob.id << list(job_ids))
+                                           .order_by(NetworkPollSanitizerJob.id))
+
+    @staticmethod
+    def group_poll_sanitizer_jobs(job_ids, max_group_size):
+        """
+            Group the provided network poll sanitizer jobs by the CS of their raw polls.
+        :param job_ids: ids of the jobs to group.
+        :param max_group_size: maximum number of jobs in a group.
+        :return: list of lists of job ids, jobs in a list share CS.
+        """
+        job_groups = {}
+        all_raw_poll_ids = dict(map(lambda curr_job: (curr_job.id, curr_job.payload['raw_poll_id']),
+                                    NetworkPollSanitizerJob.select()
+                                                           .where(NetworkPollSanitizerJob.id << list(job_ids))))
+        all_cs_ids = {}
+        if len(all_raw_poll_ids) > 0:
+            all_cs_ids = dict(RawRoundPoll.select(RawRoundPoll.id, RawRoundPoll.cs)
+                                          .where(RawRoundPoll.id << all_raw_poll_ids.values()).tuples())
+        for curr_job_id, curr_raw_poll_id in sorted(all_raw_poll_ids.items()):
+            job_groups.setdefault(all_cs_ids.get(curr_raw_poll_id), []).append(curr_job_id)
+        to_ret = []
+        for curr_group in job_groups.values():
+            for i in range(0, len(curr_group), max_group_size):
+                to_ret.append(curr_group[i:i + max_group_size])
+        return to_ret
+
+    @staticmethod
+    def get_raw_polls(target_jobs):
+        """
+            Get raw polls of the given network poll sanitizer jobs, with a single query.
+        :param target_jobs: list of NetworkPollSanitizerJob whose raw polls need to be fetched.
+        :return: dict of job id -> RawRoundPoll
+        """
+        all_raw_poll_ids = dict(map(lambda curr_job: (curr_job.id, curr_job.payload['raw_poll_id']), target_jobs))
+        if len(all_raw_poll_ids) == 0:
+            return {}
+        all_raw_polls = dict(map(lambda curr_poll: (curr_poll.id, curr_poll),
+                                 RawRoundPoll.select().where(RawRoundPoll.id << all_raw_poll_ids.values())))
+        return dict(map(lambda curr_job_id: (curr_job_id, all_raw_polls[all_raw_poll_ids[curr_job_id]]),
+                        all_raw_poll_ids))
+
+    @staticmethod
+    def start_job(target_job, job_args):
+        """
+            Mark the provided job as started, unless the dispatcher already claimed it for us.
+        :param target_job: Job that needs to be started.
+        :param job_args: (job id, num threads, is claimed) args with which the job processor is invoked.
+        :return: True if the job is ours to run else False.
+        """
+        if len(job_args) > 2 and job_args[2]:
+            return True
+        return target_job.try_start()
+
+    @staticmethod
+    def _get_unstarted_query(job_type, target_cs_id=None, target_cs_ids=None):
+        """
+            Get query of all unstarted jobs of the provided type.
+        :param job_type: Type of Job to get.
         :param target_cs_id: CS ID for which the Jobs needs to be fetched.
-        :return: List of all PollSanitizer Jobs.
+        :param target_cs_ids: list of CS IDs, for which the Jobs needs to be fetched. Ignored if target_cs_id is given.
+        :return: SelectQuery
         """
+        if target_cs_id is None and target_cs_ids is not None:
+            return job_type.unstarted().where(job_type.cs << target_cs_ids)
         target_cs = None
         if target_cs_id is not None:
             target_cs = CRSAPIWrapper.get_cs_from_id(target_cs_id)
         if target_cs is None:
-            all_poll_san_jobs = list(NetworkPollSanitizerJob.unstarted())
+            return job_type.unstarted()
+        return job_type.unstarted(cs=target_cs)
+
+    @staticmethod
+    def claim_jobs(job_type, num_jobs, target_cs_id=None, target_cs_ids=None):
+        """
+            Atomically mark up to the provided number of unstarted jobs as started.
+            On postgres, this is a single UPDATE ... RETURNING with SKIP LOCKED, so
+            that concurrent workers never wait on or get the same jobs.
+        :param job_type: Type of Job to claim.
+        :param num_jobs: Maximum number of jobs to claim.
+        :param target_cs_id: CS ID for which the Jobs needs to be claimed.
+        :param target_cs_ids: list of CS IDs, for which the Jobs needs to be claimed.
+        :return: List of ids of the claimed jobs.
+        """
+        if num_jobs <= 0 or (target_cs_ids is not None and len(target_cs_ids) == 0):
+            return []
+        unstarted_query = CRSAPIWrapper._get_unstarted_query(job_type, target_cs_id=target_cs_id,
+                                                             target_cs_ids=target_cs_ids)
+        job_db = job_type._meta.database
+        if isinstance(job_db, PostgresqlDatabase):
+            candidates_sql, candidates_params = unstarted_query.select(job_type.id).limit(num_jobs).sql()
+            started_column = _get_column_name(job_type.started_at)
+            id_column = _get_column_name(job_type.id)
+            claim_sql = 'UPDATE "{0}" SET "{1}" = %s WHERE "{2}" IN ({3} FOR UPDATE SKIP LOCKED) AND "{1}" IS NULL ' \
+                        'RETURNING "{2}"'.format(_get_table_name(job_type), started_column, id_column, candidates_sql)
+            cursor = job_db.execute_sql(claim_sql, [datetime.now()] + list(candidates_params))
+            return map(lambda curr_row: curr_row[0], cursor.fetchall())
+        # No row level locking, fall back to starting jobs one by one.
+        claimed_jobs = []
+        for curr_job in CRSAPIWrapper.iter_unstarted_jobs(job_type, target_cs_id=target_cs_id,
+                                                          target_cs_ids=target_cs_ids,
+                                                          page_size=min(num_jobs, JOB_PAGE_SIZE)):
+            if curr_job.try_start():
+                claimed_jobs.append(curr_job.id)
+                if len(claimed_jobs) >= num_jobs:
+                    break
+        return claimed_jobs
+
+    @staticmethod
+    def iter_unstarted_jobs(job_type, target_cs_id=None, page_size=JOB_PAGE_SIZE, target_cs_ids=None):
+        """
+            Iterate over unstarted jobs of the provided type.
+            Jobs are fetched page by page using keyset pagination (higher priority first, then by id),
+            so memory usage does not depend on the number of unstarted jobs.
+        :param job_type: Type of Job to get.
+        :param target_cs_id: CS ID for which the Jobs needs to be fetched.
+        :param page_size: Number of jobs fetched per query.
+        :param target_cs_ids: list of CS IDs, for which the Jobs needs to be fetched.
+        :return: Iterator of unstarted jobs.
+        """
+        unstarted_query = CRSAPIWrapper._get_unstarted_query(job_type, target_cs_id=target_cs_id,
+                                                             target_cs_ids=target_cs_ids)
+        priority_field = job_type._meta.fields.get('priority')
+        if priority_field is None:
+            unstarted_query = unstarted_query.order_by(job_type.id)
         else:
-            all_poll_san_jobs = list(NetworkPollSanitizerJob.unstarted(cs=target_cs))
+            unstarted_query = unstarted_query.order_by(priority_field.desc(), job_type.id)
+        last_job = None
+        while True:
+            curr_page_query = unstarted_query
+            if last_job is not None:
+                if priority_field is None:
+                    curr_page_query = curr_page_query.where(job_type.id > last_job.id)
+                else:
+                    last_priority = getattr(last_job, priority_field.name)
+                    curr_page_query = curr_page_query.where((priority_field < last_priority) |
+                                                            ((priority_field == last_priority) &
+                                                             (job_type.id > last_job.id)))
+            num_jobs = 0
+            for curr_job in curr_page_query.limit(page_size).iterator():
+                num_jobs += 1
+                last_job = curr_job
+                yield curr_job
+            if num_jobs < page_size:
+                break
+
+    @staticmethod
+    def get_unstarted_cs_ids(job_type):
+        """
+            Get ids of all the CS, which have unstarted jobs of the provided type.
+        :param job_type: Type of Job.
+        :return: list of CS IDs.
+        """
+        # without the ordering of unstarted, whose columns are not selected, which postgres refuses with distinct.
+        unstarted_query = job_type.unstarted().select(job_type.cs).order_by().distinct()
+        return map(lambda curr_row: curr_row[0], unstarted_query.tuples())
 
-        return all_poll_san_jobs
+    @staticmethod
+    def get_all_poll_sanitizer_jobs(target_cs_id=None):
+        """
+        Get all PollSanitizer Jobs Ready to run.
+        :param target_cs_id: CS ID for which the Jobs needs to be fetched.
+        :return: Iterator of all PollSanitizer Jobs.
+        """
+        return CRSAPIWrapper.iter_unstarted_jobs(NetworkPollSanitizerJob, target_cs_id=target_cs_id)
 
     @staticmethod
     def get_all_cb_tester_jobs(target_cs_id=None):
         """
         Get all cb tester jobs Ready to run.
         :param target_cs_id: CS ID for which the Jobs needs to be fetched.
-        :return: List of all tester jobs, ready to run.
+        :return: Iterator of all tester jobs, ready to run.
         """
-        target_cs = None
-        if target_cs_id is not None:
-            target_cs = CRSAPIWrapper.get_cs_from_id(target_cs_id)
-        if target_cs is None:
-            all_tests = list(CBTesterJob.unstarted())
-        else:
-            all_tests = list(CBTesterJob.unstarted(cs=target_cs))
-        return all_tests
+        return CRSAPIWrapper.iter_unstarted_jobs(CBTesterJob, target_cs_id=target_cs_id)
 
     @staticmethod
     def get_all_poller_jobs(target_cs_id=None):
         """
         Get all Poller Jobs Ready to run.
         :param target_cs_id: CS ID for which the Jobs needs to be fetched.
-        :return: List of all Poller Jobs.
+        :return: Iterator of all Poller Jobs.
         """
-        target_cs = None
-        if target_cs_id is not None:
-            target_cs = CRSAPIWrapper.get_cs_from_id(target_cs_id)
-        if target_cs is None:
-            all_poller_jobs = list(PollCreatorJob.unstarted())
-        else:
-            all_poller_jobs = list(PollCreatorJob.unstarted(cs=target_cs))
-        return all_poller_jobs
+        return CRSAPIWrapper.iter_unstarted_jobs(PollCreatorJob, target_cs_id=target_cs_id)
 
     @staticmethod
     def get_all_povtester_jobs(target_cs_id=None):
         """
         Get all PovTesterJobs Ready to run.
         :param target_cs_id: CS ID for which the Jobs needs to be fetched.
-        :return: List of all PovTester Jobs, that need to run
+        :return: Iterator of all PovTester Jobs, that need to run
         """
-        target_cs = None
-        if target_cs_id is not None:
-            target_cs = CRSAPIWrapper.get_cs_from_id(target_cs_id)
-        if target_cs is None:
-            all_povtester_jobs = list(PovTesterJob.unstarted())
-        else:
-            all_povtester_jobs = list(PovTesterJob.unstarted(cs=target_cs))
-        return all_povtester_jobs
+        return CRSAPIWrapper.iter_unstarted_jobs(PovTesterJob, target_cs_id=target_cs_id)
+
+    @staticmethod
+    def defer_large_fields(target_query, model_class):
+        """
+            Restrict the provided query to the columns of the model, other than its blobs.
+            Blobs can be loaded later with load_deferred_field.
+            Meant for models holding binaries (CBNs, polls, tests), jobs are always fetched whole
+            as their relations are kept in their payload.
+        :param target_query: SelectQuery of the provided model (lists are returned as is).
+        :param model_class: Model class of the query.
+        :return: SelectQuery
+        """
+        if not hasattr(target_query, 'select'):
+            return target_query
+        return target_query.select(*_get_light_fields(model_class))
+
+    @staticmethod
+    def load_deferred_field(model_obj, field_name, keep=True):
+        """
+            Get value of a field, which was deferred when the object was fetched.
+            The value is fetched only once and kept in the object.
+        :param model_obj: Model object.
+        :param field_name: Name of the field to load.
+        :param keep: flag to indicate whether the value should be kept in the object.
+        :return: value of the field.
+        """
+        loaded_data = getattr(model_obj, '__data__', None)
+        if loaded_data is None:
+            loaded_data = model_obj._data
+        if field_name in loaded_data:
+            return loaded_data[field_name]
+        model_class = type(model_obj)
+        field_value = model_class.select(model_class._meta.fields[field_name]) \
+                                 .where(model_class.id == model_obj.id).scalar()
+        if keep:
+            loaded_data[field_name] = field_value
+        return field_value
+
+    @staticmethod
+    def save_cbn(curr_cb, target_path, is_read_only=False):
+        """
+            Save binary of the provided cbn at the provided path.
+            The blob is fetched only if it is not in the binary cache.
+        :param curr_cb: ChallengeBinaryNode, possibly fetched without its blob.
+        :param target_path: path where the binary should be saved.
+        :param is_read_only: flag to indicate whether the saved binary is only read (like the binaries in the
+                             workspace of a job, which are only run by cb-test), so that it can be shared with
+                             the binary cache.
+        :return: target_path
+        """
+        return materialize_cbn(curr_cb, target_path, blob_getter=lambda: _load_cbn_blob(curr_cb),
+                               is_read_only=is_read_only)
 
     @staticmethod
     def get_best_pov_result(cs_fielding_obj, ids_fielding_obj):
@@ -141,6 +415,62 @@ class CRSAPIWrapper:
         """
         return PovTestResult.best(cs_fielding_obj, ids_fielding_obj)
 
+    @staticmethod
+    def get_obviated_pov_tester_jobs(job_ids, success_threshold):
+        """
+            Get the pov tester jobs, whose cs and ids fielding already have a result
+            with at least the provided number of successful throws, with a single query.
+        :param job_ids: ids of the pov tester jobs to check.
+        :param success_threshold: number of successful throws that obviate further testing.
+        :return: set of ids of the obviated jobs.
+        """
+        all_fieldings = dict(map(lambda curr_job: (curr_job.id, (curr_job.payload['target_cs_fielding_id'],
+                                                                 curr_job.payload.get('target_ids_fielding_id'))),
+                                 PovTesterJob.select().where(PovTesterJob.id << list(job_ids))))
+        if len(all_fieldings) == 0:
+            return set()
+        cs_fielding_ids = list(set(map(lambda curr_fielding: curr_fielding[0], all_fieldings.values())))
+        settled_fieldings = set()
+        for curr_result in PovTestResult.select(PovTestResult.cs_fielding, PovTestResult.ids_fielding) \
+                                        .where((PovTestResult.cs_fielding << cs_fielding_ids) &
+                                               (PovTestResult.num_success >= success_threshold)).distinct():
+            settled_fieldings.add((curr_result.cs_fielding_id, curr_result.ids_fielding_id))
+        return set(filter(lambda curr_job_id: all_fieldings[curr_job_id] in settled_fieldings, all_fieldings))
+
+    @staticmethod
+    def complete_jobs(job_type, job_ids):
+        """
+            Mark all the provided jobs as completed with a single query.
+        :param job_type: Type of the jobs.
+        :param job_ids: ids of the jobs to be completed.
+        :return: Number of jobs updated.
+        """
+        if len(job_ids) == 0:
+            return 0
+        return job_type.update(completed_at=datetime.now()).where(job_type.id << list(job_ids)).execute()
+
+    @staticmethod
+    def unclaim_jobs(job_type, job_ids):
+        """
+            Return the provided jobs, which we claimed but will not run, to the unstarted jobs.
+        :param job_type: Type of the jobs.
+        :param job_ids: ids of the jobs.
+        :return: Number of jobs updated.
+        """
+        if len(job_ids) == 0:
+            return 0
+        return job_type.update(started_at=None).where((job_type.id << list(job_ids)) &
+                                                      (job_type.completed_at.is_null(True))).execute()
+
+    @staticmethod
+    def complete_job(target_job):
+        """
+            Mark the provided job as completed, once all the results created before are written.
+        :param target_job: job to be marked completed.
+        :return: True if the job will be marked completed else False.
+        """
+        return get_result_sink().complete_job(target_job)
+
     @staticmethod
     def get_binary_path(test_job):
         """
@@ -151,8 +481,7 @@ class CRSAPIWrapper:
         filename = "{}-{}-{}".format(test_job.id, test_job.cbn.cs_id, test_job.cbn.name)
         target_path = os.path.join(os.path.expanduser("~"), filename)
         if not os.path.isfile(target_path):
-            open(target_path, 'wb').write(test_job.cbn.blob)
-            os.chmod(target_path, 0o777)
+            CRSAPIWrapper.save_cbn(test_job.cbn, target_path)
         return target_path
 
     @staticmethod
@@ -181,11 +510,8 @@ class CRSAPIWrapper:
         # This means original cbns
         if target_patch_type is None:
             return CRSAPIWrapper.get_unpatched_cbs(target_cs)
-        patch_type_cbns = target_cs.cbns_by_patch_type()
-        for curr_patch_type in patch_type_cbns:
-            if curr_patch_type.name == target_patch_type:
-                return patch_type_cbns[curr_patch_type]
-        return []
+        return list(get_entity_cache().get(('cbns', target_cs.id, target_patch_type),
+                                           lambda: _get_patched_cbs(target_cs, target_patch_type)))
 
     @staticmethod
     def get_unpatched_cbs(target_cs):
@@ -194,7 +520,20 @@ class CRSAPIWrapper:
         :param target_cs: ChallengeSet for which unpatched binaries need to be fetched.
         :return: List of unpatched CBNS of the given CS.
         """
-        return target_cs.cbns_original
+        return list(get_entity_cache().get(('cbns', target_cs.id, None),
+                                           lambda: list(CRSAPIWrapper.defer_large_fields(target_cs.cbns_original,
+                                                                                         ChallengeBinaryNode))))
+
+    @staticmethod
+    def get_fielded_cbs(cs_fielding):
+        """
+            Get CBs of the provided CS fielding.
+        :param cs_fielding: ChallengeSetFielding for which binaries need to be fetched.
+        :return: List of CBNS of the given fielding.
+        """
+        return list(get_entity_cache().get(('fielded_cbns', cs_fielding.id),
+                                           lambda: list(CRSAPIWrapper.defer_large_fields(cs_fielding.cbns,
+                                                                                         ChallengeBinaryNode))))
 
     @staticmethod
     def get_cs_from_id(target_cs_id):
@@ -203,7 +542,80 @@ class CRSAPIWrapper:
         :param target_cs_id: id for which ChallengeSet need to be fetched.
         :return:  ChallengeSet
         """
-        return ChallengeSet.get(ChallengeSet.id == target_cs_id)
+        return get_entity_cache().get(('cs', target_cs_id),
+                                      lambda: ChallengeSet.get(ChallengeSet.id == target_cs_id))
+
+    @staticmethod
+    def get_patch_type(patch_type_name):
+        """
+            Get PatchType with the given name
+        :param patch_type_name: name of the patch type.
+        :return: PatchType
+        """
+        return get_entity_cache().get(('patch_type', patch_type_name),
+                                      lambda: PatchType.get(PatchType.name == patch_type_name))
+
+    @staticmethod
+    def get_ids_rule(ids_rule_id):
+        """
+            Get IDSRule for given id
+        :param ids_rule_id: id for which IDSRule need to be fetched, could be None.
+        :return: IDSRule or None
+        """
+        if ids_rule_id is None:
+            return None
+        return get_entity_cache().get(('ids_rule', ids_rule_id),
+                                      lambda: IDSRule.get(IDSRule.id == ids_rule_id))
+
+    @staticmethod
+    def invalidate_cache(entity_kind=None):
+        """
+            Drop cached entities of this process, they will be fetched again when needed.
+        :param entity_kind: kind of entities to drop ('cs', 'patch_type', 'cbns', 'fielded_cbns' or 'ids_rule'),
+                            None for all.
+        :return: None
+        """
+        get_entity_cache().invalidate(entity_kind=entity_kind)
+
+    @staticmethod
+    def create_tester_result(test_job, error_code, result, stdout_out=None, stderr_out=None):
+        """
+            Create a tester result for the provided job, without performance counters.
+        :param test_job: The job for which the result is created.
+        :param error_code: error code of the test.
+        :param result: result of the test.
+        :param stdout_out: output of the test, if any.
+        :param stderr_out: error output of the test, if any.
+        :return: None
+        """
+        get_result_sink().add(TesterResult, job=test_job, error_code=int(error_code), result=result,
+                              stdout_out=stdout_out, stderr_out=stderr_out)
+
+    @staticmethod
+    def complete_timed_out_jobs(job_type, job_ids, error_code, result, stderr_out):
+        """
+            Record a tester result for each of the provided jobs which is not completed and mark them completed,
+            in a single transaction. Used for jobs whose worker was killed, so they have no one else to do it.
+        :param job_type: Type of the jobs.
+        :param job_ids: ids of the jobs.
+        :param error_code: error code of the results.
+        :param result: result of the results.
+        :param stderr_out: error output of the results.
+        :return: ids of the jobs which were completed.
+        """
+        if len(job_ids) == 0:
+            return []
+        with job_type._meta.database.atomic():
+            unfinished_ids = map(lambda curr_row: curr_row[0],
+                                 job_type.select(job_type.id).where((job_type.id << list(job_ids)) &
+                                                                    (job_type.completed_at.is_null(True))).tuples())
+            if len(unfinished_ids) == 0:
+                return []
+            TesterResult.insert_many(map(lambda curr_job_id: {'job': curr_job_id, 'error_code': int(error_code),
+                                                              'result': result, 'stderr_out': stderr_out},
+                                         unfinished_ids)).execute()
+            CRSAPIWrapper.complete_jobs(job_type, unfinished_ids)
+        return unfinished_ids
 
     @staticmethod
     def update_testjob_completed(test_job, error_code, result, stdout_out, stderr_out, performance_json):
@@ -217,14 +629,15 @@ class CRSAPIWrapper:
         :param output: Produced output of this job.
         :param performance_json: Json containing the performance counter of
                 the given job.
-        :return: True if successful else false
-        """
-        # Create tester result.
-        TesterResult.create(job=test_job, error_code=int(error_code), result=result, stdout_out=stdout_out,
-                            stderr_out=stderr_out, performances=performance_json)
-        # mark the corresponding test job as complete
-        test_job.completed()
-        return test_job.is_completed()
+        :return: True if the job is marked completed in the DB else false
+        """
+        # Create tester result and mark the corresponding test job as complete, along with it.
+        if not get_result_sink().complete_job_with_result(test_job, TesterResult, job=test_job,
+                                                          error_code=int(error_code), result=result,
+                                                          stdout_out=stdout_out, stderr_out=stderr_out,
+                                                          performances=performance_json):
+            return False
+        return CRSAPIWrapper.flush_results()
 
     @staticmethod
     def create_valid_poll(target_cs, poll_xml_content, test=None, target_round=None, is_perf_ready=True):
@@ -237,8 +650,8 @@ class CRSAPIWrapper:
         :param is_perf_ready: Flag to indicate that this poll could be used to measure performance.
         :return: None
         """
-        ValidPoll.create(cs=target_cs, test=test, is_perf_ready=is_perf_ready, round=target_round,
-                         blob=poll_xml_content)
+        get_result_sink().add(ValidPoll, cs=target_cs, test=test, is_perf_ready=is_perf_ready, round=target_round,
+                              blob=poll_xml_content)
 
     @staticmethod
     def create_poll_performance(target_poll, target_cs, patch_type, is_poll_ok=True, perf_json=None):
@@ -253,9 +666,9 @@ class CRSAPIWrapper:
         """
         patch_type_obj = None
         if patch_type is not None:
-            patch_type_obj = PatchType.get(PatchType.name == patch_type)
-        CBPollPerformance.create(poll=target_poll, cs=target_cs, patch_type=patch_type_obj, is_poll_ok=is_poll_ok,
-                                 performances=perf_json)
+            patch_type_obj = CRSAPIWrapper.get_patch_type(patch_type)
+        get_result_sink().add(CBPollPerformance, poll=target_poll, cs=target_cs, patch_type=patch_type_obj,
+                              is_poll_ok=is_poll_ok, performances=perf_json)
 
     @staticmethod
     def create_pov_test_result(target_exploit, cs_fielding, ids_fielding, num_success, test_feedback=None):
@@ -268,6 +681,64 @@ class CRSAPIWrapper:
         :param test_feedback: Feedback from testing, if any.
         :return:
         """
-        PovTestResult.create(exploit=target_exploit, cs_fielding=cs_fielding, ids_fielding=ids_fielding,
-                             num_success=num_success, test_feedback=test_feedback)
+        get_result_sink().add(PovTestResult, exploit=target_exploit, cs_fielding=cs_fielding,
+                              ids_fielding=ids_fielding, num_success=num_success, test_feedback=test_feedback)
+
+
+
+def _get_table_name(model_class):
+    """
+        Get name of the DB table of the provided model.
+    :param model_class: peewee model class.
+    :return: table name.
+    """
+    model_meta = model_class._meta
+    return getattr(model_meta, 'table_name', None) or model_meta.db_table
+
 
+def _get_column_name(model_field):
+    """
+        Get name of the DB column of the provided field.
+    :param model_field: peewee field.
+    :return: column name.
+    """
+    return getattr(model_field, 'column_name', None) or model_field.db_column
+
+
+def _get_light_fields(model_class):
+    """
+        Get all fields of the provided model, except its blobs.
+    :param model_class: peewee model class, other than a job.
+    :return: list of fields.
+    """
+    return filter(lambda curr_field: not isinstance(curr_field, BlobField), model_class._meta.sorted_fields)
+
+
+def _load_cbn_blob(curr_cb):
+    """
+        Get blob of the provided cbn, which might have been fetched without it.
+        The blob is not kept in the cbn, as cbns are cached.
+    :param curr_cb: ChallengeBinaryNode
+    :return: blob of the cbn.
+    """
+    curr_blob = CRSAPIWrapper.load_deferred_field(curr_cb, 'blob', keep=False)
+    if curr_blob is None:
+        # the binary is no longer in the DB, the cached binaries are stale.
+        CRSAPIWrapper.invalidate_cache(entity_kind='cbns')
+        CRSAPIWrapper.invalidate_cache(entity_kind='fielded_cbns')
+        raise ValueError("ChallengeBinaryNode:" + str(curr_cb.id) + " no longer exists.")
+    return curr_blob
+
+
+def _get_patched_cbs(target_cs, target_patch_type):
+    """
+        Get binaries of the provided CS and patch type, without their blobs.
+    :param target_cs: CS for which the binaries need to be fetched.
+    :param target_patch_type: name of the patch type.
+    :return: list of binaries.
+    """
+    return list(ChallengeBinaryNode.select(*_get_light_fields(ChallengeBinaryNode))
+                                   .join(PatchType, on=(ChallengeBinaryNode.patch_type == PatchType.id))
+                                   .where((ChallengeBinaryNode.cs == target_cs) &
+                                          (PatchType.name == target_patch_type))
+                                   .order_by(ChallengeBinaryNode.id))
@@ -0,0 +1,244 @@
+import bisect
+import hashlib
+import os
+import socket
+import time
+from datetime import datetime, timedelta
+from peewee import Model, CharField, IntegerField, DateTimeField, IntegrityError
+from common_utils.simple_logging import log_info, log_error
+from farnsworth.models import PovTesterJob
+from farnsworth_api_wrapper import CRSAPIWrapper
+from metrics import get_metrics
+
+# Flag to indicate whether VMs coordinate which CS they work on, when no CS ID is provided.
+FLEET_MODE = os.environ.get('VM_WORKER_FLEET_MODE', '0') == '1'
+# Name of this VM in the fleet, should be unique across the fleet.
+FLEET_NODE_NAME = os.environ.get('VM_WORKER_NODE_NAME', socket.gethostname())
+# Time (in seconds) between two heartbeats of a VM.
+FLEET_HEARTBEAT_INTERVAL = float(os.environ.get('VM_WORKER_FLEET_HEARTBEAT_INTERVAL', 10))
+# Time (in seconds) after the last heartbeat, after which a VM is considered dead and its CS are reassigned.
+FLEET_NODE_TIMEOUT = float(os.environ.get('VM_WORKER_FLEET_NODE_TIMEOUT', 60))
+# Flag to indicate whether a VM with no jobs of its own, takes jobs of CS assigned to other VMs.
+FLEET_WORK_STEALING = os.environ.get('VM_WORKER_FLEET_WORK_STEALING', '1') == '1'
+# Time (in seconds) for which a VM should be out of jobs of its own, before it takes jobs of other VMs.
+FLEET_STEAL_GRACE = float(os.environ.get('VM_WORKER_FLEET_STEAL_GRACE', 5))
+# Number of points per slot of a VM on the hash ring, more points spread the CS more evenly.
+RING_POINTS_PER_SLOT = 16
+
+
+class VMWorkerNode(Model):
+    """
+    A VM of the fleet, kept alive by its heartbeats.
+    """
+    name = CharField(unique=True)
+    num_slots = IntegerField(default=1)
+    last_seen = DateTimeField(index=True)
+
+    class Meta:
+        # same database as the jobs.
+        database = PovTesterJob._meta.database
+
+
+def _get_hash(hash_key):
+    """
+        Get position of the provided key on the hash ring.
+    :param hash_key: str
+    :return: int
+    """
+    return int(hashlib.md5(hash_key).hexdigest()[:16], 16)
+
+
+class FleetCoordinator(object):
+    """
+    Assigns challenge sets to the VMs of a fleet, by consistent hashing over the
+    live VMs, so that all jobs of a CS prefer the VM which already has its
+    binaries. When a VM joins or leaves, only the CS of its neighbours on the
+    ring move. A VM which is out of jobs of its own CS for a while, takes jobs of the others.
+    """
+
+    def __init__(self, node_name, num_slots, heartbeat_interval=FLEET_HEARTBEAT_INTERVAL,
+                 node_timeout=FLEET_NODE_TIMEOUT, allow_stealing=FLEET_WORK_STEALING, steal_grace=FLEET_STEAL_GRACE):
+        """
+            Create a coordinator for this VM.
+        :param node_name: name of this VM, unique across the fleet.
+        :param num_slots: number of jobs this VM runs at once, VMs get CS in proportion to their slots.
+        :param heartbeat_interval: Time (in seconds) between two heartbeats.
+        :param node_timeout: Time (in seconds) after the last heartbeat, after which a VM is considered dead.
+        :param allow_stealing: flag to indicate whether jobs of CS assigned to other VMs can be taken.
+        :param steal_grace: Time (in seconds) for which this VM should be out of jobs of its own,
+                            before it takes jobs of other VMs.
+        :return: None
+        """
+        self.node_name = node_name
+        self.num_slots = max(num_slots, 1)
+        self.heartbeat_interval = heartbeat_interval
+        self.node_timeout = node_timeout
+        self.allow_stealing = allow_stealing
+        self.steal_grace = steal_grace
+        # time since which this VM is out of jobs of its own, None if it is not.
+        self.idle_since = None
+        # job type -> CS IDs with unstarted jobs, fetched once per dispatch pass.
+        self.unstarted_cs_ids = {}
+        self.last_heartbeat_time = None
+        # sorted list of positions on the ring, and the VM at each position.
+        self.ring_positions = []
+        self.ring_nodes = []
+        self.live_node_names = []
+
+    def register(self):
+        """
+            Add this VM to the fleet.
+        :return: None
+        """
+        VMWorkerNode.create_table(True)
+        self.heartbeat()
+        log_info("Registered VM:" + self.node_name + " with " + str(self.num_slots) + " slots, fleet has " +
+                 str(len(self.live_node_names)) + " live VMs.")
+
+    def heartbeat(self):
+        """
+            Tell the fleet that this VM is alive, and get the VMs which are alive.
+        :return: None
+        """
+        self.last_heartbeat_time = time.time()
+        curr_time = datetime.now()
+        try:
+            num_updated = VMWorkerNode.update(last_seen=curr_time, num_slots=self.num_slots) \
+                                      .where(VMWorkerNode.name == self.node_name).execute()
+            if num_updated == 0:
+                try:
+                    VMWorkerNode.create(name=self.node_name, num_slots=self.num_slots, last_seen=curr_time)
+                except IntegrityError:
+                    # someone else registered with our name, share it.
+                    log_error("VM:" + self.node_name + " is already registered by someone else.")
+            live_nodes = VMWorkerNode.select().where(VMWorkerNode.last_seen >=
+                                                     curr_time - timedelta(seconds=self.node_timeout))
+            self._build_ring(map(lambda curr_node: (curr_node.name, curr_node.num_slots), live_nodes))
+        except Exception as e:
+            # keep working with the VMs we know of.
+            log_error("Error occurred while sending heartbeat of VM:" + self.node_name + ", Error:" + str(e))
+            if len(self.ring_nodes) == 0:
+                self._build_ring([])
+
+    def heartbeat_if_due(self):
+        """
+            Send a heartbeat, if the last one is older than the heartbeat interval.
+        :return: None
+        """
+        if self.last_heartbeat_time is None or time.time() - self.last_heartbeat_time >= self.heartbeat_interval:
+            self.heartbeat()
+
+    def unregister(self):
+        """
+            Remove this VM from the fleet, its CS are taken over by the others.
+        :return: None
+        """
+        try:
+            VMWorkerNode.delete().where(VMWorkerNode.name == self.node_name).execute()
+            log_info("Unregistered VM:" + self.node_name)
+        except Exception as e:
+            log_error("Error occurred while unregistering VM:" + self.node_name + ", Error:" + str(e))
+
+    def _build_ring(self, all_nodes):
+        """
+            Build the hash ring of the provided VMs.
+        :param all_nodes: list of (VM name, number of slots)
+        :return: None
+        """
+        all_nodes = dict(all_nodes)
+        # we are alive, even if the DB does not know yet.
+        all_nodes[self.node_name] = self.num_slots
+        all_points = []
+        for node_name, num_slots in all_nodes.items():
+            for point_index in range(RING_POINTS_PER_SLOT * max(num_slots, 1)):
+                all_points.append((_get_hash(node_name + '#' + str(point_index)), node_name))
+        all_points.sort()
+        self.ring_positions = map(lambda curr_point: curr_point[0], all_points)
+        self.ring_nodes = map(lambda curr_point: curr_point[1], all_points)
+        if sorted(all_nodes.keys()) != self.live_node_names:
+            self.live_node_names = sorted(all_nodes.keys())
+            log_info("Live VMs in the fleet:" + ','.join(self.live_node_names))
+
+    def get_owner(self, cs_id):
+        """
+            Get the VM to which the provided CS is assigned.
+        :param cs_id: CS ID.
+        :return: name of the VM.
+        """
+        ring_index = bisect.bisect(self.ring_positions, _get_hash('cs#' + str(cs_id)))
+        return self.ring_nodes[ring_index % len(self.ring_nodes)]
+
+    def start_dispatch(self):
+        """
+            Start a dispatch pass, CS IDs with unstarted jobs are fetched once per pass.
+        :return: None
+        """
+        self.heartbeat_if_due()
+        self.unstarted_cs_ids = {}
+
+    def _get_unstarted_cs_ids(self, job_type):
+        """
+            Get CS IDs, which have unstarted jobs of the provided type.
+        :param job_type: Job model class.
+        :return: list of CS IDs.
+        """
+        if job_type not in self.unstarted_cs_ids:
+            self.unstarted_cs_ids[job_type] = CRSAPIWrapper.get_unstarted_cs_ids(job_type)
+        return self.unstarted_cs_ids[job_type]
+
+    def claim_jobs(self, job_type, num_jobs):
+        """
+            Claim jobs of the CS assigned to this VM.
+        :param job_type: Job model class.
+        :param num_jobs: Maximum number of jobs to claim.
+        :return: list of ids of the claimed jobs.
+        """
+        own_cs_ids = filter(lambda curr_cs_id: self.get_owner(curr_cs_id) == self.node_name,
+                            self._get_unstarted_cs_ids(job_type))
+        return CRSAPIWrapper.claim_jobs(job_type, num_jobs, target_cs_ids=own_cs_ids)
+
+    def on_dispatched(self, is_out_of_jobs):
+        """
+            Account for a dispatch pass of the jobs of this VM.
+        :param is_out_of_jobs: flag to indicate whether slots were left free, as there are no more jobs of our own.
+        :return: None
+        """
+        if not is_out_of_jobs:
+            self.idle_since = None
+        elif self.idle_since is None:
+            self.idle_since = time.time()
+
+    def can_steal(self):
+        """
+            Check if this VM can take jobs of the other VMs,
+            it should be out of jobs of its own (of all job types) for the grace period.
+        :return: True/False
+        """
+        return self.allow_stealing and self.idle_since is not None and \
+            time.time() - self.idle_since >= self.steal_grace
+
+    def steal_jobs(self, job_type, num_jobs):
+        """
+            Claim jobs of the CS assigned to the other VMs.
+        :param job_type: Job model class.
+        :param num_jobs: Maximum number of jobs to claim.
+        :return: list of ids of the claimed jobs.
+        """
+        other_cs_ids = filter(lambda curr_cs_id: self.get_owner(curr_cs_id) != self.node_name,
+                              self._get_unstarted_cs_ids(job_type))
+        stolen_jobs = CRSAPIWrapper.claim_jobs(job_type, num_jobs, target_cs_ids=other_cs_ids)
+        if len(stolen_jobs) > 0:
+            log_info("Took " + str(len(stolen_jobs)) + " Jobs of other VMs, as we have no more of our own.")
+            get_metrics().inc('vm_worker_jobs_stolen_total', {}, len(stolen_jobs))
+        return stolen_jobs
+
+
+def get_fleet_coordinator(num_slots):
+    """
+        Get the coordinator of this VM, if fleet mode is enabled.
+    :param num_slots: number of jobs this VM runs at once.
+    :return: FleetCoordinator or None.
+    """
+    if not FLEET_MODE:
+        return None
+    return FleetCoordinator(FLEET_NODE_NAME, num_slots)
@@ -0,0 +1,417 @@
+from common_utils.simple_logging import log_info, log_success, log_failure
+from farnsworth_api_wrapper import CRSAPIWrapper
+from metrics import get_metrics, job_phase, export_metrics
+from time_budget import get_task_time_limit, JOB_TERMINATE_GRACE, TIMEOUT_RESULT, TIMEOUT_ERROR_CODE
+import math
+import os
+import random
+import signal
+import time
+
+# Maximum number of jobs of a groupable job type that are run together by one worker.
+JOB_GROUP_SIZE = int(os.environ.get('VM_WORKER_JOB_GROUP_SIZE', 8))
+# Maximum time (in seconds) to wait before looking for jobs again, when there are none.
+POLL_MAX_TIME = float(os.environ.get('VM_WORKER_POLL_MAX_TIME', 16))
+
+
+class JobDispatcher(object):
+    """
+    Streams jobs to a worker pool.
+    A free slot is refilled as soon as any job finishes, instead of waiting
+    for a whole batch of jobs to finish.
+    Jobs of several types run at the same time: strict priority job types get
+    free slots first, the other job types share the slots according to their
+    weights, and slots a job type can not use are backfilled by the others.
+    """
+
+    def __init__(self, worker_pool, worker_config, cpu_slot_scheduler, max_in_flight, target_cs_id=None,
+                 target_job_type=None, max_num_jobs=1000, poll_time=1, job_group_config=None,
+                 job_filter_config=None, strict_priority_job_types=None, job_weight_config=None,
+                 job_cap_config=None, job_notifier=None, max_poll_time=POLL_MAX_TIME, fleet_coordinator=None,
+                 lease_manager=None):
+        """
+            Create a job dispatcher.
+        :param worker_pool: WarmWorkerPool to run the jobs.
+        :param worker_config: list of (worker name, job type, job processor) in priority order.
+        :param cpu_slot_scheduler: CPUSlotScheduler shared by all the jobs.
+        :param max_in_flight: Maximum number of jobs, which are dispatched but not finished.
+        :param target_cs_id: CS ID for which the jobs need to be processed.
+        :param target_job_type: Type of the jobs to process, None for all types.
+        :param max_num_jobs: Maximum number of jobs to process.
+        :param poll_time: Time to sleep, if no jobs are available to run. Doubles every time we find no jobs,
+                          up to max_poll_time.
+        :param job_group_config: dict of worker name -> (job grouper, group processor) for job types
+                                 whose jobs should be run in groups.
+        :param job_filter_config: dict of worker name -> job filter for job types, some of whose jobs
+                                  can be completed without a worker. A job filter completes such jobs
+                                  and returns ids of the remaining ones.
+        :param strict_priority_job_types: list of worker names, which get free slots before the other job types.
+        :param job_weight_config: dict of worker name -> weight, share of the slots of a job type is proportional
+                                  to its weight. Job types not in here have weight 1.
+        :param job_cap_config: dict of worker name -> maximum number of tasks of the job type that can be in flight.
+        :param job_notifier: notifier of new jobs (PostgresJobNotifier or LocalJobNotifier), we look for jobs as soon
+                             as they are notified. None to only poll.
+        :param max_poll_time: Maximum time to sleep, if no jobs are available to run.
+        :param fleet_coordinator: FleetCoordinator, which decides the CS whose jobs we should claim.
+                                  None to claim jobs of any CS. Not used, if target_cs_id is provided.
+        :param lease_manager: LeaseManager, which leases the claimed jobs until they finish. None to not lease them.
+        :return: None
+        """
+        self.worker_pool = worker_pool
+        self.worker_config = worker_config
+        self.cpu_slot_scheduler = cpu_slot_scheduler
+        self.max_in_flight = max_in_flight
+        self.target_cs_id = target_cs_id
+        self.target_job_type = target_job_type
+        self.max_num_jobs = max_num_jobs
+        self.poll_time = poll_time
+        self.job_group_config = job_group_config or {}
+        self.job_filter_config = job_filter_config or {}
+        self.strict_priority_job_types = strict_priority_job_types or []
+        self.job_weight_config = job_weight_config or {}
+        self.job_cap_config = job_cap_config or {}
+        self.job_notifier = job_notifier
+        self.max_poll_time = max_poll_time
+        self.fleet_coordinator = fleet_coordinator
+        self.lease_manager = lease_manager
+        # number of times in a row, we found no jobs.
+        self.num_idle_polls = 0
+        self.processed_jobs = 0
+        # task id -> (worker name, job id or list of job ids, submit time, num threads of the job)
+        self.in_flight = {}
+        # task id -> time at which its worker was asked to stop, for tasks which ran out of time.
+        self.stopping_tasks = {}
+        # task id -> (worker name, job id or list of job ids, error), for finished tasks whose results are not
+        # yet written, their leases are held until then.
+        self.unflushed_tasks = {}
+
+    def _claim_jobs(self, worker_name, job_type, num_jobs_to_claim, is_stealing=False):
+        """
+            Claim jobs of the provided type, jobs which need no worker are completed right away.
+        :param worker_name: type of the jobs.
+        :param job_type: Job model class.
+        :param num_jobs_to_claim: Maximum number of jobs to claim.
+        :param is_stealing: flag to indicate whether to claim jobs of the other VMs of the fleet, instead of ours.
+        :return: list of ids of claimed jobs, which need to be run.
+        """
+        while num_jobs_to_claim > 0:
+            # jobs are marked started here, children only get jobs that are already ours.
+            with job_phase(worker_name, 'claim'):
+                if is_stealing:
+                    available_jobs = self.fleet_coordinator.steal_jobs(job_type, num_jobs_to_claim)
+                elif self.fleet_coordinator is not None and self.target_cs_id is None:
+                    available_jobs = self.fleet_coordinator.claim_jobs(job_type, num_jobs_to_claim)
+                else:
+                    available_jobs = CRSAPIWrapper.claim_jobs(job_type, num_jobs_to_claim,
+                                                              target_cs_id=self.target_cs_id)
+            if len(available_jobs) == 0:
+                break
+            log_info("Claimed " + str(len(available_jobs)) + " " + worker_name + " Jobs.")
+            if self.lease_manager is not None:
+                self.lease_manager.acquire(job_type, available_jobs)
+            get_metrics().inc('vm_worker_jobs_claimed_total', {'job_type': worker_name}, len(available_jobs))
+            if worker_name not in self.job_filter_config:
+                return available_jobs
+            with job_phase(worker_name, 'filter'):
+                remaining_jobs = self.job_filter_config[worker_name](available_jobs)
+            num_completed = len(available_jobs) - len(remaining_jobs)
+            if num_completed > 0:
+                log_success("Completed " + str(num_completed) + " " + worker_name + " Jobs without running them.")
+                get_metrics().inc('vm_worker_jobs_skipped_total', {'job_type': worker_name}, num_completed)
+                if self.lease_manager is not None:
+                    self.lease_manager.release(job_type, filter(lambda curr_job_id: curr_job_id not in remaining_jobs,
+                                                                available_jobs))
+            self.processed_jobs += num_completed
+            if len(remaining_jobs) > 0:
+                return remaining_jobs
+            # all of them were completed, try to get some real work.
+            num_jobs_to_claim = min(num_jobs_to_claim, self.max_num_jobs - self.processed_jobs)
+        return []
+
+    def _unclaim_jobs(self, worker_name, job_type, job_ids):
+        """
+            Give back the provided claimed jobs, as we have no slots to run them.
+        :param worker_name: type of the jobs.
+        :param job_type: Job model class.
+        :param job_ids: list of job ids.
+        :return: None
+        """
+        if len(job_ids) == 0:
+            return
+        CRSAPIWrapper.unclaim_jobs(job_type, job_ids)
+        if self.lease_manager is not None:
+            self.lease_manager.cancel(job_type, job_ids)
+        log_info("Gave back " + str(len(job_ids)) + " " + worker_name + " Jobs, which did not fit in the slots.")
+
+    def _get_num_in_flight(self, worker_name):
+        """
+            Get number of tasks of the provided job type, which are dispatched but not finished.
+        :param worker_name: type of the jobs.
+        :return: Number of tasks.
+        """
+        return len(filter(lambda curr_task: curr_task[0] == worker_name, self.in_flight.values()))
+
+    def _get_job_type(self, worker_name):
+        """
+            Get Job model class of the provided job type.
+        :param worker_name: type of the jobs.
+        :return: Job model class.
+        """
+        for curr_worker_name, job_type, _ in self.worker_config:
+            if curr_worker_name == worker_name:
+                return job_type
+        return None
+
+    def _get_weight(self, worker_name):
+        """
+            Get weight of the provided job type.
+        :param worker_name: type of the jobs.
+        :return: weight
+        """
+        return max(self.job_weight_config.get(worker_name, 1), 1)
+
+    def _dispatch_job_type(self, curr_worker_config, num_tasks, exhausted_job_types, is_stealing=False):
+        """
+            Claim and dispatch up to the provided number of tasks of the provided job type.
+        :param curr_worker_config: (worker name, job type, job processor) of the job type.
+        :param num_tasks: Maximum number of tasks to dispatch.
+        :param exhausted_job_types: set of worker names of job types, which have no more jobs.
+                                    The job type is added to it, if we could not get enough jobs.
+        :param is_stealing: flag to indicate whether to dispatch jobs of the other VMs of the fleet, instead of ours.
+        :return: Number of dispatched tasks, a group of jobs is one task.
+        """
+        worker_name, job_type, job_processor = curr_worker_config
+        if worker_name in self.job_cap_config:
+            num_tasks = min(num_tasks, self.job_cap_config[worker_name] - self._get_num_in_flight(worker_name))
+        num_jobs_to_claim = min(num_tasks, self.max_num_jobs - self.processed_jobs)
+        if num_jobs_to_claim <= 0 or worker_name in exhausted_job_types:
+            return 0
+        if worker_name in self.job_group_config:
+            # each slot can take a group of jobs.
+            num_jobs_to_claim = min(num_tasks * JOB_GROUP_SIZE, self.max_num_jobs - self.processed_jobs)
+        available_jobs = self._claim_jobs(worker_name, job_type, num_jobs_to_claim, is_stealing=is_stealing)
+        if len(available_jobs) < num_jobs_to_claim:
+            exhausted_job_types.add(worker_name)
+        if len(available_jobs) == 0:
+            return 0
+        all_tasks = map(lambda curr_job_id: (job_processor, curr_job_id), available_jobs)
+        if worker_name in self.job_group_config:
+            job_grouper, group_processor = self.job_group_config[worker_name]
+            job_groups = job_grouper(available_jobs, JOB_GROUP_SIZE)
+            log_info("Grouped " + str(len(available_jobs)) + " " + worker_name + " Jobs into " +
+                     str(len(job_groups)) + " groups.")
+            # jobs which do not group well can take more tasks than we have slots for, the fullest groups go first.
+            job_groups.sort(key=len, reverse=True)
+            self._unclaim_jobs(worker_name, job_type, sum(job_groups[num_tasks:], []))
+            job_groups = job_groups[:num_tasks]
+            all_tasks = map(lambda curr_group: (group_processor, curr_group), job_groups)
+        # cb-test concurrency is bounded by the slots, threads only decide how the slots are shared.
+        child_threads = self.cpu_slot_scheduler.get_job_threads(len(self.in_flight) + len(all_tasks))
+        for curr_processor, curr_job in all_tasks:
+            task_id = self.worker_pool.submit(curr_processor, (curr_job, child_threads, True))
+            self.in_flight[task_id] = (worker_name, curr_job, time.time(), child_threads)
+            self.processed_jobs += len(curr_job) if isinstance(curr_job, list) else 1
+        return len(all_tasks)
+
+    def _dispatch(self, num_free):
+        """
+            Claim and dispatch jobs of all job types, to fill up the provided number of free slots.
+            Strict priority job types get the free slots first. The remaining slots are shared by the other
+            job types in proportion to their weights, and slots left unused are backfilled in priority order.
+            In a fleet, slots left unused once all job types are out of jobs of our own, go to jobs of other VMs.
+        :param num_free: Number of tasks that can be dispatched.
+        :return: Number of dispatched tasks, a group of jobs is one task.
+        """
+        is_fleet = self.fleet_coordinator is not None and self.target_cs_id is None
+        if is_fleet:
+            self.fleet_coordinator.start_dispatch()
+        all_job_types = filter(lambda curr_config: self.target_job_type is None or
+                               curr_config[0] == self.target_job_type, self.worker_config)
+        strict_job_types = filter(lambda curr_config: curr_config[0] in self.strict_priority_job_types,
+                                  all_job_types)
+        shared_job_types = filter(lambda curr_config: curr_config[0] not in self.strict_priority_job_types,
+                                  all_job_types)
+        exhausted_job_types = set()
+        num_dispatched = 0
+        for curr_config in strict_job_types:
+            num_dispatched += self._dispatch_job_type(curr_config, num_free - num_dispatched, exhausted_job_types)
+
+        if len(shared_job_types) > 0:
+            # slots not used by strict priority job types are shared by weight,
+            # the job types furthest below their share get to claim first.
+            num_shared_slots = self.max_in_flight - sum(map(lambda curr_config:
+                                                            self._get_num_in_flight(curr_config[0]), strict_job_types))
+            total_weight = sum(map(lambda curr_config: self._get_weight(curr_config[0]), shared_job_types))
+            shared_job_types.sort(key=lambda curr_config: float(self._get_num_in_flight(curr_config[0])) /
+                                  self._get_weight(curr_config[0]))
+            for curr_config in shared_job_types:
+                curr_share = int(math.ceil(float(num_shared_slots * self._get_weight(curr_config[0])) / total_weight))
+                num_tasks = min(curr_share - self._get_num_in_flight(curr_config[0]), num_free - num_dispatched)
+                num_dispatched += self._dispatch_job_type(curr_config, num_tasks, exhausted_job_types)
+
+            # backfill, slots which other job types could not use.
+            for curr_config in filter(lambda curr_config: curr_config in shared_job_types, all_job_types):
+                num_dispatched += self._dispatch_job_type(curr_config, num_free - num_dispatched, exhausted_job_types)
+
+        if is_fleet and num_free > 0:
+            self.fleet_coordinator.on_dispatched(num_dispatched < num_free)
+            if num_dispatched < num_free and self.fleet_coordinator.can_steal():
+                # all the job types are out of jobs of our own, help the other VMs in priority order.
+                stealing_exhausted_job_types = set()
+                for curr_config in strict_job_types + filter(lambda curr_config: curr_config in shared_job_types,
+                                                             all_job_types):
+                    if curr_config[0] in exhausted_job_types:
+                        num_dispatched += self._dispatch_job_type(curr_config, num_free - num_dispatched,
+                                                                  stealing_exhausted_job_types, is_stealing=True)
+        return num_dispatched
+
+    def _handle_completed(self, completed_tasks):
+        """
+            Handle the finished tasks.
+        :param completed_tasks: list of (task id, error)
+        :return: None
+        """
+        for task_id, task_error in completed_tasks:
+            worker_name, job_id, submit_time, _ = self.in_flight.pop(task_id)
+            get_metrics().observe('vm_worker_task_seconds', {'job_type': worker_name}, time.time() - submit_time)
+            if task_id in self.stopping_tasks:
+                self.stopping_tasks.pop(task_id)
+                self._complete_timed_out(worker_name, job_id, time.time() - submit_time)
+            if task_error is None:
+                log_success("Processed " + worker_name + " Job:" + str(job_id))
+                get_metrics().inc('vm_worker_tasks_total', {'job_type': worker_name, 'status': 'success'})
+            else:
+                log_failure("Failed to process " + worker_name + " Job:" + str(job_id) + ", Error:" + str(task_error))
+                get_metrics().inc('vm_worker_tasks_total', {'job_type': worker_name, 'status': 'failure'})
+            if self.lease_manager is not None:
+                # results might still be buffered in the worker.
+                self.unflushed_tasks[task_id] = (worker_name, job_id, task_error)
+
+    def _handle_flushed(self, flushed_tasks):
+        """
+            Release the leases of the finished tasks, whose results are written.
+        :param flushed_tasks: list of (task id, should retry)
+        :return: None
+        """
+        for task_id, should_retry in flushed_tasks:
+            if task_id not in self.unflushed_tasks:
+                continue
+            worker_name, job_id, task_error = self.unflushed_tasks.pop(task_id)
+            # jobs of failed tasks or with lost results are run again, unless they completed anyway.
+            self.lease_manager.release(self._get_job_type(worker_name),
+                                       job_id if isinstance(job_id, list) else [job_id],
+                                       should_retry=should_retry or task_error is not None)
+
+    def _wait_completed(self, timeout):
+        """
+            Wait for the tasks to finish and handle the finished tasks and the tasks whose results are written.
+        :param timeout: Maximum time (in seconds) to wait.
+        :return: None
+        """
+        self._handle_completed(self.worker_pool.wait_completed(timeout=timeout))
+        self._handle_flushed(self.worker_pool.drain_flushed_tasks())
+
+    def _stop_overdue_tasks(self):
+        """
+            Stop the workers of the tasks, which are running for longer than the time budget of their jobs.
+            A worker is asked to stop with SIGTERM, so that it writes the results of its earlier jobs,
+            and is killed if it does not stop in time. Killing it is safe, the locks it shares with the
+            other workers are given back by the kernel, its slots and cores once it is reaped, and the
+            launcher kills its cb-tests once the worker is gone.
+        :return: None
+        """
+        for task_id, (worker_name, job_id, _, num_threads) in self.in_flight.items():
+            running_time = self.worker_pool.get_running_time(task_id)
+            if running_time is None:
+                continue
+            if task_id in self.stopping_tasks:
+                if time.time() - self.stopping_tasks[task_id] >= JOB_TERMINATE_GRACE:
+                    log_failure("Killing worker of " + worker_name + " Job:" + str(job_id) + " as it did not stop.")
+                    self.worker_pool.signal_task(task_id, signal.SIGKILL)
+                continue
+            time_limit = get_task_time_limit(worker_name, len(job_id) if isinstance(job_id, list) else 1, num_threads)
+            if time_limit is None or running_time < time_limit:
+                continue
+            log_failure("Stopping worker of " + worker_name + " Job:" + str(job_id) + " as it is running for " +
+                        str(int(running_time)) + " seconds.")
+            if self.worker_pool.signal_task(task_id, signal.SIGTERM):
+                self.stopping_tasks[task_id] = time.time()
+                get_metrics().inc('vm_worker_timeouts_total', {'job_type': worker_name, 'scope': 'job'})
+
+    def _complete_timed_out(self, worker_name, job_id, running_time):
+        """
+            Complete the jobs of a task which was stopped, with a timeout result, so that they are not run again.
+            Jobs which the worker completed before it stopped are left alone.
+        :param worker_name: type of the jobs.
+        :param job_id: job id or list of job ids.
+        :param running_time: Time (in seconds) for which the task ran.
+        :return: None
+        """
+        try:
+            CRSAPIWrapper.complete_timed_out_jobs(self._get_job_type(worker_name),
+                                                  job_id if isinstance(job_id, list) else [job_id],
+                                                  TIMEOUT_ERROR_CODE, TIMEOUT_RESULT,
+                                                  "Stopped after " + str(int(running_time)) + " seconds")
+        except Exception as e:
+            # the jobs are run again, once their leases expire.
+            log_failure("Unable to complete timed out " + worker_name + " Job:" + str(job_id) + ", Error:" + str(e))
+
+    def _wait_for_jobs(self):
+        """
+            Wait for new jobs, after we found none.
+            Waits until new jobs are notified, or for an exponentially increasing time with jitter,
+            so that idle dispatchers seldom query the DB and do not query it all at once.
+        :return: None
+        """
+        max_wait = min(self.poll_time * (2 ** min(self.num_idle_polls, 16)), self.max_poll_time)
+        curr_wait = random.uniform(max_wait / 2.0, max_wait)
+        self.num_idle_polls += 1
+        if self.job_notifier is None:
+            time.sleep(curr_wait)
+        elif self.job_notifier.wait(curr_wait):
+            log_info("Notified of new jobs.")
+            self.num_idle_polls = 0
+
+    def run(self):
+        """
+            Keep dispatching jobs until there are no more jobs or we processed sufficient number of jobs.
+        :return: None
+        """
+        # we poll often, do not reconnect every time.
+        CRSAPIWrapper.set_persistent_connection(True)
+        if self.job_notifier is not None:
+            # before the first query, so that jobs created after it are notified.
+            self.job_notifier.listen()
+        while True:
+            CRSAPIWrapper.open_connection()
+            if self.fleet_coordinator is not None:
+                # even while idle, so that the fleet knows we are alive.
+                self.fleet_coordinator.heartbeat_if_due()
+            if self.lease_manager is not None:
+                self.lease_manager.reclaim_if_due()
+            with job_phase('daemon', 'dispatch'):
+                if self._dispatch(self.max_in_flight - len(self.in_flight)) > 0:
+                    self.num_idle_polls = 0
+            export_metrics()
+            if len(self.in_flight) == 0:
+                if len(self.unflushed_tasks) > 0:
+                    # workers write the results once they are idle, so that the leases are released.
+                    self._wait_completed(self.poll_time)
+                # if we processed sufficient number of jobs? then exit
+                if self.processed_jobs >= self.max_num_jobs:
+                    log_info("Processed:" + str(self.processed_jobs) + ", limit:" + str(self.max_num_jobs) +
+                             ". Exiting.")
+                    break
+                # If this is supposed to take care of only one CS.
+                # exit the loop, so that the worker knows this VM is done.
+                if self.target_cs_id is not None:
+                    break
+                self._wait_for_jobs()
+                continue
+            if len(self.in_flight) < self.max_in_flight and self.processed_jobs < self.max_num_jobs:
+                # we have free slots, look for new jobs again after some time.
+                self._wait_completed(self.poll_time)
+            else:
+                # wake up periodically, to stop tasks which ran out of time.
+                self._wait_completed(max(self.poll_time, 1))
+            self._stop_overdue_tasks()
@@ -0,0 +1,249 @@
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+from peewee import Model, CharField, IntegerField, DateTimeField
+from common_utils.simple_logging import log_info, log_error
+from farnsworth.models import PovTesterJob
+from farnsworth_api_wrapper import _get_table_name
+from fleet import FLEET_NODE_NAME
+from metrics import get_metrics
+
+# Flag to indicate whether claimed jobs are leased, so that jobs of dead workers are run again.
+JOB_LEASES_ENABLED = os.environ.get('VM_WORKER_JOB_LEASES', '1') == '1'
+# Time (in seconds) for which a lease is valid, unless it is renewed.
+LEASE_DURATION = float(os.environ.get('VM_WORKER_LEASE_DURATION', 120))
+# Time (in seconds) between two renewals of the leases held by a VM.
+LEASE_RENEW_INTERVAL = float(os.environ.get('VM_WORKER_LEASE_RENEW_INTERVAL', 30))
+# Time (in seconds) between two checks for expired leases.
+LEASE_RECLAIM_INTERVAL = float(os.environ.get('VM_WORKER_LEASE_RECLAIM_INTERVAL', 30))
+# Number of times a job is run, after which it is completed without running it again.
+MAX_JOB_ATTEMPTS = int(os.environ.get('VM_WORKER_MAX_JOB_ATTEMPTS', 3))
+
+
+class JobLease(Model):
+    """
+    Lease of a claimed job, held by a VM as long as it keeps renewing it.
+    Kept after the lease expires, so that the attempts of the job are counted across claims.
+    """
+    job_type = CharField()
+    job_id = IntegerField()
+    owner = CharField(null=True)
+    expires_at = DateTimeField(null=True, index=True)
+    num_attempts = IntegerField(default=0)
+
+    class Meta:
+        # same database as the jobs.
+        database = PovTesterJob._meta.database
+        indexes = ((('job_type', 'job_id'), True),)
+
+
+class LeaseManager(object):
+    """
+    Leases the jobs claimed by this VM, and renews the leases from a heartbeat
+    thread as long as the jobs are not finished. Jobs whose lease expired (the VM
+    or the worker died) are returned to the unstarted jobs by any VM of the fleet.
+    Jobs which were run too many times without finishing are completed.
+    """
+
+    def __init__(self, all_job_types, owner_name, lease_duration=LEASE_DURATION,
+                 renew_interval=LEASE_RENEW_INTERVAL, reclaim_interval=LEASE_RECLAIM_INTERVAL,
+                 max_attempts=MAX_JOB_ATTEMPTS):
+        """
+            Create a lease manager.
+        :param all_job_types: list of Job model classes, whose jobs are leased.
+        :param owner_name: name of the holder of the leases, unique across the fleet.
+        :param lease_duration: Time (in seconds) for which a lease is valid, unless it is renewed.
+        :param renew_interval: Time (in seconds) between two renewals.
+        :param reclaim_interval: Time (in seconds) between two checks for expired leases.
+        :param max_attempts: Number of times a job is run, after which it is not run again.
+        :return: None
+        """
+        self.all_job_types = all_job_types
+        self.owner_name = owner_name
+        self.lease_duration = lease_duration
+        self.renew_interval = renew_interval
+        self.reclaim_interval = reclaim_interval
+        self.max_attempts = max_attempts
+        # Job model class -> set of ids of jobs leased by us, shared with the heartbeat thread.
+        self.held_leases = {}
+        self.leases_lock = threading.Lock()
+        self.last_reclaim_time = None
+        self.heartbeat_thread = None
+        self.stop_event = threading.Event()
+
+    def _get_expiry(self):
+        """
+            Get expiry time of a lease taken or renewed now.
+        """
+        return datetime.now() + timedelta(seconds=self.lease_duration)
+
+    def start(self):
+        """
+            Create the lease table, if needed, and start renewing leases.
+        :return: None
+        """
+        JobLease.create_table(True)
+        self.heartbeat_thread = threading.Thread(target=self._heartbeat_main, name='lease-heartbeat')
+        self.heartbeat_thread.daemon = True
+        self.heartbeat_thread.start()
+        log_info("Leasing jobs as:" + self.owner_name + " for " + str(self.lease_duration) + " seconds.")
+
+    def stop(self):
+        """
+            Stop renewing leases.
+        :return: None
+        """
+        self.stop_event.set()
+        if self.heartbeat_thread is not None:
+            self.heartbeat_thread.join()
+            self.heartbeat_thread = None
+
+    def acquire(self, job_type, job_ids):
+        """
+            Lease the provided jobs, which we just claimed.
+        :param job_type: Job model class.
+        :param job_ids: list of job ids.
+        :return: None
+        """
+        if len(job_ids) == 0:
+            return
+        table_name = _get_table_name(job_type)
+        curr_expiry = self._get_expiry()
+        JobLease.update(owner=self.owner_name, expires_at=curr_expiry, num_attempts=JobLease.num_attempts + 1) \
+                .where((JobLease.job_type == table_name) & (JobLease.job_id << job_ids)).execute()
+        leased_ids = set(map(lambda curr_row: curr_row[0],
+                             JobLease.select(JobLease.job_id).where((JobLease.job_type == table_name) &
+                                                                    (JobLease.job_id << job_ids)).tuples()))
+        new_leases = map(lambda curr_job_id: {'job_type': table_name, 'job_id': curr_job_id, 'owner': self.owner_name,
+                                              'expires_at': curr_expiry, 'num_attempts': 1},
+                         filter(lambda curr_job_id: curr_job_id not in leased_ids, job_ids))
+        if len(new_leases) > 0:
+            JobLease.insert_many(new_leases).execute()
+        with self.leases_lock:
+            self.held_leases.setdefault(job_type, set()).update(job_ids)
+
+    def release(self, job_type, job_ids, should_retry=False):
+        """
+            Give up the leases of the provided jobs, as they are finished.
+        :param job_type: Job model class.
+        :param job_ids: list of job ids.
+        :param should_retry: flag to indicate that the jobs failed and should be run again, if they are not completed.
+        :return: None
+        """
+        with self.leases_lock:
+            self.held_leases.get(job_type, set()).difference_update(job_ids)
+        if len(job_ids) == 0:
+            return
+        lease_query = JobLease.update(owner=None, expires_at=None)
+        if should_retry:
+            # expire right away, the reclaim either runs them again or gives up on them.
+            lease_query = JobLease.update(expires_at=datetime.now() - timedelta(seconds=1))
+        lease_query.where((JobLease.job_type == _get_table_name(job_type)) & (JobLease.job_id << job_ids) &
+                          (JobLease.owner == self.owner_name)).execute()
+        if should_retry:
+            self.last_reclaim_time = None
+
+    def cancel(self, job_type, job_ids):
+        """
+            Give up the leases of the provided jobs, which we claimed but will not run.
+            The claim does not count as an attempt of the jobs.
+        :param job_type: Job model class.
+        :param job_ids: list of job ids.
+        :return: None
+        """
+        with self.leases_lock:
+            self.held_leases.get(job_type, set()).difference_update(job_ids)
+        if len(job_ids) == 0:
+            return
+        JobLease.update(owner=None, expires_at=None, num_attempts=JobLease.num_attempts - 1) \
+                .where((JobLease.job_type == _get_table_name(job_type)) & (JobLease.job_id << job_ids) &
+                       (JobLease.owner == self.owner_name)).execute()
+
+    def renew(self):
+        """
+            Extend the leases of all the jobs we hold.
+        :return: None
+        """
+        with self.leases_lock:
+            all_leases = map(lambda curr_item: (curr_item[0], list(curr_item[1])), self.held_leases.items())
+        curr_expiry = self._get_expiry()
+        for job_type, job_ids in all_leases:
+            if len(job_ids) == 0:
+                continue
+            JobLease.update(expires_at=curr_expiry) \
+                    .where((JobLease.job_type == _get_table_name(job_type)) & (JobLease.job_id << job_ids) &
+                           (JobLease.owner == self.owner_name)).execute()
+
+    def _heartbeat_main(self):
+        """
+            Main loop of the heartbeat thread.
+        :return: None
+        """
+        while not self.stop_event.wait(self.renew_interval):
+            try:
+                self.renew()
+            except Exception as e:
+                log_error("Error occurred while renewing job leases:" + str(e))
+
+    def reclaim(self):
+        """
+            Return the jobs with expired leases to the unstarted jobs, or complete them if they were tried enough.
+        :return: Number of jobs, which will be run again.
+        """
+        self.last_reclaim_time = time.time()
+        num_reclaimed = 0
+        curr_time = datetime.now()
+        for job_type in self.all_job_types:
+            table_name = _get_table_name(job_type)
+            # fetched up front, so that no cursor is open while we update.
+            expired_leases = list(JobLease.select().where((JobLease.job_type == table_name) &
+                                                          (JobLease.expires_at < curr_time)))
+            for curr_lease in expired_leases:
+                # only one VM gets to reclaim a lease.
+                num_updated = JobLease.update(owner=None, expires_at=None) \
+                                      .where((JobLease.id == curr_lease.id) & (JobLease.expires_at < curr_time)) \
+                                      .execute()
+                if num_updated == 0:
+                    continue
+                unfinished_query = job_type.update(started_at=None)
+                if curr_lease.num_attempts >= self.max_attempts:
+                    unfinished_query = job_type.update(completed_at=curr_time)
+                num_updated = unfinished_query.where((job_type.id == curr_lease.job_id) &
+                                                     (job_type.completed_at.is_null(True))).execute()
+                if num_updated == 0:
+                    # finished, after all.
+                    continue
+                if curr_lease.num_attempts >= self.max_attempts:
+                    log_error("Giving up on " + table_name + " Job:" + str(curr_lease.job_id) + " after " +
+                              str(curr_lease.num_attempts) + " attempts.")
+                    get_metrics().inc('vm_worker_jobs_poisoned_total', {'job_type': table_name})
+                else:
+                    log_info("Reclaimed " + table_name + " Job:" + str(curr_lease.job_id) + " held by:" +
+                             str(curr_lease.owner) + ", it will be run again.")
+                    get_metrics().inc('vm_worker_jobs_reclaimed_total', {'job_type': table_name})
+                    num_reclaimed += 1
+        return num_reclaimed
+
+    def reclaim_if_due(self):
+        """
+            Reclaim the jobs with expired leases, if we did not check for a while.
+        :return: Number of jobs, which will be run again.
+        """
+        if self.last_reclaim_time is None or time.time() - self.last_reclaim_time >= self.reclaim_interval:
+            try:
+                return self.reclaim()
+            except Exception as e:
+                log_error("Error occurred while reclaiming jobs with expired leases:" + str(e))
+        return 0
+
+
+def get_lease_manager(all_job_types):
+    """
+        Get the lease manager of this VM, if leases are enabled.
+    :param all_job_types: list of Job model classes.
+    :return: LeaseManager or None.
+    """
+    if not JOB_LEASES_ENABLED:
+        return None
+    return LeaseManager(all_job_types, FLEET_NODE_NAME + ':' + str(os.getpid()))
@@ -0,0 +1,248 @@
+from common_utils.simple_logging import log_info, log_error
+from farnsworth_api_wrapper import _get_table_name
+from peewee import PostgresqlDatabase
+import errno
+import fcntl
+import os
+import select
+import time
+
+# Flag to indicate whether the dispatcher should wait for job notifications, instead of only polling.
+JOB_NOTIFY_ENABLED = os.environ.get('VM_WORKER_JOB_NOTIFY', '1') == '1'
+# Postgres channel on which new jobs are notified.
+JOB_NOTIFY_CHANNEL = os.environ.get('VM_WORKER_JOB_NOTIFY_CHANNEL', 'vm_worker_jobs')
+# Flag to indicate whether the daemon should create the triggers, which notify new jobs.
+# Without them nothing is notified, so postgres is only polled for new jobs.
+INSTALL_JOB_TRIGGERS = os.environ.get('VM_WORKER_INSTALL_JOB_TRIGGERS', '1' if JOB_NOTIFY_ENABLED else '0') == '1'
+
+# Name of the trigger (and its function), which notifies new jobs.
+JOB_TRIGGER_NAME = 'vm_worker_notify_job'
+
+# LocalJobNotifiers of this process, notified by notify_new_jobs.
+_local_notifiers = []
+
+
+def _get_connect_params(target_db):
+    """
+        Get connection parameters of the provided database, other than its name.
+    :param target_db: peewee database.
+    :return: dict of parameter name -> value
+    """
+    # peewee 3 calls them connect_params, peewee 2 connect_kwargs.
+    return dict(getattr(target_db, 'connect_params', None) or getattr(target_db, 'connect_kwargs', None) or {})
+
+
+class PostgresJobNotifier(object):
+    """
+    Waits for new jobs using postgres LISTEN/NOTIFY.
+    Listens on its own connection, so that notifications are received even while
+    the dispatcher is busy, and are never lost between a query and the next wait.
+    """
+
+    def __init__(self, target_db, channel_name):
+        """
+            Create a notifier.
+        :param target_db: peewee PostgresqlDatabase of the jobs.
+        :param channel_name: channel on which new jobs are notified.
+        :return: None
+        """
+        self.target_db = target_db
+        self.channel_name = channel_name
+        self.listen_conn = None
+
+    def listen(self):
+        """
+            Start listening for notifications, if we are not already listening.
+        :return: True if we are listening else False.
+        """
+        if self.listen_conn is not None:
+            return True
+        try:
+            import psycopg2
+            import psycopg2.extensions
+            self.listen_conn = psycopg2.connect(database=self.target_db.database,
+                                                **_get_connect_params(self.target_db))
+            self.listen_conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+            self.listen_conn.cursor().execute('LISTEN "' + self.channel_name + '"')
+            log_info("Listening for new jobs on channel:" + self.channel_name)
+            return True
+        except Exception as e:
+            log_error("Unable to listen for new jobs, falling back to polling. Error:" + str(e))
+            self.close()
+        return False
+
+    def wait(self, timeout):
+        """
+            Wait until new jobs are notified or the timeout expires.
+        :param timeout: maximum time (in seconds) to wait.
+        :return: True if new jobs were notified else False.
+        """
+        if not self.listen():
+            time.sleep(timeout)
+            return False
+        try:
+            if len(self.listen_conn.notifies) == 0:
+                if select.select([self.listen_conn], [], [], timeout) == ([], [], []):
+                    return False
+                self.listen_conn.poll()
+            is_notified = len(self.listen_conn.notifies) > 0
+            del self.listen_conn.notifies[:]
+            return is_notified
+        except select.error as e:
+            if e.args[0] == errno.EINTR:
+                return False
+            log_error("Error occurred while waiting for new jobs:" + str(e))
+        except Exception as e:
+            log_error("Error occurred while waiting for new jobs:" + str(e))
+        # reconnect on the next wait.
+        self.close()
+        return False
+
+    def close(self):
+        """
+            Stop listening.
+        :return: None
+        """
+        if self.listen_conn is not None:
+            try:
+                self.listen_conn.close()
+            except Exception:
+                pass
+            self.listen_conn = None
+
+
+class LocalJobNotifier(object):
+    """
+    Stand-in for PostgresJobNotifier on databases without notifications (for ex: sqlite in tests).
+    Jobs are notified by calling notify (or notify_new_jobs), from this process or any process forked after
+    the notifier is created.
+    """
+
+    def __init__(self):
+        """
+            Create a notifier.
+        :return: None
+        """
+        self.read_fd, self.write_fd = os.pipe()
+        # a full pipe already means new jobs, notify should never wait for the waiter to drain it.
+        fcntl.fcntl(self.write_fd, fcntl.F_SETFL, fcntl.fcntl(self.write_fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+        _local_notifiers.append(self)
+
+    def listen(self):
+        """
+            Start listening for notifications, we always are.
+        :return: True
+        """
+        return True
+
+    def notify(self):
+        """
+            Notify that new jobs are available.
+        :return: None
+        """
+        try:
+            os.write(self.write_fd, 'j')
+        except OSError as e:
+            # pipe is full, the waiter is notified already.
+            if e.errno != errno.EAGAIN:
+                log_error("Unable to notify new jobs:" + str(e))
+
+    def wait(self, timeout):
+        """
+            Wait until new jobs are notified or the timeout expires.
+        :param timeout: maximum time (in seconds) to wait.
+        :return: True if new jobs were notified else False.
+        """
+        try:
+            if select.select([self.read_fd], [], [], timeout) == ([], [], []):
+                return False
+        except select.error as e:
+            if e.args[0] == errno.EINTR:
+                return False
+            raise
+        # any number of notifications mean the same, drop them all.
+        os.read(self.read_fd, 4096)
+        return True
+
+    def close(self):
+        """
+            Stop listening.
+        :return: None
+        """
+        if self in _local_notifiers:
+            _local_notifiers.remove(self)
+        for curr_fd in [self.read_fd, self.write_fd]:
+            try:
+                os.close(curr_fd)
+            except OSError:
+                pass
+
+
+def notify_new_jobs():
+    """
+        Notify the LocalJobNotifiers of this process, that new jobs are available.
+        Stands in for the job triggers on databases without notifications.
+    :return: None
+    """
+    for curr_notifier in list(_local_notifiers):
+        curr_notifier.notify()
+
+
+def install_job_triggers(all_job_types, channel_name=JOB_NOTIFY_CHANNEL):
+    """
+        Create triggers, which notify the provided channel whenever jobs are inserted.
+        Statement level triggers, so that inserting many jobs at once sends one notification.
+    :param all_job_types: list of Job model classes.
+    :param channel_name: channel on which new jobs are notified.
+    :return: True if the triggers are installed else False.
+    """
+    target_db = all_job_types[0]._meta.database
+    if not isinstance(target_db, PostgresqlDatabase):
+        log_info("Not installing job triggers, database does not support notifications.")
+        return False
+    try:
+        _create_job_triggers(target_db, all_job_types, channel_name)
+    except Exception as e:
+        log_error("Unable to install job triggers, polling for new jobs. Error:" + str(e))
+        return False
+    log_info("Installed triggers to notify new jobs on channel:" + channel_name)
+    return True
+
+
+def _create_job_triggers(target_db, all_job_types, channel_name):
+    """
+        Create the triggers, which notify the provided channel whenever jobs are inserted.
+    :param target_db: peewee PostgresqlDatabase of the jobs.
+    :param all_job_types: list of Job model classes.
+    :param channel_name: channel on which new jobs are notified.
+    :return: None
+    """
+    with target_db.atomic():
+        target_db.execute_sql('CREATE OR REPLACE FUNCTION ' + JOB_TRIGGER_NAME + '() RETURNS trigger AS $$ '
+                              'BEGIN PERFORM pg_notify(\'' + channel_name + '\', TG_TABLE_NAME); RETURN NULL; END; '
+                              '$$ LANGUAGE plpgsql')
+        for job_type in all_job_types:
+            table_name = _get_table_name(job_type)
+            target_db.execute_sql('DROP TRIGGER IF EXISTS ' + JOB_TRIGGER_NAME + ' ON "' + table_name + '"')
+            target_db.execute_sql('CREATE TRIGGER ' + JOB_TRIGGER_NAME + ' AFTER INSERT ON "' + table_name +
+                                  '" FOR EACH STATEMENT EXECUTE PROCEDURE ' + JOB_TRIGGER_NAME + '()')
+
+
+def get_job_notifier(all_job_types, has_job_triggers=False):
+    """
+        Get a notifier of new jobs of the provided types.
+        Databases without notifications get a LocalJobNotifier, which is woken up by notify_new_jobs.
+    :param all_job_types: list of Job model classes.
+    :param has_job_triggers: flag to indicate whether the triggers notifying new jobs are installed.
+    :return: PostgresJobNotifier, LocalJobNotifier or None, if the jobs should only be polled.
+    """
+    if not JOB_NOTIFY_ENABLED:
+        return None
+    target_db = all_job_types[0]._meta.database
+    if not isinstance(target_db, PostgresqlDatabase):
+        return LocalJobNotifier()
+    if not has_job_triggers:
+        # listening would only make us wait longer, as nothing is notified.
+        log_info("No triggers to notify new jobs, polling for new jobs.")
+        return None
+    return PostgresJobNotifier(target_db, JOB_NOTIFY_CHANNEL)
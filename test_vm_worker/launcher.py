@@ -0,0 +1,559 @@
+import cPickle
+import errno
+import functools
+import os
+import select
+import shutil
+import signal
+import socket
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import types
+# other modules of the worker are imported where they are used,
+# this module is also run as the launcher, which should stay small.
+
+# Flag to indicate whether cb-test should be started by a launcher process, instead of by the worker itself.
+USE_LAUNCHER = os.environ.get('VM_WORKER_USE_LAUNCHER', '1') == '1'
+# Modules, whose subprocess.Popen is replaced with the launcher.
+LAUNCHER_MODULES = ['common_utils.binary_tester', 'common_utils.poll_sanitizer']
+# Time (in seconds) to wait for the launcher to start listening.
+LAUNCHER_START_TIMEOUT = 10
+# Time (in seconds) between two checks of whether the worker of the launcher is still alive.
+LAUNCHER_CHECK_INTERVAL = 1
+
+# Popen arguments, which can be forwarded to the launcher. Anything else is run by the worker itself.
+_SUPPORTED_ARGS = {'bufsize', 'stdin', 'stdout', 'stderr', 'shell', 'cwd', 'env', 'close_fds',
+                   'universal_newlines'}
+
+
+def _send_msg(target_sock, curr_msg):
+    """
+        Send a message over a stream socket.
+    :param target_sock: socket.
+    :param curr_msg: picklable object.
+    :return: None
+    """
+    msg_data = cPickle.dumps(curr_msg, cPickle.HIGHEST_PROTOCOL)
+    target_sock.sendall(struct.pack('!I', len(msg_data)) + msg_data)
+
+
+def _recv_exact(target_sock, num_bytes):
+    """
+        Receive exactly the provided number of bytes from a stream socket.
+    """
+    all_chunks = []
+    while num_bytes > 0:
+        curr_chunk = target_sock.recv(min(num_bytes, 1 << 20))
+        if len(curr_chunk) == 0:
+            raise EOFError("Launcher connection closed")
+        all_chunks.append(curr_chunk)
+        num_bytes -= len(curr_chunk)
+    return ''.join(all_chunks)
+
+
+def _recv_msg(target_sock):
+    """
+        Receive a message sent by _send_msg.
+    :param target_sock: socket.
+    :return: the object.
+    """
+    msg_len = struct.unpack('!I', _recv_exact(target_sock, 4))[0]
+    return cPickle.loads(_recv_exact(target_sock, msg_len))
+
+
+class _ProcessWatchdog(threading.Thread):
+    """
+    Kills the process group of a started process, once its timeout expires or its client goes away.
+    """
+
+    def __init__(self, client_sock, process_pid, timeout):
+        """
+            Create a watchdog.
+        :param client_sock: connection to the client, it is closed if the client dies.
+        :param process_pid: pid of the process, which leads its own process group.
+        :param timeout: Time (in seconds) after which the process is killed, None for no limit.
+        :return: None
+        """
+        threading.Thread.__init__(self, name='watchdog')
+        self.daemon = True
+        self.client_sock = client_sock
+        self.process_pid = process_pid
+        self.timeout = timeout
+        self.finished_event = threading.Event()
+        self.is_timed_out = False
+
+    def run(self):
+        """
+            Wait for the timeout or the client to go away, and kill the process group.
+        :return: None
+        """
+        try:
+            # the client sends nothing more, the connection gets readable only if it is closed.
+            is_client_gone = len(select.select([self.client_sock], [], [], self.timeout)[0]) > 0
+        except select.error:
+            return
+        if self.finished_event.is_set():
+            return
+        self.is_timed_out = not is_client_gone
+        try:
+            # cb-test starts the binaries and the replay processes, they all go.
+            os.killpg(self.process_pid, signal.SIGKILL)
+        except OSError:
+            # exited already.
+            pass
+
+    def stop(self):
+        """
+            Tell the watchdog that the process exited.
+        :return: None
+        """
+        self.finished_event.set()
+
+
+def _handle_launch(client_sock):
+    """
+        Run one process for a client of the launcher, in a process forked from the launcher.
+        Sends ('started', pid) once the process is started, and ('done', return code, stdout, stderr, is timed out)
+        once it exits.
+    :param client_sock: connection to the client.
+    :return: None
+    """
+    launch_request = _recv_msg(client_sock)
+    try:
+        if launch_request['affinity'] is not None:
+            from cpu_affinity import set_thread_affinity
+            # inherited by the process we start.
+            set_thread_affinity(launch_request['affinity'])
+        popen_kwargs = launch_request['kwargs']
+        stdin_data = launch_request['stdin_data']
+        if stdin_data is not None:
+            popen_kwargs['stdin'] = subprocess.PIPE
+        # in its own process group, so that it can be killed along with its children.
+        popen_kwargs['preexec_fn'] = os.setsid
+        target_process = subprocess.Popen(launch_request['args'], **popen_kwargs)
+    except Exception as e:
+        _send_msg(client_sock, ('error', getattr(e, 'errno', None) or 0, str(e)))
+        return
+    _send_msg(client_sock, ('started', target_process.pid))
+    process_watchdog = _ProcessWatchdog(client_sock, target_process.pid, launch_request['timeout'])
+    process_watchdog.start()
+    stdout_data, stderr_data = target_process.communicate(stdin_data)
+    process_watchdog.stop()
+    _send_msg(client_sock, ('done', target_process.returncode, stdout_data, stderr_data,
+                            process_watchdog.is_timed_out))
+
+
+def _launcher_main(socket_path, worker_pid):
+    """
+        Main loop of the launcher process.
+        Every request is handled in a process forked from the launcher, which is small and single threaded,
+        so forking it is cheap. Exits when its worker exits.
+    :param socket_path: path of the unix socket to listen on.
+    :param worker_pid: pid of the worker, which started the launcher.
+    :return: None
+    """
+    # handler processes are reaped by the kernel.
+    signal.signal(signal.SIGCHLD, signal.SIG_IGN)
+    # interrupts are for the daemon, we exit along with our worker.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    server_sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server_sock.bind(socket_path)
+    server_sock.listen(128)
+    server_sock.settimeout(LAUNCHER_CHECK_INTERVAL)
+    try:
+        while os.getppid() == worker_pid:
+            try:
+                client_sock, _ = server_sock.accept()
+            except socket.timeout:
+                continue
+            except socket.error as e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+            if os.fork() == 0:
+                exit_code = 0
+                try:
+                    server_sock.close()
+                    # started processes should not inherit our signal dispositions.
+                    signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+                    signal.signal(signal.SIGINT, signal.SIG_DFL)
+                    client_sock.settimeout(None)
+                    _handle_launch(client_sock)
+                except Exception:
+                    exit_code = 1
+                finally:
+                    os._exit(exit_code)
+            client_sock.close()
+    finally:
+        shutil.rmtree(os.path.dirname(socket_path), ignore_errors=True)
+
+
+class LauncherPopen(object):
+    """
+    subprocess.Popen lookalike, whose process is started by the launcher.
+    Supports the parts of Popen used to run cb-test: communicate, wait, poll, kill and terminate.
+    The CPU affinity of the calling thread is applied to the started process, and the process
+    is killed along with its children, if it runs longer than the time budget of the job.
+    """
+
+    def __init__(self, socket_path, args, popen_kwargs):
+        """
+            Start a process through the launcher.
+        :param socket_path: path of the unix socket of the launcher.
+        :param args: args of the process, as for Popen.
+        :param popen_kwargs: keyword args, as for Popen.
+        :return: None
+        """
+        from cpu_affinity import get_thread_affinity
+        self.args = args
+        self.returncode = None
+        self.stdin = None
+        self.capture_stdout = popen_kwargs.get('stdout') == subprocess.PIPE
+        self.capture_stderr = popen_kwargs.get('stderr') == subprocess.PIPE
+        self.stdout_data = None
+        self.stderr_data = None
+        self.is_timed_out = False
+        self.launcher_sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.launcher_sock.connect(socket_path)
+        if popen_kwargs.get('env') is None:
+            # environment of the worker might have changed since the launcher started.
+            popen_kwargs['env'] = dict(os.environ)
+        if popen_kwargs.get('cwd') is None:
+            popen_kwargs['cwd'] = os.getcwd()
+        # input is sent with communicate.
+        is_stdin_pipe = popen_kwargs.pop('stdin', None) == subprocess.PIPE
+        self.launch_request = {'args': args, 'kwargs': popen_kwargs, 'affinity': get_thread_affinity(),
+                               'stdin_data': None, 'timeout': None}
+        if is_stdin_pipe:
+            # the process is started once we get the input.
+            self.pid = None
+            return
+        self._start()
+
+    def _start(self):
+        """
+            Send the launch request and wait for the process to start.
+        :return: None
+        """
+        from time_budget import get_throw_timeout
+        # the time left for the job is known only when the process is started.
+        self.launch_request['timeout'] = get_throw_timeout()
+        _send_msg(self.launcher_sock, self.launch_request)
+        curr_reply = _recv_msg(self.launcher_sock)
+        if curr_reply[0] == 'error':
+            self.launcher_sock.close()
+            raise OSError(curr_reply[1], curr_reply[2])
+        self.pid = curr_reply[1]
+
+    def communicate(self, input=None):
+        """
+            Wait for the process to exit.
+        :param input: data to be sent to the stdin of the process.
+        :return: (stdout, stderr)
+        """
+        if self.pid is None:
+            self.launch_request['stdin_data'] = input or ''
+            self._start()
+        if self.returncode is None:
+            try:
+                curr_reply = _recv_msg(self.launcher_sock)
+                self.returncode, self.stdout_data, self.stderr_data, self.is_timed_out = curr_reply[1:]
+            finally:
+                self.launcher_sock.close()
+            if self.is_timed_out:
+                from common_utils.simple_logging import log_failure
+                from time_budget import on_throw_timeout
+                log_failure("Killed:" + str(self.args) + " as it ran out of time.")
+                on_throw_timeout()
+        return (self.stdout_data if self.capture_stdout else None,
+                self.stderr_data if self.capture_stderr else None)
+
+    def wait(self):
+        """
+            Wait for the process to exit.
+        :return: return code.
+        """
+        self.communicate()
+        return self.returncode
+
+    def poll(self):
+        """
+            Check if the process exited, without waiting.
+        :return: return code or None if it is still running.
+        """
+        if self.returncode is None and self.pid is not None:
+            self.launcher_sock.settimeout(0)
+            try:
+                self.launcher_sock.recv(1, socket.MSG_PEEK)
+            except socket.error:
+                # nothing to read, still running.
+                return None
+            finally:
+                self.launcher_sock.settimeout(None)
+            self.communicate()
+        return self.returncode
+
+    def send_signal(self, signum):
+        """
+            Send a signal to the process, if it is still running.
+        :param signum: signal number.
+        :return: None
+        """
+        if self.pid is not None and self.returncode is None:
+            try:
+                os.kill(self.pid, signum)
+            except OSError as e:
+                if e.errno != errno.ESRCH:
+                    raise
+
+    def terminate(self):
+        """
+            Terminate the process.
+        """
+        self.send_signal(signal.SIGTERM)
+
+    def kill(self):
+        """
+            Kill the process.
+        """
+        self.send_signal(signal.SIGKILL)
+
+
+def _start_process_group(preexec_fn):
+    """
+        Run in the started process before exec, puts it in its own process group.
+    :param preexec_fn: function to be called afterwards, as asked by the caller of Popen, or None.
+    :return: None
+    """
+    os.setsid()
+    if preexec_fn is not None:
+        preexec_fn()
+
+
+class DeadlinePopen(subprocess.Popen):
+    """
+    subprocess.Popen, used when the launcher can not start the process.
+    Like a process started by the launcher, the process is killed along with its
+    children, if it runs longer than the time budget of the job.
+    """
+
+    def __init__(self, args, timeout, **popen_kwargs):
+        """
+            Start a process.
+        :param args: args of the process, as for Popen.
+        :param timeout: Time (in seconds) after which the process is killed.
+        :param popen_kwargs: keyword args, as for Popen.
+        :return: None
+        """
+        self.args = args
+        self.is_timed_out = False
+        self.is_finished = False
+        # in its own process group, so that it can be killed along with its children.
+        popen_kwargs['preexec_fn'] = functools.partial(_start_process_group, popen_kwargs.get('preexec_fn'))
+        subprocess.Popen.__init__(self, args, **popen_kwargs)
+        self.kill_timer = threading.Timer(timeout, self._kill_group)
+        self.kill_timer.daemon = True
+        self.kill_timer.start()
+
+    def _kill_group(self):
+        """
+            Kill the process along with its children, as it ran out of time.
+        :return: None
+        """
+        # not reaped yet, so the pid is still ours.
+        if self.returncode is not None:
+            return
+        self.is_timed_out = True
+        try:
+            os.killpg(self.pid, signal.SIGKILL)
+        except OSError:
+            # exited already.
+            pass
+
+    def _on_exit(self):
+        """
+            Stop the timer once the process exited, and account for the run if it ran out of time.
+        :return: None
+        """
+        if self.returncode is None or self.is_finished:
+            return
+        self.is_finished = True
+        self.kill_timer.cancel()
+        if self.is_timed_out:
+            from common_utils.simple_logging import log_failure
+            from time_budget import on_throw_timeout
+            log_failure("Killed:" + str(self.args) + " as it ran out of time.")
+            on_throw_timeout()
+
+    def wait(self):
+        """
+            Wait for the process to exit.
+        :return: return code.
+        """
+        try:
+            return subprocess.Popen.wait(self)
+        finally:
+            self._on_exit()
+
+    def poll(self):
+        """
+            Check if the process exited, without waiting.
+        :return: return code or None if it is still running.
+        """
+        try:
+            return subprocess.Popen.poll(self)
+        finally:
+            self._on_exit()
+
+
+def popen_with_deadline(args, **popen_kwargs):
+    """
+        Start a process in the worker itself, killed along with its children once the time budget of the job runs out.
+    :param args: args of the process, as for subprocess.Popen
+    :param popen_kwargs: keyword args, as for subprocess.Popen
+    :return: DeadlinePopen or subprocess.Popen if there is no time limit.
+    """
+    from time_budget import get_throw_timeout
+    curr_timeout = get_throw_timeout()
+    if curr_timeout is None:
+        return subprocess.Popen(args, **popen_kwargs)
+    return DeadlinePopen(args, curr_timeout, **popen_kwargs)
+
+
+class ProcessLauncher(object):
+    """
+    Launcher of the processes (cb-test) started by a worker.
+    Forking a large worker with many threads, for every cb-test run, copies its
+    page tables every time. Instead, the worker starts a small launcher process
+    once, which forks and starts the processes for it.
+    """
+
+    def __init__(self):
+        """
+            Create a launcher, it is started with start.
+        :return: None
+        """
+        self.socket_dir = None
+        self.socket_path = None
+        self.launcher_process = None
+        self.owner_pid = None
+
+    def is_running(self):
+        """
+            Check if the launcher is usable from the current process.
+        :return: True/False
+        """
+        return self.launcher_process is not None and self.owner_pid == os.getpid() and \
+            self.launcher_process.poll() is None
+
+    def start(self):
+        """
+            Start the launcher process.
+        :return: True if the launcher is running else False.
+        """
+        from common_utils.simple_logging import log_info, log_error
+        self.socket_dir = tempfile.mkdtemp(prefix='vm_worker_launcher_')
+        self.socket_path = os.path.join(self.socket_dir, 'launcher.sock')
+        self.owner_pid = os.getpid()
+        launcher_script = os.path.abspath(__file__)
+        if launcher_script.endswith('.pyc'):
+            launcher_script = launcher_script[:-1]
+        # a fresh interpreter, with nothing but this module.
+        self.launcher_process = subprocess.Popen([sys.executable, launcher_script, self.socket_path,
+                                                  str(self.owner_pid)], close_fds=True)
+        start_time = time.time()
+        while not os.path.exists(self.socket_path):
+            if self.launcher_process.poll() is not None or time.time() - start_time > LAUNCHER_START_TIMEOUT:
+                log_error("Unable to start launcher, processes will be started by the worker.")
+                self.stop()
+                return False
+            time.sleep(0.01)
+        log_info("Started launcher:" + str(self.launcher_process.pid) + " for worker:" + str(self.owner_pid))
+        return True
+
+    def popen(self, args, **popen_kwargs):
+        """
+            Start a process, through the launcher if possible.
+        :param args: args of the process, as for subprocess.Popen
+        :param popen_kwargs: keyword args, as for subprocess.Popen
+        :return: LauncherPopen, DeadlinePopen or subprocess.Popen
+        """
+        if not self.is_running() or not set(popen_kwargs.keys()).issubset(_SUPPORTED_ARGS) or \
+                popen_kwargs.get('stdin') not in (None, subprocess.PIPE) or \
+                popen_kwargs.get('stdout') not in (None, subprocess.PIPE) or \
+                popen_kwargs.get('stderr') not in (None, subprocess.PIPE, subprocess.STDOUT):
+            return popen_with_deadline(args, **popen_kwargs)
+        try:
+            return LauncherPopen(self.socket_path, args, dict(popen_kwargs))
+        except socket.error:
+            # launcher died, do it ourselves.
+            return popen_with_deadline(args, **popen_kwargs)
+
+    def stop(self):
+        """
+            Stop the launcher process.
+        :return: None
+        """
+        if self.launcher_process is not None and self.owner_pid == os.getpid():
+            if self.launcher_process.poll() is None:
+                self.launcher_process.kill()
+            self.launcher_process.wait()
+        self.launcher_process = None
+        if self.socket_dir is not None:
+            shutil.rmtree(self.socket_dir, ignore_errors=True)
+            self.socket_dir = None
+
+
+_process_launcher = ProcessLauncher()
+
+
+def _get_subprocess_proxy():
+    """
+        Get a module like subprocess, whose Popen starts processes through the launcher.
+    :return: module
+    """
+    subprocess_proxy = types.ModuleType('subprocess')
+    subprocess_proxy.__dict__.update(subprocess.__dict__)
+    subprocess_proxy.Popen = _process_launcher.popen
+    return subprocess_proxy
+
+
+def init_worker_launcher():
+    """
+        Start the launcher of the current worker, and make LAUNCHER_MODULES use it.
+        Without the launcher, LAUNCHER_MODULES start the processes themselves, which are still killed once they
+        run out of time.
+        Should be called once in each worker, when it starts.
+    :return: None
+    """
+    if USE_LAUNCHER:
+        _process_launcher.start()
+    subprocess_proxy = _get_subprocess_proxy()
+    for module_name in LAUNCHER_MODULES:
+        target_module = sys.modules.get(module_name)
+        if target_module is None:
+            try:
+                target_module = __import__(module_name, fromlist=['*'])
+            except ImportError:
+                continue
+        if getattr(target_module, 'subprocess', None) is subprocess:
+            target_module.subprocess = subprocess_proxy
+        if getattr(target_module, 'Popen', None) is subprocess.Popen:
+            target_module.Popen = _process_launcher.popen
+
+
+def stop_worker_launcher():
+    """
+        Stop the launcher of the current worker, if any.
+    :return: None
+    """
+    _process_launcher.stop()
+
+
+if __name__ == "__main__":
+    # Command line arguments: launcher.py <socket path> <worker pid>
+    _launcher_main(sys.argv[1], int(sys.argv[2]))
@@ -0,0 +1,279 @@
+import json
+import os
+import tempfile
+import time
+from common_utils.simple_logging import log_error
+
+# File to which the metrics are exported, metrics are not collected if this is empty.
+METRICS_FILE = os.environ.get('VM_WORKER_METRICS_FILE', '')
+# Format of the exported metrics: 'prometheus' (text exposition format) or 'json'.
+METRICS_FORMAT = os.environ.get('VM_WORKER_METRICS_FORMAT', 'json' if METRICS_FILE.endswith('.json') else 'prometheus')
+# Time (in seconds) between two exports of the metrics.
+METRICS_EXPORT_INTERVAL = float(os.environ.get('VM_WORKER_METRICS_EXPORT_INTERVAL', 10))
+# Upper bounds (in seconds) of the histogram buckets.
+DEFAULT_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600]
+
+PHASE_METRIC_NAME = 'vm_worker_phase_seconds'
+
+
+class _NullTimer(object):
+    """
+    Timer used when metrics are disabled, does nothing.
+    """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        return False
+
+
+_NULL_TIMER = _NullTimer()
+
+
+class _PhaseTimer(object):
+    """
+    Context manager which observes its duration into a histogram.
+    """
+
+    def __init__(self, registry, metric_name, labels):
+        self.registry = registry
+        self.metric_name = metric_name
+        self.labels = labels
+        self.start_time = None
+
+    def __enter__(self):
+        self.start_time = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.registry.observe(self.metric_name, self.labels, time.time() - self.start_time)
+        return False
+
+
+def _get_key(metric_name, labels):
+    """
+        Get key of a metric with the provided labels.
+    :param metric_name: name of the metric.
+    :param labels: dict of label name -> value.
+    :return: (metric name, sorted tuple of labels)
+    """
+    return metric_name, tuple(sorted(labels.items()))
+
+
+def _format_labels(label_items, extra_label=None):
+    """
+        Format labels in prometheus text format.
+    :param label_items: tuple of (label name, value)
+    :param extra_label: additional (label name, value), if any.
+    :return: formatted labels, like {a="1",b="2"}
+    """
+    all_items = list(label_items)
+    if extra_label is not None:
+        all_items.append(extra_label)
+    if len(all_items) == 0:
+        return ''
+    return '{' + ','.join(map(lambda curr_item: curr_item[0] + '="' + str(curr_item[1]).replace('\\', '\\\\')
+                              .replace('"', '\\"') + '"', all_items)) + '}'
+
+
+class MetricsRegistry(object):
+    """
+    Counters and histograms of a process.
+    Worker processes drain their metrics after every job and send them to the
+    daemon, which merges them into its registry and exports them.
+    """
+
+    def __init__(self, enabled, buckets=None):
+        """
+            Create a metrics registry.
+        :param enabled: flag to indicate whether metrics are collected.
+        :param buckets: upper bounds of the histogram buckets.
+        :return: None
+        """
+        self.enabled = enabled
+        self.buckets = buckets or DEFAULT_BUCKETS
+        # key -> value
+        self.counters = {}
+        # key -> [list of bucket counts, sum, count]
+        self.histograms = {}
+        self.last_export_time = time.time()
+
+    def inc(self, metric_name, labels, value=1):
+        """
+            Increment a counter.
+        :param metric_name: name of the counter.
+        :param labels: dict of label name -> value.
+        :param value: value to add.
+        :return: None
+        """
+        if not self.enabled:
+            return
+        curr_key = _get_key(metric_name, labels)
+        self.counters[curr_key] = self.counters.get(curr_key, 0) + value
+
+    def observe(self, metric_name, labels, value):
+        """
+            Add an observation to a histogram.
+        :param metric_name: name of the histogram.
+        :param labels: dict of label name -> value.
+        :param value: observed value.
+        :return: None
+        """
+        if not self.enabled:
+            return
+        curr_key = _get_key(metric_name, labels)
+        curr_histogram = self.histograms.get(curr_key)
+        if curr_histogram is None:
+            curr_histogram = [[0] * len(self.buckets), 0.0, 0]
+            self.histograms[curr_key] = curr_histogram
+        for i in range(len(self.buckets)):
+            if value <= self.buckets[i]:
+                curr_histogram[0][i] += 1
+                break
+        curr_histogram[1] += value
+        curr_histogram[2] += 1
+
+    def phase(self, job_type, phase_name):
+        """
+            Context manager to time a phase of a job.
+        :param job_type: type of the job.
+        :param phase_name: name of the phase.
+        :return: context manager.
+        """
+        if not self.enabled:
+            return _NULL_TIMER
+        return _PhaseTimer(self, PHASE_METRIC_NAME, {'job_type': job_type, 'phase': phase_name})
+
+    def drain(self):
+        """
+            Get all the metrics collected since the last drain and reset them.
+        :return: (counters, histograms) or None if there are no metrics.
+        """
+        if len(self.counters) == 0 and len(self.histograms) == 0:
+            return None
+        curr_snapshot = (self.counters, self.histograms)
+        self.counters = {}
+        self.histograms = {}
+        return curr_snapshot
+
+    def merge(self, metrics_snapshot):
+        """
+            Add the provided metrics, drained from another registry, to this one.
+        :param metrics_snapshot: (counters, histograms) returned by drain.
+        :return: None
+        """
+        if not self.enabled or metrics_snapshot is None:
+            return
+        all_counters, all_histograms = metrics_snapshot
+        for curr_key, curr_value in all_counters.items():
+            self.counters[curr_key] = self.counters.get(curr_key, 0) + curr_value
+        for curr_key, other_histogram in all_histograms.items():
+            curr_histogram = self.histograms.get(curr_key)
+            if curr_histogram is None:
+                self.histograms[curr_key] = [list(other_histogram[0]), other_histogram[1], other_histogram[2]]
+                continue
+            for i in range(len(curr_histogram[0])):
+                curr_histogram[0][i] += other_histogram[0][i]
+            curr_histogram[1] += other_histogram[1]
+            curr_histogram[2] += other_histogram[2]
+
+    def to_prometheus(self):
+        """
+            Get all the metrics in prometheus text exposition format.
+        :return: str
+        """
+        all_lines = []
+        for metric_name in sorted(set(map(lambda curr_key: curr_key[0], self.counters.keys()))):
+            all_lines.append('# TYPE ' + metric_name + ' counter')
+            for curr_key in sorted(filter(lambda curr_key: curr_key[0] == metric_name, self.counters.keys())):
+                all_lines.append(metric_name + _format_labels(curr_key[1]) + ' ' + str(self.counters[curr_key]))
+        for metric_name in sorted(set(map(lambda curr_key: curr_key[0], self.histograms.keys()))):
+            all_lines.append('# TYPE ' + metric_name + ' histogram')
+            for curr_key in sorted(filter(lambda curr_key: curr_key[0] == metric_name, self.histograms.keys())):
+                bucket_counts, value_sum, value_count = self.histograms[curr_key]
+                cumulative_count = 0
+                for i in range(len(self.buckets)):
+                    cumulative_count += bucket_counts[i]
+                    all_lines.append(metric_name + '_bucket' + _format_labels(curr_key[1], ('le', self.buckets[i])) +
+                                     ' ' + str(cumulative_count))
+                all_lines.append(metric_name + '_bucket' + _format_labels(curr_key[1], ('le', '+Inf')) + ' ' +
+                                 str(value_count))
+                all_lines.append(metric_name + '_sum' + _format_labels(curr_key[1]) + ' ' + repr(value_sum))
+                all_lines.append(metric_name + '_count' + _format_labels(curr_key[1]) + ' ' + str(value_count))
+        return '\n'.join(all_lines) + '\n'
+
+    def to_json(self):
+        """
+            Get all the metrics as json.
+        :return: str
+        """
+        all_counters = map(lambda curr_item: {'name': curr_item[0][0], 'labels': dict(curr_item[0][1]),
+                                              'value': curr_item[1]}, sorted(self.counters.items()))
+        all_histograms = map(lambda curr_item: {'name': curr_item[0][0], 'labels': dict(curr_item[0][1]),
+                                                'buckets': dict(zip(map(str, self.buckets), curr_item[1][0])),
+                                                'sum': curr_item[1][1], 'count': curr_item[1][2]},
+                             sorted(self.histograms.items()))
+        return json.dumps({'counters': all_counters, 'histograms': all_histograms}, indent=2, sort_keys=True)
+
+    def export(self, target_path, export_format):
+        """
+            Write all the metrics to the provided file, atomically.
+        :param target_path: path of the file.
+        :param export_format: 'prometheus' or 'json'
+        :return: None
+        """
+        self.last_export_time = time.time()
+        if not self.enabled or len(target_path) == 0:
+            return
+        try:
+            file_contents = self.to_json() if export_format == 'json' else self.to_prometheus()
+            tmp_fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(target_path)),
+                                                prefix='.metrics_')
+            with os.fdopen(tmp_fd, 'w') as fp:
+                fp.write(file_contents)
+            os.chmod(tmp_path, 0o644)
+            os.rename(tmp_path, target_path)
+        except (IOError, OSError) as e:
+            log_error("Unable to export metrics to:" + target_path + ", Error:" + str(e))
+
+    def export_if_due(self, target_path, export_format, export_interval):
+        """
+            Export the metrics, if the last export is older than the provided interval.
+        :return: None
+        """
+        if self.enabled and time.time() - self.last_export_time >= export_interval:
+            self.export(target_path, export_format)
+
+
+_metrics_registry = None
+
+
+def get_metrics():
+    """
+        Get the metrics registry of the current process.
+    :return: MetricsRegistry
+    """
+    global _metrics_registry
+    if _metrics_registry is None:
+        _metrics_registry = MetricsRegistry(len(METRICS_FILE) > 0)
+    return _metrics_registry
+
+
+def job_phase(job_type, phase_name):
+    """
+        Context manager to time a phase of a job of the provided type.
+    """
+    return get_metrics().phase(job_type, phase_name)
+
+
+def export_metrics(force=False):
+    """
+        Export the metrics of the current process to METRICS_FILE, at most once every METRICS_EXPORT_INTERVAL.
+    :param force: flag to indicate that the metrics should be exported irrespective of the interval.
+    :return: None
+    """
+    if force:
+        get_metrics().export(METRICS_FILE, METRICS_FORMAT)
+    else:
+        get_metrics().export_if_due(METRICS_FILE, METRICS_FORMAT, METRICS_EXPORT_INTERVAL)
@@ -3,6 +3,12 @@ from common_utils.binary_tester import BinaryTester
 from common_utils.poll_sanitizer import generate_poll_from_input
 import os
 from ..farnsworth_api_wrapper import CRSAPIWrapper
+from ..cpu_slots import cpu_slot
+from ..workspace import get_workspace_manager
+from ..metrics import job_phase
+from ..time_budget import job_budget, TIMEOUT_RESULT, TIMEOUT_ERROR_CODE
+
+JOB_TYPE = 'poll_creator'
 
 
 def _generate_poll(curr_poller_job):
@@ -15,34 +21,35 @@ def _generate_poll(curr_poller_job):
     log_info("Trying to create Poll for Job:" + str(curr_poller_job.id))
 
     # get binary path
-    bin_dir_path = os.path.join(os.path.expanduser("~"), 'pollcreator_' + str(curr_poller_job.id))
-    os.system('mkdir -p ' + bin_dir_path)
+    bin_dir_path = get_workspace_manager().create('pollcreator_' + str(curr_poller_job.id))
     target_poll_content = None
     ret_code = -1
     try:
         # get original binary
-        un_patched_bins = curr_poller_job.cs.cbns_original
-        for curr_cb in un_patched_bins:
-            curr_file = str(curr_cb.cs_id) + '_' + str(curr_cb.name)
-            curr_file_path = os.path.join(bin_dir_path, curr_file)
-            fp = open(curr_file_path, 'wb')
-            fp.write(curr_cb.blob)
-            fp.close()
-            os.chmod(curr_file_path, 0o777)
-        cs_name = curr_poller_job.cs.name
+        with job_phase(JOB_TYPE, 'setup'):
+            un_patched_bins = CRSAPIWrapper.get_unpatched_cbs(curr_poller_job.cs)
+            for curr_cb in un_patched_bins:
+                curr_file = str(curr_cb.cs_id) + '_' + str(curr_cb.name)
+                curr_file_path = os.path.join(bin_dir_path, curr_file)
+                CRSAPIWrapper.save_cbn(curr_cb, curr_file_path, is_read_only=True)
+            cs_name = curr_poller_job.cs.name
 
-        # Get target test object
-        target_test = curr_poller_job.target_test
-        input_data = target_test.blob
+            # Get target test object
+            target_test = curr_poller_job.target_test
+            input_data = target_test.blob
 
         # generate poll from input
-        target_poll_content, poll_test_res, ret_code = generate_poll_from_input(input_data, bin_dir_path,
-                                                                                str(cs_name),
-                                                                                optional_prefix=str(curr_poller_job.id) +
-                                                                                                '_gen',
-                                                                                log_suffix='For PollCreator Job:' +
-                                                                                           str(curr_poller_job.id),
-                                                                                afl_input=True)
+        with job_phase(JOB_TYPE, 'cb_test'), job_budget(JOB_TYPE) as curr_budget, cpu_slot():
+            target_poll_content, poll_test_res, ret_code = generate_poll_from_input(input_data, bin_dir_path,
+                                                                                    str(cs_name),
+                                                                                    optional_prefix=str(
+                                                                                        curr_poller_job.id) + '_gen',
+                                                                                    log_suffix='For PollCreator Job:' +
+                                                                                               str(curr_poller_job.id),
+                                                                                    afl_input=True)
+        if curr_budget.is_timed_out():
+            log_failure("Ran out of time while generating PollXml for Job:" + str(curr_poller_job.id))
+            CRSAPIWrapper.create_tester_result(curr_poller_job, TIMEOUT_ERROR_CODE, TIMEOUT_RESULT)
         # set the flag so that, we will not try again.
         target_test.poll_created = True
         target_test.save()
@@ -51,7 +58,8 @@ def _generate_poll(curr_poller_job):
     except Exception as e:
         log_error("Error occurred:" + str(e) + " while trying to Generate Poll for Job:" + str(curr_poller_job.id))
     # clean up
-    os.system('rm -rf ' + bin_dir_path)
+    with job_phase(JOB_TYPE, 'cleanup'):
+        get_workspace_manager().release(bin_dir_path)
 
     return target_poll_content, ret_code
 
@@ -59,24 +67,26 @@ def _generate_poll(curr_poller_job):
 def process_poll_creator_job(curr_job_args):
     """
     Process the provided job data, and update DB with corresponding result.
-    :param curr_job_args:  (job that needs to run, Number of threads that could be used).
+    :param curr_job_args:  (job that needs to run, Number of threads that could be used, is claimed).
     :return: None
     """
     CRSAPIWrapper.open_connection()
     job_id = curr_job_args[0]
-    curr_job = CRSAPIWrapper.get_poll_creator_job(job_id)
+    with job_phase(JOB_TYPE, 'job_fetch'):
+        curr_job = CRSAPIWrapper.get_poll_creator_job(job_id)
     target_job = curr_job
 
-    if target_job.try_start():
+    if CRSAPIWrapper.start_job(target_job, curr_job_args):
         try:
             generated_poll_xml, ret_code = _generate_poll(curr_job)
             if generated_poll_xml is not None:
                 # create a valid poll in the db.
-                CRSAPIWrapper.create_valid_poll(curr_job.cs, generated_poll_xml, test=curr_job.target_test,
-                                                is_perf_ready=(ret_code == 0))
+                with job_phase(JOB_TYPE, 'result'):
+                    CRSAPIWrapper.create_valid_poll(curr_job.cs, generated_poll_xml, test=curr_job.target_test,
+                                                    is_perf_ready=(ret_code == 0))
         except Exception as e:
             log_error("Error Occurred while processing PollerJob:" + str(target_job.id) + ". Error:" + str(e))
-        target_job.completed()
+        CRSAPIWrapper.complete_job(target_job)
     else:
         log_failure("Ignoring PollerJob:" + str(target_job.id) + " as we failed to mark it busy.")
     CRSAPIWrapper.close_connection()
@@ -1,10 +1,17 @@
 from ..farnsworth_api_wrapper import CRSAPIWrapper
+from ..cpu_slots import cpu_slot
+from ..workspace import get_workspace_manager
+from ..metrics import job_phase
+from ..time_budget import job_budget, get_num_rounds, get_thread_timeouts, TIMEOUT_RESULT, TIMEOUT_ERROR_CODE
 from farnsworth.actions import cfe_poll_from_xml, Write
 from common_utils.simple_logging import log_success, log_failure, log_error, log_info
 from common_utils.poll_sanitizer import sanitize_pcap_poll
 from common_utils.binary_tester import BinaryTester
+from multiprocessing.dummy import Pool as ThreadPool
 import os
 
+JOB_TYPE = 'network_poll_sanitizer'
+
 
 def get_write_data_from_poll(xml_blob):
     """
@@ -23,70 +30,179 @@ def get_write_data_from_poll(xml_blob):
     return write_data
 
 
+def _save_binaries(target_cs, target_cbs_path):
+    """
+        Save all the unpatched binaries of the provided CS in the provided directory.
+    :param target_cs: CS whose binaries need to be saved.
+    :param target_cbs_path: directory in which the binaries need to be saved.
+    :return: None
+    """
+    for curr_cb in CRSAPIWrapper.get_unpatched_cbs(target_cs):
+        curr_file = str(curr_cb.cs_id) + '_' + str(curr_cb.name)
+        curr_file_path = os.path.join(target_cbs_path, curr_file)
+        CRSAPIWrapper.save_cbn(curr_cb, curr_file_path, is_read_only=True)
+
+
+def _sanitize_poll(thread_arg):
+    """
+        Sanitize the provided raw poll on already saved binaries.
+    :param thread_arg: (raw poll blob, directory containing the binaries, id of the sanitizer job) tuple.
+    :return: (sanitized xml, result, return code, is timed out) tuple.
+    """
+    raw_poll_blob = thread_arg[0]
+    target_cbs_path = thread_arg[1]
+    job_id = thread_arg[2]
+    # polls of a group are sanitized by different threads, timeouts are counted per thread.
+    num_timeouts = get_thread_timeouts()
+    with cpu_slot():
+        sanitized_xml, target_result, ret_code = sanitize_pcap_poll(raw_poll_blob, target_cbs_path,
+                                                                    optional_prefix='pollsan_' + str(job_id),
+                                                                    log_suffix=' for PollSanitizerJob:' +
+                                                                               str(job_id))
+    return sanitized_xml, target_result, ret_code, get_thread_timeouts() > num_timeouts
+
+
+def _try_sanitize_poll(thread_arg):
+    """
+        Sanitize the provided raw poll, without letting errors reach the other polls of the group.
+    :param thread_arg: args to _sanitize_poll
+    :return: result of _sanitize_poll or None on error.
+    """
+    try:
+        return _sanitize_poll(thread_arg)
+    except Exception as e:
+        log_error("Error Occured while sanitizing poll of PollerSanitizerJob:" + str(thread_arg[2]) +
+                  ". Error:" + str(e))
+    return None
+
+
+def _save_sanitizer_result(curr_job, target_raw_poll, sanitizer_result):
+    """
+        Update the raw poll of the provided job with the result of sanitizing it, and create a valid poll if it passed.
+    :param curr_job: sanitizer job.
+    :param target_raw_poll: raw poll of the job.
+    :param sanitizer_result: result of _sanitize_poll for the raw poll.
+    :return: None
+    """
+    sanitized_xml, target_result, ret_code, is_timed_out = sanitizer_result
+    target_raw_poll.sanitized = True
+    target_raw_poll.save()
+    if is_timed_out:
+        log_error("PollSanitizerJob:" + str(curr_job.id) + ", Ran out of time on binary.")
+        CRSAPIWrapper.create_tester_result(curr_job, TIMEOUT_ERROR_CODE, TIMEOUT_RESULT)
+
+    if target_result == BinaryTester.CRASH_RESULT:
+        # set crash to true
+        target_raw_poll.is_crash = True
+        log_error("PollSanitizerJob:" + str(curr_job.id) + ", Lead to Crash. Someone attacked us, "
+                                                           "it will be synced in network poll creator")
+        target_raw_poll.save()
+    elif target_result == BinaryTester.FAIL_RESULT:
+        # set failed to true
+        target_raw_poll.is_failed = True
+        target_raw_poll.save()
+        log_error("PollSanitizerJob:" + str(curr_job.id) + ", Failed on binary. Mostly timeout or Crash.")
+    elif target_result == BinaryTester.PASS_RESULT:
+        # Create Valid Poll
+        CRSAPIWrapper.create_valid_poll(target_raw_poll.cs, sanitized_xml,
+                                        target_round=target_raw_poll.round, is_perf_ready=(ret_code == 0))
+        log_success("Created a ValidPoll for PollSanitizerJob:" + str(curr_job.id))
+    else:
+        log_error("Error occurred while sanitizing provided poll of Job:" + str(curr_job.id) +
+                  ", Sanitize PCAP POLL Returned:" + str(target_result))
+
+
 def process_sanitizer_job(curr_job_args):
     """
         Process the provided sanitizer job.
         and update DB with corresponding valid poll, else update the
         raw poll with reason of failure.
-    :param curr_job_args:  (job that needs to run, num threads)
+    :param curr_job_args:  (job that needs to run, num threads, is claimed)
                             (As of now, we ignore num threads as it is not needed)
     :return: None
     """
     CRSAPIWrapper.open_connection()
     job_id = curr_job_args[0]
-    curr_job = CRSAPIWrapper.get_poll_sanitizer_job(job_id)
+    with job_phase(JOB_TYPE, 'job_fetch'):
+        curr_job = CRSAPIWrapper.get_poll_sanitizer_job(job_id)
     target_job = curr_job
 
-    if target_job.try_start():
-        target_cbs_path = os.path.join(os.path.expanduser('~'), 'pollsan_' + str(curr_job.id))
+    if CRSAPIWrapper.start_job(target_job, curr_job_args):
+        target_cbs_path = None
         try:
             log_info("Trying to process PollSanitizerJob:" + str(target_job.id))
             # Create folder to save all binaries that belong to current CS.
             target_raw_poll = curr_job.raw_poll
 
-            os.system('mkdir -p ' + str(target_cbs_path))
+            target_cbs_path = get_workspace_manager().create('pollsan_' + str(curr_job.id))
             # Save all binaries
-            for curr_cb in target_raw_poll.cs.cbns_original:
-                curr_file = str(curr_cb.cs_id) + '_' + str(curr_cb.name)
-                curr_file_path = os.path.join(target_cbs_path, curr_file)
-                fp = open(curr_file_path, 'wb')
-                fp.write(curr_cb.blob)
-                fp.close()
-                os.chmod(curr_file_path, 0o777)
-
-            sanitized_xml, target_result, ret_code = sanitize_pcap_poll(target_raw_poll.blob,
-                                                                        target_cbs_path,
-                                                                        optional_prefix='pollsan_' + str(curr_job.id),
-                                                                        log_suffix=' for PollSanitizerJob:' +
-                                                                                   str(curr_job.id))
-            target_raw_poll.sanitized = True
-            target_raw_poll.save()
-
-            if target_result == BinaryTester.CRASH_RESULT:
-                # set crash to true
-                target_raw_poll.is_crash = True
-                log_error("PollSanitizerJob:" + str(curr_job.id) + ", Lead to Crash. Someone attacked us, "
-                                                                   "it will be synced in network poll creator")
-                target_raw_poll.save()
-            elif target_result == BinaryTester.FAIL_RESULT:
-                # set failed to true
-                target_raw_poll.is_failed = True
-                target_raw_poll.save()
-                log_error("PollSanitizerJob:" + str(curr_job.id) + ", Failed on binary. Mostly timeout or Crash.")
-            elif target_result == BinaryTester.PASS_RESULT:
-                # Create Valid Poll
-                CRSAPIWrapper.create_valid_poll(curr_job.raw_poll.cs, sanitized_xml,
-                                                target_round=curr_job.raw_poll.round, is_perf_ready=(ret_code == 0))
-                log_success("Created a ValidPoll for PollSanitizerJob:" + str(curr_job.id))
-            else:
-                log_error("Error occurred while sanitizing provided poll of Job:" + str(curr_job.id) +
-                          ", Sanitize PCAP POLL Returned:" + str(target_result))
+            with job_phase(JOB_TYPE, 'setup'):
+                _save_binaries(target_raw_poll.cs, target_cbs_path)
+
+            with job_phase(JOB_TYPE, 'cb_test'), job_budget(JOB_TYPE):
+                sanitizer_result = _sanitize_poll((target_raw_poll.blob, target_cbs_path, curr_job.id))
+            with job_phase(JOB_TYPE, 'result'):
+                _save_sanitizer_result(curr_job, target_raw_poll, sanitizer_result)
 
         except Exception as e:
             log_error("Error Occured while processing PollerSanitizerJob:" + str(target_job.id) + ". Error:" + str(e))
         # clean up
-        os.system('rm -rf ' + str(target_cbs_path))
-        target_job.completed()
+        with job_phase(JOB_TYPE, 'cleanup'):
+            get_workspace_manager().release(target_cbs_path)
+        CRSAPIWrapper.complete_job(target_job)
     else:
         log_failure("Ignoring PollerSanitizerJob:" + str(target_job.id) + " as we failed to mark it busy.")
     CRSAPIWrapper.close_connection()
+
+
+def process_sanitizer_job_group(job_args):
+    """
+        Process a group of sanitizer jobs, whose raw polls have the same CS.
+        Binaries are saved once, and the polls are sanitized in parallel with the given number of threads.
+        Each raw poll is updated and gets its valid poll, as if its job was run by itself.
+    :param job_args: Tuple (list of sanitizer job ids, num threads, is claimed) to be sanitized.
+    :return: None
+    """
+    CRSAPIWrapper.open_connection()
+    num_threads = job_args[1]
+    with job_phase(JOB_TYPE, 'job_fetch'):
+        all_jobs = filter(lambda curr_job: CRSAPIWrapper.start_job(curr_job, job_args),
+                          CRSAPIWrapper.get_poll_sanitizer_jobs(job_args[0]))
+        all_raw_polls = CRSAPIWrapper.get_raw_polls(all_jobs)
+    if len(all_jobs) > 0:
+        group_str = ",".join(map(lambda curr_job: str(curr_job.id), all_jobs))
+        log_info("Trying to process PollSanitizerJobs:" + group_str)
+        target_cbs_path = get_workspace_manager().create('pollsan_' + str(all_jobs[0].id) + '_group')
+        all_results = [None] * len(all_jobs)
+        try:
+            with job_phase(JOB_TYPE, 'setup'):
+                _save_binaries(all_raw_polls[all_jobs[0].id].cs, target_cbs_path)
+            all_thread_args = map(lambda curr_job: (all_raw_polls[curr_job.id].blob, target_cbs_path,
+                                                    curr_job.id), all_jobs)
+            with job_phase(JOB_TYPE, 'cb_test'), job_budget(JOB_TYPE, get_num_rounds(len(all_jobs), num_threads)):
+                if num_threads > 1 and len(all_jobs) > 1:
+                    log_info("Running in multi-threaded mode with:" + str(num_threads) +
+                             " threads. For PollSanitizerJobs:" + group_str)
+                    thread_pool = ThreadPool(processes=min(num_threads, len(all_jobs)))
+                    all_results = thread_pool.map(_try_sanitize_poll, all_thread_args)
+                    thread_pool.close()
+                    thread_pool.join()
+                else:
+                    all_results = map(_try_sanitize_poll, all_thread_args)
+        except Exception as e:
+            log_error("Error Occured while processing PollerSanitizerJobs:" + group_str + ". Error:" + str(e))
+        for curr_job, sanitizer_result in zip(all_jobs, all_results):
+            if sanitizer_result is not None:
+                try:
+                    with job_phase(JOB_TYPE, 'result'):
+                        _save_sanitizer_result(curr_job, all_raw_polls[curr_job.id], sanitizer_result)
+                except Exception as e:
+                    log_error("Error Occured while processing PollerSanitizerJob:" + str(curr_job.id) +
+                              ". Error:" + str(e))
+            CRSAPIWrapper.complete_job(curr_job)
+        # clean up
+        with job_phase(JOB_TYPE, 'cleanup'):
+            get_workspace_manager().release(target_cbs_path)
+    else:
+        log_info("Unable to start any of the jobs:" + str(job_args[0]) + ". Ignoring")
+    CRSAPIWrapper.close_connection()
@@ -1,12 +1,22 @@
 from ..farnsworth_api_wrapper import CRSAPIWrapper
-from farnsworth.models import Exploit
+from ..cpu_slots import cpu_slot
+from ..workspace import get_workspace_manager, make_dir
+from ..metrics import job_phase
+from ..time_budget import job_budget, is_budget_expired, on_throw_timeout, TIMEOUT_RESULT
+from farnsworth.models import Exploit, PovTesterJob
 from common_utils.binary_tester import BinaryTester
 import collections
+import Queue
 from multiprocessing.dummy import Pool as ThreadPool
 from common_utils.simple_logging import log_info, log_success, log_failure, log_error
 import os
 import compilerex
 NUM_THROWS = 10
+JOB_TYPE = 'pov_tester'
+# Number of successful throws after which a fielding needs no more testing.
+SUCCESS_THRESHOLD = 4
+# Stop throwing once the remaining throws can not change whether we reach the SUCCESS_THRESHOLD.
+EARLY_STOP_THROWS = os.environ.get('VM_WORKER_POV_EARLY_STOP', '1') == '1'
 
 
 def _test_pov(thread_arg):
@@ -19,17 +29,31 @@ def _test_pov(thread_arg):
     pov_file = thread_arg[1]
     ids_rules = thread_arg[2]
     bin_tester = BinaryTester(bin_folder, pov_file, is_pov=True, is_cfe=True, standalone=True, ids_rules=ids_rules)
-    ret_code, stdout_txt, stderr_txt = bin_tester.test_cb_binary()
+    with cpu_slot():
+        ret_code, stdout_txt, stderr_txt = bin_tester.test_cb_binary()
     return ret_code == 0, stdout_txt, stderr_txt
 
 
+def _queue_pov_test(thread_arg):
+    """
+        Test the provided PoV and queue the result, or the error.
+    :param thread_arg: (result queue, args to _test_pov) tuple.
+    :return: None
+    """
+    result_queue = thread_arg[0]
+    try:
+        result_queue.put((_test_pov(thread_arg[1]), None))
+    except Exception as e:
+        result_queue.put((None, e))
+
+
 def _get_all_cbns(cs_fielded_obj):
     """
         Get all cbns of the provided fielded cs
     :param cs_fielded_obj: fielded cs for which we need to get the CBns for.
     :return: list of cbs of the provided fielded cs.
     """
-    return cs_fielded_obj.cbns
+    return CRSAPIWrapper.get_fielded_cbs(cs_fielded_obj)
 
 
 def _get_ids_rules_obj(ids_fielding_obj):
@@ -39,7 +63,7 @@ def _get_ids_rules_obj(ids_fielding_obj):
     :return: ids_rules obj of the provided ids_fielding_obj
     """
     if ids_fielding_obj is not None:
-        return ids_fielding_obj.ids_rule
+        return CRSAPIWrapper.get_ids_rule(ids_fielding_obj.ids_rule_id)
     return None
 
 
@@ -53,7 +77,7 @@ def _get_job_args(curr_pov_test_job):
     pov_test_job_id = curr_pov_test_job.id
     # Get all binaries in
     all_cbns = _get_all_cbns(cs_fielding_obj)
-    curr_work_dir = os.path.join(os.path.expanduser("~"), "pov_tester_" + str(pov_test_job_id))
+    curr_work_dir = get_workspace_manager().create("pov_tester_" + str(pov_test_job_id))
 
     bin_dir = os.path.join(curr_work_dir, 'bin_dir')
     pov_dir = os.path.join(curr_work_dir, 'pov_dir')
@@ -63,20 +87,17 @@ def _get_job_args(curr_pov_test_job):
 
         # set up binaries
         # Save CBNs into the bin dir
-        os.system('mkdir -p ' + str(bin_dir))
+        make_dir(bin_dir)
         for curr_cb in all_cbns:
             curr_file = str(curr_cb.cs_id) + '_' + str(curr_cb.name)
             curr_file_path = os.path.join(bin_dir, curr_file)
-            fp = open(curr_file_path, 'wb')
-            fp.write(curr_cb.blob)
-            fp.close()
-            os.chmod(curr_file_path, 0o777)
+            CRSAPIWrapper.save_cbn(curr_cb, curr_file_path, is_read_only=True)
 
         pov_file_path = None
 
         # set up povs
         # save povs into pov directory
-        os.system('mkdir -p ' + str(pov_dir))
+        make_dir(pov_dir)
         target_exploit_obj = curr_pov_test_job.target_exploit
         pov_file_path = os.path.join(pov_dir, str(curr_pov_test_job.id) + '.pov')
         fp = open(pov_file_path, 'w')
@@ -87,7 +108,7 @@ def _get_job_args(curr_pov_test_job):
         ids_file_path = None
         # set up ids rules
         # save ids rules into directory
-        os.system('mkdir -p ' + str(ids_dir))
+        make_dir(ids_dir)
         ids_rules_obj = _get_ids_rules_obj(curr_pov_test_job.target_ids_fielding)
         # if we have non-empty ids rules?
         if ids_rules_obj is not None and ids_rules_obj.rules is not None and len(str(ids_rules_obj.rules).strip()) > 0:
@@ -98,8 +119,7 @@ def _get_job_args(curr_pov_test_job):
             os.chmod(ids_file_path, 0o777)
     except Exception as e:
         # clean up
-        if curr_work_dir is not None:
-            os.system('rm -rf ' + curr_work_dir)
+        get_workspace_manager().release(curr_work_dir)
         log_error("Error occurred while trying to setup working directory for PovTesterJob:" + str(pov_test_job_id) +
                   ", Error:" + str(e))
         raise e
@@ -112,7 +132,6 @@ def is_testing_not_required(pov_test_job):
     :param pov_test_job: Pov Tester job which needs to be checked.
     :return: True/False: indicating whether testing is not required.
     """
-    SUCCESS_THRESHOLD = 4
     try:
         curr_result = CRSAPIWrapper.get_best_pov_result(pov_test_job.target_cs_fielding,
                                                         pov_test_job.target_ids_fielding)
@@ -123,26 +142,126 @@ def is_testing_not_required(pov_test_job):
     return False
 
 
+def filter_obviated_jobs(job_ids):
+    """
+        Complete the provided pov tester jobs, whose fieldings already have enough successful throws, in bulk.
+    :param job_ids: ids of the claimed pov tester jobs.
+    :return: list of ids of the jobs, which still need to be tested.
+    """
+    obviated_jobs = CRSAPIWrapper.get_obviated_pov_tester_jobs(job_ids, SUCCESS_THRESHOLD)
+    if len(obviated_jobs) > 0:
+        CRSAPIWrapper.complete_jobs(PovTesterJob, obviated_jobs)
+    return filter(lambda curr_job_id: curr_job_id not in obviated_jobs, job_ids)
+
+
+def _is_outcome_settled(num_passed, num_thrown):
+    """
+        Check if the remaining throws can change whether the pov reaches the success threshold.
+    :param num_passed: number of successful throws so far.
+    :param num_thrown: number of throws so far.
+    :return: True/False indicating whether the outcome is settled.
+    """
+    num_remaining = NUM_THROWS - num_thrown
+    return num_passed >= SUCCESS_THRESHOLD or num_passed + num_remaining < SUCCESS_THRESHOLD
+
+
+def _get_test_feedback(num_thrown, is_timed_out):
+    """
+        Get the feedback to be recorded with the result of a pov.
+        num_success of the result only counts the throws which were done, the feedback tells how many were done,
+        as the throws stop early once the outcome is settled or the job ran out of time.
+    :param num_thrown: number of throws.
+    :param is_timed_out: flag to indicate whether the job ran out of time.
+    :return: feedback str like throws:4/10, prefixed with the timeout result if the job ran out of time.
+    """
+    test_feedback = "throws:" + str(num_thrown) + "/" + str(NUM_THROWS)
+    if is_timed_out:
+        # throws which were killed count as failed, but the result tells them apart.
+        test_feedback = TIMEOUT_RESULT + "," + test_feedback
+    return test_feedback
+
+
+def _throw_povs(all_child_process_args, num_threads, job_id_str):
+    """
+        Throw the pov for all the provided args, stopping early if the outcome is settled
+        or the job ran out of time.
+    :param all_child_process_args: list of args to _test_pov
+    :param num_threads: number of threads that could be used.
+    :param job_id_str: id of the PovTesterJob, for logging.
+    :return: list of results of _test_pov for all the throws done.
+    """
+    all_results = []
+    # If we can multiprocess? Run in multi-threaded mode
+    if num_threads > 1:
+        log_info("Running in multi-threaded mode with:" + str(num_threads) + " threads. For PovTesterJob:" +
+                 job_id_str)
+        thread_pool = ThreadPool(processes=num_threads)
+        result_queue = Queue.Queue()
+        # a throw is started only once a thread is free, so that we stop starting throws as soon as the outcome
+        # is settled, while the throws already started are waited for and counted.
+        num_started = min(num_threads, len(all_child_process_args))
+        for curr_child_arg in all_child_process_args[:num_started]:
+            thread_pool.apply_async(_queue_pov_test, ((result_queue, curr_child_arg),))
+        is_stopped = False
+        try:
+            while len(all_results) < num_started:
+                curr_result, curr_error = result_queue.get()
+                if curr_error is not None:
+                    raise curr_error
+                all_results.append(curr_result)
+                if EARLY_STOP_THROWS and \
+                        _is_outcome_settled(len(filter(lambda x: x[0], all_results)), len(all_results)):
+                    is_stopped = True
+                if is_budget_expired():
+                    is_stopped = True
+                if not is_stopped and num_started < len(all_child_process_args):
+                    thread_pool.apply_async(_queue_pov_test, ((result_queue, all_child_process_args[num_started]),))
+                    num_started += 1
+        finally:
+            thread_pool.close()
+            thread_pool.join()
+    else:
+        log_info("Running in single threaded mode. For PovTesterJob:" +
+                 job_id_str)
+        for curr_child_arg in all_child_process_args:
+            all_results.append(_test_pov(curr_child_arg))
+            if EARLY_STOP_THROWS and _is_outcome_settled(len(filter(lambda x: x[0], all_results)), len(all_results)):
+                break
+            if is_budget_expired():
+                break
+    if len(all_results) < len(all_child_process_args) and is_budget_expired():
+        log_failure("Ran out of time after:" + str(len(all_results)) + " throws for PovTesterJob:" + job_id_str)
+        # the throws which were not done count as timed out.
+        on_throw_timeout()
+    elif len(all_results) < len(all_child_process_args):
+        log_info("Outcome settled after:" + str(len(all_results)) + " throws for PovTesterJob:" + job_id_str)
+    return all_results
+
+
 def process_povtester_job(curr_job_args):
     """
         Process the provided PoV Tester Job with given number of threads.
-    :param curr_job_args: (pov tester job to process, number of threads that could be used)
+    :param curr_job_args: (pov tester job to process, number of threads that could be used, is claimed)
     :return: None
     """
     CRSAPIWrapper.open_connection()
     job_id = curr_job_args[0]
-    curr_job = CRSAPIWrapper.get_pov_tester_job(job_id)
+    with job_phase(JOB_TYPE, 'job_fetch'):
+        curr_job = CRSAPIWrapper.get_pov_tester_job(job_id)
     num_threads = curr_job_args[1]
     target_job = curr_job
     job_id_str = str(curr_job.id)
 
-    if target_job.try_start():
-        if is_testing_not_required(curr_job):
+    if CRSAPIWrapper.start_job(target_job, curr_job_args):
+        with job_phase(JOB_TYPE, 'result_check'):
+            is_obviated = is_testing_not_required(curr_job)
+        if is_obviated:
             log_success("Testing not required for PovTesterJob:" + str(job_id) + ", as a previous job obviated this.")
         else:
             curr_work_dir = None
             try:
-                job_bin_dir, curr_work_dir, pov_file_path, ids_rules_path = _get_job_args(curr_job)
+                with job_phase(JOB_TYPE, 'setup'):
+                    job_bin_dir, curr_work_dir, pov_file_path, ids_rules_path = _get_job_args(curr_job)
                 job_id_str = str(curr_job.id)
                 log_info("Trying to run PovTesterJob:" + job_id_str)
                 all_child_process_args = []
@@ -152,30 +271,18 @@ def process_povtester_job(curr_job_args):
 
                 log_info("Got:" + str(len(all_child_process_args)) + " Throws to test for PovTesterJob:" + job_id_str)
 
-                all_results = []
-                # If we can multiprocess? Run in multi-threaded mode
-                if num_threads > 1:
-                    log_info("Running in multi-threaded mode with:" + str(num_threads) + " threads. For PovTesterJob:" +
-                             job_id_str)
-                    thread_pool = ThreadPool(processes=num_threads)
-                    all_results = thread_pool.map(_test_pov, all_child_process_args)
-                    thread_pool.close()
-                    thread_pool.join()
-                else:
-                    log_info("Running in single threaded mode. For PovTesterJob:" +
-                             job_id_str)
-                    for curr_child_arg in all_child_process_args:
-                        all_results.append(_test_pov(curr_child_arg))
-
+                with job_phase(JOB_TYPE, 'cb_test'), job_budget(JOB_TYPE) as curr_budget:
+                    all_results = _throw_povs(all_child_process_args, num_threads, job_id_str)
                 throws_passed = len(filter(lambda x: x[0], all_results))
                 # if none of the throws passed, lets see if we can create new exploit?
                 if throws_passed == 0:
                     log_info("Exploit is bad. Trying to create new exploit by replacing most common register.")
                     all_regs = collections.defaultdict(int)
-                    for _,curr_output,_ in all_results:
-                        curr_exploit_reg = _get_exploit_register(curr_output)
-                        if curr_exploit_reg is not None:
-                            all_regs[curr_exploit_reg] += 1
+                    with job_phase(JOB_TYPE, 'parse_output'):
+                        for _,curr_output,_ in all_results:
+                            curr_exploit_reg = _get_exploit_register(curr_output)
+                            if curr_exploit_reg is not None:
+                                all_regs[curr_exploit_reg] += 1
                     if len(all_regs) > 0:
                         log_info("Got:" + str(len(all_regs)) + " possible registers")
                         target_reg = sorted(all_regs.items(), key=lambda x: x[1], reverse=True)[0][0]
@@ -184,15 +291,19 @@ def process_povtester_job(curr_job_args):
                     else:
                         log_failure("Could not get any register from cb-test output")
 
-                CRSAPIWrapper.create_pov_test_result(curr_job.target_exploit, curr_job.target_cs_fielding,
-                                                     curr_job.target_ids_fielding, throws_passed)
+                with job_phase(JOB_TYPE, 'result'):
+                    CRSAPIWrapper.create_pov_test_result(curr_job.target_exploit, curr_job.target_cs_fielding,
+                                                         curr_job.target_ids_fielding,
+                                                         throws_passed,
+                                                         test_feedback=_get_test_feedback(len(all_results),
+                                                                                          curr_budget.is_timed_out()))
                 log_success("Done Processing PovTesterJob:" + job_id_str)
             except Exception as e:
                 log_error("Error Occured while processing PovTesterJob:" + job_id_str + ". Error:" + str(e))
             # clean up
-            if curr_work_dir is not None:
-                os.system('rm -rf ' + curr_work_dir)
-        target_job.completed()
+            with job_phase(JOB_TYPE, 'cleanup'):
+                get_workspace_manager().release(curr_work_dir)
+        CRSAPIWrapper.complete_job(target_job)
     else:
         log_failure("Ignoring PovTesterJob:" + job_id_str + " as we failed to mark it busy.")
     CRSAPIWrapper.close_connection()
@@ -0,0 +1,125 @@
+import errno
+import fcntl
+import multiprocessing
+import os
+import tempfile
+import threading
+
+# Maximum time (in seconds) a waiter sleeps without being woken up, before it checks again whether what it
+# waits for happened.
+LOCK_WAIT_TIMEOUT = float(os.environ.get('VM_WORKER_LOCK_WAIT_TIMEOUT', 1))
+
+
+def _set_cloexec(target_fd):
+    """
+        Keep the provided descriptor out of the processes started with exec, like cb-test.
+    :param target_fd: file descriptor.
+    :return: None
+    """
+    fcntl.fcntl(target_fd, fcntl.F_SETFD, fcntl.fcntl(target_fd, fcntl.F_GETFD) | fcntl.FD_CLOEXEC)
+
+
+def open_lock_file(lock_file_path):
+    """
+        Open a file to be locked with flock.
+        cb-tests started by another thread with subprocess (which does not close the descriptors by default) do
+        not inherit it, else they would keep holding the lock until they exit.
+    :param lock_file_path: path of the lock file.
+    :return: file object.
+    """
+    # e is close on exec set by the open itself, so that a fork by another thread can not come in between.
+    lock_fp = open(lock_file_path, 'ae')
+    _set_cloexec(lock_fp.fileno())
+    return lock_fp
+
+
+def _lock_file(lock_fp):
+    """
+        Get an exclusive lock on the provided file, waiting as long as needed.
+    :param lock_fp: file object.
+    :return: None
+    """
+    while True:
+        try:
+            fcntl.flock(lock_fp.fileno(), fcntl.LOCK_EX)
+            return
+        except IOError as e:
+            # interrupted by a signal, like the one toggling the profiler.
+            if e.errno != errno.EINTR:
+                raise
+
+
+class ProcessLock(object):
+    """
+    Lock shared by the processes forked after it is created, and by their threads.
+    Unlike multiprocessing.Lock, it is a lock on a file, which the kernel gives back
+    when its holder dies, so that a worker killed while holding it can not block the
+    daemon and the other workers. The file is removed right away and is opened through
+    the descriptor inherited by the processes, so that it is never left behind.
+    Waiters sleep on a semaphore, which is only posted and never held, until they
+    are notified. They check again after a while anyway, as a notification from a
+    holder which dies would never come.
+    """
+
+    def __init__(self, wait_timeout=LOCK_WAIT_TIMEOUT):
+        """
+            Create a lock.
+        :param wait_timeout: Maximum time (in seconds) a waiter sleeps without being notified.
+        :return: None
+        """
+        lock_fd, lock_file_path = tempfile.mkstemp(prefix='vm_worker_', suffix='.lock')
+        os.unlink(lock_file_path)
+        _set_cloexec(lock_fd)
+        self.lock_fd = lock_fd
+        # every open of it is a file of its own, sharing the lock with the other opens.
+        self.lock_file_path = '/proc/self/fd/' + str(lock_fd)
+        self.wait_timeout = wait_timeout
+        # file holding the lock, of every thread of the current process.
+        self._held_files = threading.local()
+        # posted once for every waiter, when they are notified.
+        self._wakeups = multiprocessing.Semaphore(0)
+        # number of waiters to be notified, changed only while holding the lock.
+        self._num_waiters = multiprocessing.Value('i', 0, lock=False)
+
+    def __enter__(self):
+        # a file of its own, so that the threads of a process exclude each other too.
+        lock_fp = open_lock_file(self.lock_file_path)
+        try:
+            _lock_file(lock_fp)
+        except BaseException:
+            lock_fp.close()
+            raise
+        self._held_files.lock_fp = lock_fp
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        lock_fp = self._held_files.lock_fp
+        self._held_files.lock_fp = None
+        lock_fp.close()
+
+    def wait(self):
+        """
+            Give up the lock until we are notified, or for at most the wait timeout.
+            Should be called while holding the lock, which is held again once it returns.
+        :return: None
+        """
+        self._num_waiters.value += 1
+        self.__exit__(None, None, None)
+        is_notified = False
+        try:
+            is_notified = self._wakeups.acquire(True, self.wait_timeout)
+        finally:
+            self.__enter__()
+            if not is_notified and self._num_waiters.value > 0:
+                # a notification which comes late only wakes up a waiter once more.
+                self._num_waiters.value -= 1
+
+    def notify_all(self):
+        """
+            Wake up all the waiters.
+            Should be called while holding the lock.
+        :return: None
+        """
+        for _ in range(self._num_waiters.value):
+            self._wakeups.release()
+        self._num_waiters.value = 0
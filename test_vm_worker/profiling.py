@@ -0,0 +1,356 @@
+import cProfile
+import glob
+import os
+import pstats
+import random
+import signal
+import sys
+import threading
+import time
+from multiprocessing import Value
+from common_utils.simple_logging import log_info, log_error
+
+# Directory to which the profiles are written, profiling is disabled if this is empty.
+PROFILE_DIR = os.environ.get('VM_WORKER_PROFILE_DIR', '')
+# Fraction of the jobs, which are run under cProfile.
+PROFILE_FRACTION = float(os.environ.get('VM_WORKER_PROFILE_FRACTION', 0))
+# Start sampling the stacks as soon as a process starts, instead of waiting for the signal.
+PROFILE_SAMPLING = os.environ.get('VM_WORKER_PROFILE_SAMPLING', '0') == '1'
+# Time (in seconds) between two stack samples.
+PROFILE_SAMPLE_INTERVAL = float(os.environ.get('VM_WORKER_PROFILE_SAMPLE_INTERVAL', 0.005))
+# Time (in seconds) between two writes of the stack samples, while sampling.
+PROFILE_DUMP_INTERVAL = float(os.environ.get('VM_WORKER_PROFILE_DUMP_INTERVAL', 30))
+# Signal which toggles stack sampling, sending it to the daemon turns it on or off in all the workers.
+PROFILE_SIGNAL = signal.SIGUSR2
+# Maximum depth of a sampled stack.
+MAX_STACK_DEPTH = 64
+
+# Extension of the cProfile output files (pstats format).
+CPROFILE_EXTENSION = '.prof'
+# Extension of the stack sample files (folded stacks, as used by flamegraph.pl).
+SAMPLES_EXTENSION = '.folded'
+
+
+def _get_frame_name(curr_frame):
+    """
+        Get name of a frame, as used in the folded stacks.
+    :param curr_frame: frame object.
+    :return: str like file.py:function
+    """
+    return os.path.basename(curr_frame.f_code.co_filename) + ':' + curr_frame.f_code.co_name
+
+
+class Profiler(object):
+    """
+    Profiles of the jobs run by a process, kept per job type.
+    A configurable fraction of the jobs is run under cProfile, along with the
+    threads they start, and the stacks of all the threads of the process can be
+    sampled by a thread, which is turned on and off by a signal.
+    Profiles are written per job type and process, so that the files of all the
+    workers (and of recycled workers) can be merged later.
+    """
+
+    def __init__(self, profile_dir, profile_fraction, sample_interval):
+        """
+            Create a profiler.
+        :param profile_dir: Directory to which the profiles are written, empty to disable profiling.
+        :param profile_fraction: Fraction of the jobs to be run under cProfile.
+        :param sample_interval: Time (in seconds) of CPU time between two stack samples.
+        :return: None
+        """
+        self.profile_dir = profile_dir
+        self.profile_fraction = profile_fraction
+        self.sample_interval = sample_interval
+        self.process_name = str(os.getpid())
+        # type of the job being run.
+        self.curr_job_type = None
+        # job type of the samples taken outside of jobs, they are ignored if this is None.
+        self.default_job_type = None
+        # job type -> pstats.Stats
+        self.job_stats = {}
+        # job type -> {folded stack -> number of samples}
+        self.job_samples = {}
+        # reentrant, as the samples are also written by the handler of the profiling signal.
+        self.samples_lock = threading.RLock()
+        self.is_sampling = False
+        # set to stop the current sampler thread.
+        self.stop_sampling_event = None
+        # shared by the daemon and its workers, tells the workers whether they should be sampling.
+        self.sampling_state = None
+        # cProfile.Profile of each thread started by the job being profiled.
+        self.thread_profiles = []
+        self.thread_profiles_lock = threading.Lock()
+        self.last_dump_time = time.time()
+
+    def is_enabled(self):
+        """
+            Check if profiling is enabled.
+        :return: True/False
+        """
+        return len(self.profile_dir) > 0
+
+    def _get_profile_path(self, job_type, extension):
+        """
+            Get path of the profile file of the provided job type, for this process.
+        """
+        return os.path.join(self.profile_dir, job_type + '.' + self.process_name + extension)
+
+    def _take_sample(self):
+        """
+            Record the current stacks of all the threads of this process, except the sampler.
+        :return: None
+        """
+        job_type = self.curr_job_type or self.default_job_type
+        if job_type is None:
+            return
+        all_stacks = []
+        sampler_ident = threading.current_thread().ident
+        for thread_ident, curr_frame in sys._current_frames().items():
+            if thread_ident == sampler_ident:
+                continue
+            all_names = []
+            while curr_frame is not None and len(all_names) < MAX_STACK_DEPTH:
+                all_names.append(_get_frame_name(curr_frame))
+                curr_frame = curr_frame.f_back
+            all_stacks.append(';'.join(reversed(all_names)))
+        with self.samples_lock:
+            curr_samples = self.job_samples.setdefault(job_type, {})
+            for curr_stack in all_stacks:
+                curr_samples[curr_stack] = curr_samples.get(curr_stack, 0) + 1
+
+    def _run_sampler(self, stop_event):
+        """
+            Body of the sampler thread, samples the stacks until sampling is stopped.
+            Threads waiting for cb-test or for the DB are sampled in their waits.
+        :param stop_event: threading.Event which is set to stop this sampler.
+        :return: None
+        """
+        while not stop_event.wait(self.sample_interval):
+            try:
+                self._take_sample()
+            except Exception as e:
+                log_error("Error occurred while sampling stacks of process:" + self.process_name + ", Error:" + str(e))
+
+    def start_sampling(self):
+        """
+            Start sampling the stacks of all the threads of this process.
+        :return: None
+        """
+        if not self.is_enabled() or self.is_sampling:
+            return
+        self.stop_sampling_event = threading.Event()
+        sampler_thread = threading.Thread(target=self._run_sampler, args=(self.stop_sampling_event,),
+                                          name='stack_sampler')
+        sampler_thread.daemon = True
+        sampler_thread.start()
+        self.is_sampling = True
+        log_info("Started sampling stacks of process:" + self.process_name)
+
+    def stop_sampling(self):
+        """
+            Stop sampling the stacks of this process and write the samples.
+        :return: None
+        """
+        if not self.is_sampling:
+            return
+        # not waiting for the sampler to exit, we might be a signal handler interrupting it.
+        self.stop_sampling_event.set()
+        self.is_sampling = False
+        self.dump()
+        log_info("Stopped sampling stacks of process:" + self.process_name)
+
+    def set_sampling(self, is_sampling):
+        """
+            Start or stop sampling the stacks of this process.
+        :param is_sampling: flag to indicate whether the stacks should be sampled.
+        :return: None
+        """
+        if is_sampling:
+            self.start_sampling()
+        else:
+            self.stop_sampling()
+
+    def toggle_sampling(self, signum=None, curr_frame=None):
+        """
+            Start sampling if we are not sampling, else stop it.
+            The shared sampling state, if any, is updated so that the workers can follow.
+            Can be used as a signal handler.
+        :return: None
+        """
+        self.set_sampling(not self.is_sampling)
+        if self.sampling_state is not None:
+            self.sampling_state.value = int(self.is_sampling)
+
+    def sync_sampling(self, signum=None, curr_frame=None):
+        """
+            Start or stop sampling as told by the shared sampling state, toggle sampling if there is none.
+            Workers use this as the handler of the profiling signal, so that a worker which missed a signal,
+            like a worker started after it, does not end up sampling while the others are not.
+        :return: None
+        """
+        if self.sampling_state is None:
+            self.toggle_sampling()
+        else:
+            self.set_sampling(self.sampling_state.value != 0)
+
+    def _profile_thread(self, curr_frame, event, arg):
+        """
+            Profile hook of the threads started by a profiled job, runs each of them under its own cProfile.
+            The hook is replaced by cProfile in the thread, after its first event.
+        """
+        thread_profile = cProfile.Profile()
+        with self.thread_profiles_lock:
+            self.thread_profiles.append(thread_profile)
+        thread_profile.enable()
+
+    def run(self, job_type, job_fn, *job_args):
+        """
+            Run a job, under cProfile if it is selected for profiling.
+        :param job_type: type of the job, profiles are kept per job type.
+        :param job_fn: function to run the job.
+        :param job_args: arguments to the function.
+        :return: return value of the function.
+        """
+        if not self.is_enabled():
+            return job_fn(*job_args)
+        self.curr_job_type = job_type
+        try:
+            if self.profile_fraction <= 0 or random.random() >= self.profile_fraction:
+                return job_fn(*job_args)
+            job_profile = cProfile.Profile()
+            self.thread_profiles = []
+            # cProfile only sees the thread it is enabled in, threads of the job get their own.
+            threading.setprofile(self._profile_thread)
+            try:
+                return job_profile.runcall(job_fn, *job_args)
+            finally:
+                threading.setprofile(None)
+                with self.thread_profiles_lock:
+                    all_profiles = [job_profile] + self.thread_profiles
+                    self.thread_profiles = []
+                self._add_profile(job_type, all_profiles)
+        finally:
+            self.curr_job_type = None
+            self.dump_if_due()
+
+    def _add_profile(self, job_type, all_profiles):
+        """
+            Add the profiles of a job to the profile of its job type and write it.
+        :param job_type: type of the job.
+        :param all_profiles: list of cProfile.Profile of the job and of the threads it started.
+        :return: None
+        """
+        try:
+            if job_type in self.job_stats:
+                self.job_stats[job_type].add(*all_profiles)
+            else:
+                self.job_stats[job_type] = pstats.Stats(*all_profiles)
+            # profiled jobs are few, write right away so that nothing is lost if we get killed.
+            self.job_stats[job_type].dump_stats(self._get_profile_path(job_type, CPROFILE_EXTENSION))
+        except Exception as e:
+            log_error("Error occurred while writing profile of job type:" + str(job_type) + ", Error:" + str(e))
+
+    def dump(self):
+        """
+            Write the stack samples of all the job types.
+        :return: None
+        """
+        self.last_dump_time = time.time()
+        with self.samples_lock:
+            all_samples = map(lambda curr_entry: (curr_entry[0], dict(curr_entry[1])), self.job_samples.items())
+        for job_type, curr_samples in all_samples:
+            target_path = self._get_profile_path(job_type, SAMPLES_EXTENSION)
+            try:
+                with open(target_path + '.tmp', 'w') as fp:
+                    for curr_stack, num_samples in sorted(curr_samples.items()):
+                        fp.write(curr_stack + ' ' + str(num_samples) + '\n')
+                os.rename(target_path + '.tmp', target_path)
+            except (IOError, OSError) as e:
+                log_error("Unable to write stack samples to:" + target_path + ", Error:" + str(e))
+
+    def dump_if_due(self):
+        """
+            Write the stack samples, if we are sampling and they were not written for a while.
+        :return: None
+        """
+        if self.is_sampling and time.time() - self.last_dump_time >= PROFILE_DUMP_INTERVAL:
+            self.dump()
+
+
+_profiler = None
+
+
+def get_profiler():
+    """
+        Get the profiler of the current process.
+    :return: Profiler
+    """
+    global _profiler
+    if _profiler is None or _profiler.process_name != str(os.getpid()):
+        # profiles of the parent are not ours to write.
+        _profiler = Profiler(PROFILE_DIR, PROFILE_FRACTION, PROFILE_SAMPLE_INTERVAL)
+    return _profiler
+
+
+def create_sampling_state():
+    """
+        Create the sampling state shared by the daemon and its workers.
+        Set by the daemon when it toggles sampling, and followed by the workers.
+    :return: multiprocessing.Value
+    """
+    # a single byte is written atomically, no lock that a dying process could hold.
+    return Value('b', int(PROFILE_SAMPLING), lock=False)
+
+
+def init_process_profiling(default_job_type=None, signal_handler=None, sampling_state=None):
+    """
+        Install the handler of the profiling signal in the current process.
+        Should be called once in each worker, when it starts.
+    :param default_job_type: job type of the stack samples taken outside of jobs, None to ignore them.
+    :param signal_handler: handler of the signal, defaults to following the sampling state.
+    :param sampling_state: sampling state shared with the daemon, None to toggle sampling on each signal.
+    :return: None
+    """
+    curr_profiler = get_profiler()
+    if not curr_profiler.is_enabled():
+        return
+    curr_profiler.default_job_type = default_job_type
+    curr_profiler.sampling_state = sampling_state
+    try:
+        os.makedirs(PROFILE_DIR)
+    except OSError:
+        # exists.
+        pass
+    signal.signal(PROFILE_SIGNAL, signal_handler or curr_profiler.sync_sampling)
+    if sampling_state is not None:
+        curr_profiler.set_sampling(sampling_state.value != 0)
+    elif PROFILE_SAMPLING:
+        curr_profiler.start_sampling()
+
+
+def profile_job(job_type, job_fn, *job_args):
+    """
+        Run a job under the profiler of the current process.
+    :param job_type: type of the job.
+    :param job_fn: function to run the job.
+    :param job_args: arguments to the function.
+    :return: return value of the function.
+    """
+    return get_profiler().run(job_type, job_fn, *job_args)
+
+
+def merge_profiles(profile_dir, job_type):
+    """
+        Merge the cProfile outputs of all the processes for the provided job type.
+        Folded stack samples can be merged by concatenating the files.
+    :param profile_dir: Directory with the profiles.
+    :param job_type: type of the job.
+    :return: pstats.Stats or None if there are no profiles.
+    """
+    all_paths = sorted(glob.glob(os.path.join(profile_dir, job_type + '.*' + CPROFILE_EXTENSION)))
+    if len(all_paths) == 0:
+        return None
+    merged_stats = pstats.Stats(all_paths[0])
+    for curr_path in all_paths[1:]:
+        merged_stats.add(curr_path)
+    return merged_stats
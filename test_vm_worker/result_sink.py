@@ -0,0 +1,230 @@
+import atexit
+import os
+import time
+from datetime import datetime
+from common_utils.simple_logging import log_info, log_error
+from metrics import get_metrics, job_phase
+
+# Number of buffered results after which they are written to the DB.
+RESULT_SINK_MAX_ROWS = int(os.environ.get('VM_WORKER_RESULT_SINK_MAX_ROWS', 50))
+# Time (in seconds) after which buffered results are written to the DB.
+RESULT_SINK_MAX_DELAY = float(os.environ.get('VM_WORKER_RESULT_SINK_MAX_DELAY', 2))
+# Number of buffered results kept while they can not be written, after which new results are refused.
+RESULT_SINK_MAX_PENDING = int(os.environ.get('VM_WORKER_RESULT_SINK_MAX_PENDING', 5000))
+# Time (in seconds) after a failed flush, before the buffered results are written again.
+RESULT_SINK_RETRY_DELAY = float(os.environ.get('VM_WORKER_RESULT_SINK_RETRY_DELAY', 5))
+# Maximum number of rows in one insert statement.
+INSERT_BATCH_SIZE = 100
+
+
+class ResultSink(object):
+    """
+    Write-behind buffer for job results.
+    Results and job completions are buffered in the process and written with
+    one insert per model and one update per job type, in a single transaction.
+    A job is marked completed in the same transaction which writes its results,
+    so it is never completed without its results.
+    Results which could not be written are kept and written again later. Once too
+    many of them are waiting, new results are refused, their jobs are not completed
+    and are run again.
+    """
+
+    def __init__(self, max_rows, max_delay, max_pending=RESULT_SINK_MAX_PENDING, retry_delay=RESULT_SINK_RETRY_DELAY):
+        """
+            Create a result sink.
+        :param max_rows: Number of buffered results after which they are flushed.
+        :param max_delay: Time (in seconds) after which buffered results are flushed.
+        :param max_pending: Number of buffered results after which new results are refused.
+        :param retry_delay: Time (in seconds) after a failed flush, before the results are flushed again.
+        :return: None
+        """
+        self.max_rows = max_rows
+        self.max_delay = max_delay
+        self.max_pending = max_pending
+        self.retry_delay = retry_delay
+        # model class -> list of row dicts, in insertion order of the models.
+        self.pending_rows = []
+        # job type -> list of job ids.
+        self.pending_completions = {}
+        self.num_pending = 0
+        self.oldest_pending_time = None
+        self.num_failed_flushes = 0
+        # time before which failed results are not written again, unless asked to.
+        self.retry_time = None
+        # number of successful writes, so that callers can tell whether results buffered earlier are written.
+        self.num_flushes = 0
+        # number of refused results, so that callers can tell whether some of their results are refused.
+        self.num_refused = 0
+
+    def _get_model_rows(self, model_class):
+        """
+            Get buffered rows of the provided model.
+        :param model_class: peewee model class.
+        :return: list of row dicts.
+        """
+        for curr_model, curr_rows in self.pending_rows:
+            if curr_model is model_class:
+                return curr_rows
+        curr_rows = []
+        self.pending_rows.append((model_class, curr_rows))
+        return curr_rows
+
+    def _can_add(self, num_rows=1):
+        """
+            Check if there is room for the provided number of results, writing the buffered results if needed.
+        :param num_rows: number of results to be buffered.
+        :return: True/False
+        """
+        if self.num_pending + num_rows <= self.max_pending or self.flush(force=False):
+            return True
+        self.num_refused += 1
+        get_metrics().inc('vm_worker_results_refused_total', {})
+        return False
+
+    def _on_added(self, num_rows=1):
+        """
+            Account for newly buffered results and flush, if needed.
+        :param num_rows: number of results buffered.
+        :return: None
+        """
+        if self.oldest_pending_time is None:
+            self.oldest_pending_time = time.time()
+        self.num_pending += num_rows
+        if self.num_pending >= self.max_rows:
+            self.flush(force=False)
+
+    def add(self, model_class, **row):
+        """
+            Buffer a row to be created.
+        :param model_class: peewee model class of the row.
+        :param row: field values of the row.
+        :return: True if the row is buffered else False.
+        """
+        if not self._can_add():
+            log_error("Refusing result of " + model_class.__name__ + " as " + str(self.num_pending) +
+                      " buffered results can not be written.")
+            return False
+        self._get_model_rows(model_class).append(row)
+        self._on_added()
+        return True
+
+    def complete_job(self, target_job):
+        """
+            Buffer completion of the provided job, it is marked completed along with the results buffered so far.
+            If it is refused, the job is not completed and is run again.
+        :param target_job: job to be marked completed.
+        :return: True if the completion is buffered else False.
+        """
+        if not self._can_add():
+            log_error("Not completing " + type(target_job).__name__ + ":" + str(target_job.id) + " as " +
+                      str(self.num_pending) + " buffered results can not be written.")
+            return False
+        self.pending_completions.setdefault(type(target_job), []).append(target_job.id)
+        self._on_added()
+        return True
+
+    def complete_job_with_result(self, target_job, model_class, **row):
+        """
+            Buffer a result of the provided job along with its completion.
+            Either both are buffered or none is, so that a job which is run again does not leave a result behind.
+        :param target_job: job to be marked completed.
+        :param model_class: peewee model class of the result.
+        :param row: field values of the result.
+        :return: True if they are buffered else False.
+        """
+        if not self._can_add(2):
+            log_error("Not completing " + type(target_job).__name__ + ":" + str(target_job.id) + " as " +
+                      str(self.num_pending) + " buffered results can not be written.")
+            return False
+        self._get_model_rows(model_class).append(row)
+        self.pending_completions.setdefault(type(target_job), []).append(target_job.id)
+        self._on_added(2)
+        return True
+
+    def is_flush_due(self):
+        """
+            Check if the buffered results are waiting for longer than the maximum delay.
+        :return: True/False
+        """
+        return self.oldest_pending_time is not None and time.time() - self.oldest_pending_time >= self.max_delay
+
+    def flush_if_due(self):
+        """
+            Flush the buffered results, if they are waiting for longer than the maximum delay.
+        :return: None
+        """
+        if self.is_flush_due():
+            self.flush(force=False)
+
+    def _clear(self):
+        """
+            Drop all the buffered results.
+        :return: None
+        """
+        self.pending_rows = []
+        self.pending_completions = {}
+        self.num_pending = 0
+        self.oldest_pending_time = None
+        self.num_failed_flushes = 0
+        self.retry_time = None
+
+    def _write(self):
+        """
+            Write all the buffered results in a single transaction.
+        :return: None
+        """
+        all_models = map(lambda curr_entry: curr_entry[0], self.pending_rows) + self.pending_completions.keys()
+        with all_models[0]._meta.database.atomic():
+            for model_class, curr_rows in self.pending_rows:
+                for i in range(0, len(curr_rows), INSERT_BATCH_SIZE):
+                    model_class.insert_many(curr_rows[i:i + INSERT_BATCH_SIZE]).execute()
+            completed_time = datetime.now()
+            for job_type, job_ids in self.pending_completions.items():
+                job_type.update(completed_at=completed_time).where(job_type.id << job_ids).execute()
+
+    def flush(self, force=True):
+        """
+            Write all the buffered results to the DB.
+            On failure, results are kept and written with the next flush.
+        :param force: flag to indicate whether to write even if a failed write is to be retried later.
+        :return: True if all the results are written else False.
+        """
+        if self.num_pending == 0:
+            return True
+        if not force and self.retry_time is not None and time.time() < self.retry_time:
+            return False
+        try:
+            with job_phase('all', 'result_write'):
+                self._write()
+            log_info("Wrote " + str(self.num_pending) + " buffered results.")
+            get_metrics().inc('vm_worker_results_written_total', {}, self.num_pending)
+            self._clear()
+            self.num_flushes += 1
+            return True
+        except Exception as e:
+            get_metrics().inc('vm_worker_result_write_failures_total', {})
+            self.num_failed_flushes += 1
+            self.retry_time = time.time() + self.retry_delay
+            log_error("Error occurred while writing " + str(self.num_pending) + " buffered results, tried " +
+                      str(self.num_failed_flushes) + " times, Error:" + str(e))
+        return False
+
+
+_result_sink = None
+_result_sink_pid = None
+
+
+def get_result_sink():
+    """
+        Get the result sink of the current process.
+        Results are written when the process exits, if they are not written before.
+    :return: ResultSink
+    """
+    global _result_sink
+    global _result_sink_pid
+    if _result_sink is None or _result_sink_pid != os.getpid():
+        # buffers of the parent, if any, are not ours to write.
+        _result_sink = ResultSink(RESULT_SINK_MAX_ROWS, RESULT_SINK_MAX_DELAY)
+        _result_sink_pid = os.getpid()
+        atexit.register(_result_sink.flush)
+    return _result_sink
@@ -0,0 +1,221 @@
+import os
+import signal
+import threading
+import time
+from contextlib import contextmanager
+from common_utils.simple_logging import log_error
+from metrics import get_metrics
+
+
+def _parse_budgets(budgets_str):
+    """
+        Parse the time budgets of the job types.
+    :param budgets_str: str like pov_tester=1200,cb_tester=1800
+    :return: dict of job type -> time (in seconds)
+    """
+    all_budgets = {}
+    for curr_item in budgets_str.split(','):
+        if len(curr_item.strip()) == 0:
+            continue
+        try:
+            job_type, time_budget = curr_item.split('=')
+            all_budgets[job_type.strip()] = float(time_budget)
+        except ValueError:
+            log_error("Ignoring invalid time budget:" + curr_item)
+    return all_budgets
+
+
+# Time (in seconds) after which a single cb-test run is killed along with its children, 0 for no limit.
+THROW_TIME_BUDGET = float(os.environ.get('VM_WORKER_THROW_TIME_BUDGET', 300))
+# Time (in seconds) within which a job of each type should finish, 0 or missing for no limit.
+# cb-test runs after the budget is spent are not started, and the ones running are killed.
+JOB_TIME_BUDGETS = _parse_budgets(os.environ.get('VM_WORKER_JOB_TIME_BUDGETS',
+                                                 'pov_tester=1200,cb_tester=1800,poll_creator=600,'
+                                                 'network_poll_sanitizer=600'))
+# Job types whose grouped jobs are run in parallel by the threads of the task, sharing a budget per round.
+# Grouped jobs of the other job types are run one after the other, each with a budget of its own.
+PARALLEL_GROUP_JOB_TYPES = ['network_poll_sanitizer']
+# Time (in seconds) over the budget of a job, after which the daemon stops the worker running it.
+JOB_STOP_GRACE = float(os.environ.get('VM_WORKER_JOB_STOP_GRACE', 60))
+# Time (in seconds) given to a worker to stop a job which ran out of time, after which the worker is killed.
+JOB_TERMINATE_GRACE = float(os.environ.get('VM_WORKER_JOB_TERMINATE_GRACE', 10))
+# Smallest timeout of a cb-test run, so that runs started right at the end of the budget are killed right away.
+MIN_THROW_TIMEOUT = 0.01
+
+# Result and error code recorded for jobs and cb-test runs, which ran out of time.
+TIMEOUT_RESULT = 'timeout'
+TIMEOUT_ERROR_CODE = -signal.SIGKILL
+
+
+class JobBudget(object):
+    """
+    Time budget of the job being run by a worker.
+    Every cb-test run of the job gets the smaller of the per run budget and the
+    time left for the job. Runs killed on expiry are counted, so that the job can
+    record a timeout result instead of a regular failure.
+    """
+
+    def __init__(self, job_type, time_budget, throw_budget):
+        """
+            Start the budget of a job.
+        :param job_type: type of the job.
+        :param time_budget: Time (in seconds) within which the job should finish, 0 for no limit.
+        :param throw_budget: Time (in seconds) after which a single cb-test run is killed, 0 for no limit.
+        :return: None
+        """
+        self.job_type = job_type
+        self.deadline = None
+        if time_budget > 0:
+            self.deadline = time.time() + time_budget
+        self.throw_budget = throw_budget
+        # number of cb-test runs that ran out of time, updated by the throw threads.
+        self.num_timeouts = 0
+        # thread ident -> number of cb-test runs of the thread that ran out of time.
+        self.thread_timeouts = {}
+        self.timeouts_lock = threading.Lock()
+
+    def is_expired(self):
+        """
+            Check if the job used up its budget.
+        :return: True/False
+        """
+        return self.deadline is not None and time.time() >= self.deadline
+
+    def get_throw_timeout(self):
+        """
+            Get the time after which a cb-test run started now should be killed.
+        :return: Time (in seconds) or None for no limit.
+        """
+        all_limits = []
+        if self.throw_budget > 0:
+            all_limits.append(self.throw_budget)
+        if self.deadline is not None:
+            all_limits.append(self.deadline - time.time())
+        if len(all_limits) == 0:
+            return None
+        return max(min(all_limits), MIN_THROW_TIMEOUT)
+
+    def on_timeout(self):
+        """
+            Account for a cb-test run, which was killed or not started as the budget was used up.
+        :return: None
+        """
+        curr_thread = threading.current_thread().ident
+        with self.timeouts_lock:
+            self.num_timeouts += 1
+            self.thread_timeouts[curr_thread] = self.thread_timeouts.get(curr_thread, 0) + 1
+        get_metrics().inc('vm_worker_timeouts_total', {'job_type': self.job_type, 'scope': 'throw'})
+
+    def get_thread_timeouts(self):
+        """
+            Get number of cb-test runs of the current thread, which ran out of time.
+            Lets jobs run in parallel by one process tell which of them timed out.
+        :return: Number of runs.
+        """
+        with self.timeouts_lock:
+            return self.thread_timeouts.get(threading.current_thread().ident, 0)
+
+    def is_timed_out(self):
+        """
+            Check if any cb-test run of the job ran out of time.
+        :return: True/False
+        """
+        return self.num_timeouts > 0
+
+
+# budget of the job being run by this process, a worker runs one job at a time.
+_curr_budget = None
+
+
+def get_job_time_budget(job_type):
+    """
+        Get the time budget of the provided job type.
+    :param job_type: type of the job.
+    :return: Time (in seconds), 0 for no limit.
+    """
+    return JOB_TIME_BUDGETS.get(job_type, 0)
+
+
+def get_num_rounds(num_jobs, num_threads):
+    """
+        Get number of rounds in which the provided number of jobs are run by the provided number of threads.
+    :param num_jobs: number of jobs.
+    :param num_threads: number of threads running the jobs in parallel.
+    :return: number of rounds.
+    """
+    num_threads = max(1, min(num_threads, num_jobs))
+    return max(1, (num_jobs + num_threads - 1) / num_threads)
+
+
+def get_task_time_limit(job_type, num_jobs=1, num_threads=1):
+    """
+        Get the time after which the daemon should stop a worker running a task of the provided job type.
+    :param job_type: type of the jobs.
+    :param num_jobs: number of jobs in the task.
+    :param num_threads: number of threads of the task, they run the jobs in parallel only for
+                        PARALLEL_GROUP_JOB_TYPES.
+    :return: Time (in seconds) or None for no limit.
+    """
+    time_budget = get_job_time_budget(job_type)
+    if time_budget <= 0:
+        return None
+    if job_type not in PARALLEL_GROUP_JOB_TYPES:
+        num_threads = 1
+    return time_budget * get_num_rounds(num_jobs, num_threads) + JOB_STOP_GRACE
+
+
+@contextmanager
+def job_budget(job_type, num_rounds=1):
+    """
+        Run the cb-tests in the block under the time budget of the provided job type.
+    :param job_type: type of the job.
+    :param num_rounds: number of jobs run one after the other in the block, they share a budget of that many jobs.
+    :return: JobBudget
+    """
+    global _curr_budget
+    _curr_budget = JobBudget(job_type, get_job_time_budget(job_type) * num_rounds, THROW_TIME_BUDGET)
+    try:
+        yield _curr_budget
+    finally:
+        _curr_budget = None
+
+
+def is_budget_expired():
+    """
+        Check if the job being run used up its budget.
+    :return: True/False
+    """
+    return _curr_budget is not None and _curr_budget.is_expired()
+
+
+def get_thread_timeouts():
+    """
+        Get number of cb-test runs of the current thread, which ran out of time in the job being run.
+    :return: Number of runs.
+    """
+    if _curr_budget is None:
+        return 0
+    return _curr_budget.get_thread_timeouts()
+
+
+def get_throw_timeout():
+    """
+        Get the time after which a cb-test run started now should be killed.
+    :return: Time (in seconds) or None for no limit.
+    """
+    if _curr_budget is not None:
+        return _curr_budget.get_throw_timeout()
+    if THROW_TIME_BUDGET > 0:
+        return THROW_TIME_BUDGET
+    return None
+
+
+def on_throw_timeout():
+    """
+        Account for a cb-test run, which was killed as it ran out of time.
+    :return: None
+    """
+    if _curr_budget is not None:
+        _curr_budget.on_timeout()
+    else:
+        get_metrics().inc('vm_worker_timeouts_total', {'job_type': 'unknown', 'scope': 'throw'})
@@ -0,0 +1,523 @@
+from common_utils.simple_logging import log_info, log_success, log_failure, log_error
+from farnsworth_api_wrapper import CRSAPIWrapper
+from metrics import get_metrics
+from profiling import get_profiler, profile_job
+from result_sink import get_result_sink
+from workspace import get_workspace_manager
+import collections
+import errno
+import multiprocessing
+import os
+import resource
+import select
+import signal
+import time
+import traceback
+
+# Number of jobs after which a worker is replaced with a fresh one.
+WORKER_MAX_JOBS = int(os.environ.get('VM_WORKER_MAX_JOBS_PER_WORKER', 200))
+# RSS (in MB) after which a worker is replaced with a fresh one, 0 to disable.
+WORKER_MAX_RSS_MB = int(os.environ.get('VM_WORKER_MAX_RSS_MB', 2048))
+# Time (in seconds) a worker waits for its next task, before it writes the buffered results.
+WORKER_IDLE_FLUSH_DELAY = float(os.environ.get('VM_WORKER_IDLE_FLUSH_DELAY', 0.05))
+
+
+def _get_rss_mb():
+    """
+        Get current resident set size of this process.
+    :return: RSS in MB
+    """
+    try:
+        with open('/proc/self/statm', 'r') as fp:
+            rss_pages = int(fp.read().split()[1])
+        return (rss_pages * resource.getpagesize()) / (1024 * 1024)
+    except (IOError, ValueError, IndexError):
+        # peak rss, in KB on linux.
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def _send_metrics(worker_conn, worker_pid):
+    """
+        Send the metrics collected by this worker since the last time, to the pool.
+    :param worker_conn: Connection to the pool, to which the metrics are written.
+    :param worker_pid: pid of this worker.
+    :return: None
+    """
+    metrics_snapshot = get_metrics().drain()
+    if metrics_snapshot is not None:
+        worker_conn.send((WarmWorkerPool.METRICS_REPORTED, None, worker_pid, metrics_snapshot))
+
+
+def _report_flushed_tasks(worker_conn, worker_pid, unflushed_tasks):
+    """
+        Tell the pool about the finished tasks, whose results are written to the DB.
+    :param worker_conn: Connection to the pool, to which the flushed tasks are written.
+    :param worker_pid: pid of this worker.
+    :param unflushed_tasks: list of (task id, is any result refused, number of writes of the result sink when
+                            the task finished), from which the flushed tasks are removed.
+    :return: None
+    """
+    result_sink = get_result_sink()
+    flushed_tasks = filter(lambda curr_task: result_sink.num_pending == 0 or result_sink.num_flushes > curr_task[2],
+                           unflushed_tasks)
+    if len(flushed_tasks) > 0:
+        for curr_task in flushed_tasks:
+            unflushed_tasks.remove(curr_task)
+        worker_conn.send((WarmWorkerPool.TASKS_FLUSHED, None, worker_pid,
+                          map(lambda curr_task: (curr_task[0], curr_task[1]), flushed_tasks)))
+
+
+def _get_job_type(job_processor):
+    """
+        Get type of the jobs processed by the provided job processor, i.e., name of its package.
+    :param job_processor: function to process the job.
+    :return: job type, like pov_tester
+    """
+    return getattr(job_processor, '__module__', 'unknown').split('.')[-1]
+
+
+def _should_recycle(worker_pid, num_jobs, max_jobs, max_rss_mb):
+    """
+        Check if a worker should be replaced with a fresh one.
+    :param worker_pid: pid of the worker.
+    :param num_jobs: Number of jobs run by the worker.
+    :param max_jobs: Number of jobs after which the worker should exit.
+    :param max_rss_mb: RSS after which the worker should exit.
+    :return: True/False
+    """
+    if 0 < max_jobs <= num_jobs:
+        log_info("Recycling worker:" + str(worker_pid) + " after " + str(num_jobs) + " jobs.")
+        return True
+    if max_rss_mb > 0:
+        curr_rss = _get_rss_mb()
+        if curr_rss >= max_rss_mb:
+            log_info("Recycling worker:" + str(worker_pid) + " as RSS reached " + str(curr_rss) + "MB.")
+            return True
+    return False
+
+
+def _on_terminate(signum, curr_frame):
+    """
+        Handler of SIGTERM in a worker, unwinds the running job so that the buffered results are written.
+    """
+    # not an Exception, so that the job processors do not catch it.
+    raise SystemExit(1)
+
+
+def _worker_main(worker_conn, worker_index, max_jobs, max_rss_mb, initializer, initargs):
+    """
+        Main loop of a warm worker process.
+        Keeps running the jobs handed over by the pool, until it is asked to stop or it needs to be recycled.
+    :param worker_conn: Connection to the pool, from which (task id, job processor, job args) are read and
+                        to which the status of the tasks is written.
+    :param worker_index: index of this worker in the pool, reused by its replacement.
+    :param max_jobs: Number of jobs after which this worker should exit.
+    :param max_rss_mb: RSS after which this worker should exit.
+    :param initializer: function to be called once with (worker index, *initargs), when the worker starts.
+    :param initargs: arguments to the initializer.
+    :return: None
+    """
+    curr_pid = os.getpid()
+    signal.signal(signal.SIGTERM, _on_terminate)
+    if initializer is not None:
+        initializer(worker_index, *initargs)
+    # keep the connection across jobs.
+    CRSAPIWrapper.set_persistent_connection(True)
+    num_jobs = 0
+    # finished tasks, whose results are not yet written.
+    unflushed_tasks = []
+    try:
+        while True:
+            # the pool hands over the next task as soon as it knows the previous one is done.
+            if not worker_conn.poll(WORKER_IDLE_FLUSH_DELAY):
+                # nothing to do, good time to write the buffered results.
+                CRSAPIWrapper.flush_results(force=False)
+                _report_flushed_tasks(worker_conn, curr_pid, unflushed_tasks)
+            curr_task = worker_conn.recv()
+            if curr_task is None:
+                break
+            task_id, job_processor, job_args = curr_task
+            worker_conn.send((WarmWorkerPool.TASK_STARTED, task_id, curr_pid, None))
+            task_error = None
+            num_refused = get_result_sink().num_refused
+            try:
+                profile_job(_get_job_type(job_processor), job_processor, job_args)
+            except Exception as e:
+                task_error = str(e)
+                log_error("Error occurred while running task:" + str(task_id) + " in worker:" + str(curr_pid) +
+                          ", Error:" + traceback.format_exc())
+                # connection might be in a bad state, reconnect on the next job.
+                CRSAPIWrapper.reset_connection()
+            num_jobs += 1
+            is_recycled = _should_recycle(curr_pid, num_jobs, max_jobs, max_rss_mb)
+            if is_recycled:
+                # before the task is done, so that the pool does not hand over another task to us.
+                worker_conn.send((WarmWorkerPool.WORKER_STOPPING, None, curr_pid, None))
+            worker_conn.send((WarmWorkerPool.TASK_DONE, task_id, curr_pid, task_error))
+            unflushed_tasks.append((task_id, get_result_sink().num_refused > num_refused,
+                                    get_result_sink().num_flushes))
+            CRSAPIWrapper.flush_results_if_due()
+            _report_flushed_tasks(worker_conn, curr_pid, unflushed_tasks)
+            _send_metrics(worker_conn, curr_pid)
+            if is_recycled:
+                break
+    finally:
+        CRSAPIWrapper.set_persistent_connection(False)
+        CRSAPIWrapper.flush_results()
+        _report_flushed_tasks(worker_conn, curr_pid, unflushed_tasks)
+        CRSAPIWrapper.reset_connection()
+        # the trash of our jobs would be left behind, if we exit before it is deleted.
+        get_workspace_manager().drain()
+        _send_metrics(worker_conn, curr_pid)
+        get_profiler().stop_sampling()
+        worker_conn.send((WarmWorkerPool.WORKER_EXITED, None, curr_pid, None))
+
+
+class WarmWorkerPool(object):
+    """
+    Pool of long lived worker processes.
+    Workers keep their imports and DB connection between jobs and are replaced
+    after a configurable number of jobs or amount of RSS.
+    Every worker has its own connection to the pool and is handed one task at a
+    time, so that the pool always knows the task a worker is running, even if it
+    dies right after taking it. Locks shared by the workers are given back by
+    the kernel, so a worker which dies can not block the others.
+    Results of a finished task may still be buffered in its worker, workers report
+    the tasks whose results are written, so that their jobs are not let go before.
+    """
+
+    TASK_STARTED = 'started'
+    TASK_DONE = 'done'
+    WORKER_EXITED = 'exited'
+    WORKER_STOPPING = 'stopping'
+    METRICS_REPORTED = 'metrics'
+    TASKS_FLUSHED = 'flushed'
+
+    def __init__(self, num_workers, max_jobs_per_worker=WORKER_MAX_JOBS, max_rss_mb=WORKER_MAX_RSS_MB,
+                 initializer=None, initargs=(), on_worker_exit=None):
+        """
+            Create a pool of warm workers.
+        :param num_workers: Number of worker processes.
+        :param max_jobs_per_worker: Number of jobs after which a worker is recycled, 0 to disable.
+        :param max_rss_mb: RSS after which a worker is recycled, 0 to disable.
+        :param initializer: function to be called once in each worker with (worker index, *initargs), when it starts.
+        :param initargs: arguments to the initializer.
+        :param on_worker_exit: function to be called in the pool with the worker index, after a worker exited.
+        :return: None
+        """
+        self.num_workers = num_workers
+        self.max_jobs_per_worker = max_jobs_per_worker
+        self.max_rss_mb = max_rss_mb
+        self.initializer = initializer
+        self.initargs = initargs
+        self.on_worker_exit = on_worker_exit
+        # pid -> Process
+        self.workers = {}
+        # pid -> worker index
+        self.worker_indexes = {}
+        # pid -> connection to the worker, until the worker closes it.
+        self.worker_conns = {}
+        # pids of the workers, which are exiting and should not be handed any task.
+        self.stopping_workers = set()
+        # (task id, job processor, job args) of tasks that are submitted but not handed to any worker.
+        self.backlog = collections.deque()
+        # pid -> task id, for tasks that are handed to the workers and are not finished.
+        self.running_tasks = {}
+        # task id -> time at which it started running, for tasks that are currently running.
+        self.task_start_times = {}
+        # ids of tasks that are submitted but not finished.
+        self.pending_tasks = set()
+        # pid -> ids of tasks that are finished by the worker, but whose results are not yet written.
+        self.unflushed_tasks = {}
+        # (task id, should retry) of finished tasks, whose results are written or lost.
+        self.flushed_tasks = []
+        self.next_task_id = 0
+        self.is_shutdown = False
+        for worker_index in range(self.num_workers):
+            self._start_worker(worker_index)
+
+    def _start_worker(self, worker_index):
+        """
+            Start a new worker process.
+        :param worker_index: index of the worker in the pool.
+        :return: None
+        """
+        pool_conn, worker_conn = multiprocessing.Pipe()
+        new_worker = multiprocessing.Process(target=_worker_main,
+                                             args=(worker_conn, worker_index, self.max_jobs_per_worker,
+                                                   self.max_rss_mb, self.initializer, self.initargs))
+        new_worker.daemon = True
+        new_worker.start()
+        # only the worker holds its end, so that we see the connection closed once it dies.
+        worker_conn.close()
+        self.workers[new_worker.pid] = new_worker
+        self.worker_indexes[new_worker.pid] = worker_index
+        self.worker_conns[new_worker.pid] = pool_conn
+
+    def _send_task(self, worker_pid, curr_task):
+        """
+            Send a task or the request to exit (None) to a worker.
+        :param worker_pid: pid of the worker.
+        :param curr_task: (task id, job processor, job args) or None.
+        :return: True if the worker got it else False.
+        """
+        if worker_pid not in self.worker_conns:
+            return False
+        try:
+            self.worker_conns[worker_pid].send(curr_task)
+            return True
+        except (IOError, OSError):
+            # died, it will be reaped.
+            self.stopping_workers.add(worker_pid)
+            return False
+
+    def _assign_tasks(self):
+        """
+            Hand the submitted tasks to the idle workers.
+            After shutdown, idle workers are asked to exit once there are no more tasks.
+        :return: None
+        """
+        for worker_pid in self.workers.keys():
+            if worker_pid in self.running_tasks or worker_pid in self.stopping_workers:
+                continue
+            if len(self.backlog) > 0:
+                curr_task = self.backlog.popleft()
+                if self._send_task(worker_pid, curr_task):
+                    self.running_tasks[worker_pid] = curr_task[0]
+                else:
+                    self.backlog.appendleft(curr_task)
+            elif self.is_shutdown:
+                self.stopping_workers.add(worker_pid)
+                self._send_task(worker_pid, None)
+
+    def _reap_worker(self, worker_pid, completed_tasks):
+        """
+            Clean up an exited worker and start a replacement.
+        :param worker_pid: pid of the worker that exited.
+        :param completed_tasks: list to which the task killed with the worker (if any) is added.
+        :return: None
+        """
+        curr_worker = self.workers.pop(worker_pid, None)
+        if curr_worker is None:
+            # already reaped.
+            return
+        curr_worker.join()
+        if worker_pid in self.worker_conns:
+            self.worker_conns.pop(worker_pid).close()
+        self.stopping_workers.discard(worker_pid)
+        worker_index = self.worker_indexes.pop(worker_pid)
+        if self.on_worker_exit is not None:
+            self.on_worker_exit(worker_index)
+        if worker_pid in self.running_tasks:
+            task_id = self.running_tasks.pop(worker_pid)
+            self.pending_tasks.discard(task_id)
+            self.task_start_times.pop(task_id, None)
+            log_failure("Worker:" + str(worker_pid) + " died while running task:" + str(task_id))
+            completed_tasks.append((task_id, "Worker died"))
+            self.flushed_tasks.append((task_id, True))
+        for task_id in self.unflushed_tasks.pop(worker_pid, set()):
+            # results of the tasks, which the worker did not write, are lost.
+            log_failure("Worker:" + str(worker_pid) + " exited without writing results of task:" + str(task_id))
+            self.flushed_tasks.append((task_id, True))
+        if not self.is_shutdown or len(self.backlog) > 0:
+            self._start_worker(worker_index)
+        self._assign_tasks()
+
+    def _handle_message(self, curr_msg, completed_tasks):
+        """
+            Handle a message from a worker.
+        :param curr_msg: (message type, task id, worker pid, error or metrics or flushed tasks)
+        :param completed_tasks: list to which completed tasks are added.
+        :return: None
+        """
+        msg_type, task_id, worker_pid, task_error = curr_msg
+        if msg_type == WarmWorkerPool.TASK_STARTED:
+            self.task_start_times[task_id] = time.time()
+        elif msg_type == WarmWorkerPool.TASK_DONE:
+            self.running_tasks.pop(worker_pid, None)
+            self.task_start_times.pop(task_id, None)
+            if task_id in self.pending_tasks:
+                self.pending_tasks.remove(task_id)
+                completed_tasks.append((task_id, task_error))
+                self.unflushed_tasks.setdefault(worker_pid, set()).add(task_id)
+            self._assign_tasks()
+        elif msg_type == WarmWorkerPool.WORKER_STOPPING:
+            self.stopping_workers.add(worker_pid)
+        elif msg_type == WarmWorkerPool.WORKER_EXITED:
+            self._reap_worker(worker_pid, completed_tasks)
+        elif msg_type == WarmWorkerPool.METRICS_REPORTED:
+            get_metrics().merge(task_error)
+        elif msg_type == WarmWorkerPool.TASKS_FLUSHED:
+            for task_id, is_refused in task_error:
+                if task_id in self.unflushed_tasks.get(worker_pid, set()):
+                    self.unflushed_tasks[worker_pid].remove(task_id)
+                    self.flushed_tasks.append((task_id, is_refused))
+
+    def _receive_from_worker(self, worker_pid, completed_tasks):
+        """
+            Handle all the messages a worker sent so far.
+            Once the worker closed its connection, it is reaped.
+        :param worker_pid: pid of the worker.
+        :param completed_tasks: list to which completed tasks are added.
+        :return: None
+        """
+        while worker_pid in self.worker_conns:
+            curr_conn = self.worker_conns[worker_pid]
+            try:
+                if not curr_conn.poll():
+                    return
+                curr_msg = curr_conn.recv()
+            except (EOFError, IOError):
+                # exited or died, possibly half way through a message.
+                self.worker_conns.pop(worker_pid).close()
+                self._reap_worker(worker_pid, completed_tasks)
+                return
+            self._handle_message(curr_msg, completed_tasks)
+
+    def _receive(self, timeout, completed_tasks):
+        """
+            Wait for messages from the workers and handle them.
+        :param timeout: Maximum time (in seconds) to wait for a message.
+        :param completed_tasks: list to which completed tasks are added.
+        :return: None
+        """
+        worker_pids = dict(map(lambda curr_item: (curr_item[1].fileno(), curr_item[0]), self.worker_conns.items()))
+        try:
+            ready_fds = select.select(worker_pids.keys(), [], [], timeout)[0]
+        except select.error as e:
+            if e.args[0] != errno.EINTR:
+                raise
+            # interrupted by a signal, the caller waits again.
+            return
+        for curr_fd in ready_fds:
+            self._receive_from_worker(worker_pids[curr_fd], completed_tasks)
+
+    def _check_workers(self, completed_tasks):
+        """
+            Replace workers that died without telling us (for ex: OOM killed).
+        :param completed_tasks: list to which the tasks killed with the workers are added.
+        :return: None
+        """
+        for worker_pid in list(self.workers.keys()):
+            if worker_pid in self.workers and not self.workers[worker_pid].is_alive():
+                # handle whatever the worker managed to send before dying.
+                self._receive_from_worker(worker_pid, completed_tasks)
+                self._reap_worker(worker_pid, completed_tasks)
+
+    def signal_workers(self, signum):
+        """
+            Send the provided signal to all the workers.
+        :param signum: signal number.
+        :return: None
+        """
+        for worker_pid in list(self.workers.keys()):
+            try:
+                os.kill(worker_pid, signum)
+            except OSError:
+                # already exited, it will be reaped.
+                pass
+
+    def get_running_time(self, task_id):
+        """
+            Get the time for which the provided task is running.
+        :param task_id: id of the task.
+        :return: Time (in seconds) or None if the task is not running.
+        """
+        if task_id not in self.task_start_times:
+            return None
+        return time.time() - self.task_start_times[task_id]
+
+    def signal_task(self, task_id, signum):
+        """
+            Send the provided signal to the worker running the provided task.
+        :param task_id: id of the task.
+        :param signum: signal number.
+        :return: True if the signal was sent else False.
+        """
+        for worker_pid, curr_task_id in self.running_tasks.items():
+            if curr_task_id == task_id:
+                try:
+                    os.kill(worker_pid, signum)
+                    return True
+                except OSError:
+                    # already exited, it will be reaped.
+                    pass
+        return False
+
+    def submit(self, job_processor, job_args):
+        """
+            Submit a job to be run by one of the workers.
+        :param job_processor: function (should be picklable) to process the job.
+        :param job_args: arguments to the job processor.
+        :return: id of the task.
+        """
+        task_id = self.next_task_id
+        self.next_task_id += 1
+        self.pending_tasks.add(task_id)
+        self.backlog.append((task_id, job_processor, job_args))
+        self._assign_tasks()
+        return task_id
+
+    def drain_flushed_tasks(self):
+        """
+            Get the finished tasks whose results are written (or lost), since the last time.
+        :return: list of (task id, should retry), should retry is True if some of the results are not written.
+        """
+        flushed_tasks = self.flushed_tasks
+        self.flushed_tasks = []
+        return flushed_tasks
+
+    def num_pending(self):
+        """
+            Get number of tasks submitted but not yet finished.
+        :return: number of tasks
+        """
+        return len(self.pending_tasks)
+
+    def wait_completed(self, timeout=None):
+        """
+            Wait for at least one task to finish or to have its results written.
+        :param timeout: Maximum time (in seconds) to wait, None to wait forever.
+        :return: list of (task id, error) of finished tasks, error is None on success.
+        """
+        completed_tasks = []
+        num_flushed = len(self.flushed_tasks)
+        end_time = None if timeout is None else time.time() + timeout
+        while len(completed_tasks) == 0 and len(self.flushed_tasks) == num_flushed:
+            # wake up periodically to check for dead workers.
+            curr_timeout = 1
+            if end_time is not None:
+                curr_timeout = max(min(end_time - time.time(), 1), 0)
+            self._receive(curr_timeout, completed_tasks)
+            self._check_workers(completed_tasks)
+            if end_time is not None and time.time() >= end_time:
+                break
+        return completed_tasks
+
+    def map(self, job_processor, all_job_args):
+        """
+            Run the job processor on all the provided args and wait for all of them to finish.
+        :param job_processor: function (should be picklable) to process the job.
+        :param all_job_args: list of job args.
+        :return: None
+        """
+        for curr_job_args in all_job_args:
+            self.submit(job_processor, curr_job_args)
+        while self.num_pending() > 0:
+            self.wait_completed()
+            # nobody holds on to the jobs, until their results are written.
+            self.drain_flushed_tasks()
+
+    def shutdown(self):
+        """
+            Stop all the workers, after they finish the already submitted tasks.
+        :return: None
+        """
+        self.is_shutdown = True
+        self._assign_tasks()
+        # keep draining the results, otherwise workers can block on exit.
+        while len(self.workers) > 0:
+            completed_tasks = []
+            self._receive(1, completed_tasks)
+            self._check_workers(completed_tasks)
+        log_success("Shutdown worker pool.")
@@ -0,0 +1,215 @@
+import os
+import errno
+import shutil
+import tempfile
+import threading
+import Queue
+from common_utils.simple_logging import log_info, log_error
+
+# RAM backed directory for workspaces, used as long as there is enough free memory.
+WORKSPACE_RAM_ROOT = os.environ.get('VM_WORKER_WORKSPACE_RAM_ROOT', '/dev/shm/vm_worker_workspaces')
+WORKSPACE_DISK_ROOT = os.environ.get('VM_WORKER_WORKSPACE_DISK_ROOT',
+                                     os.path.join(os.path.expanduser("~"), 'vm_worker_workspaces'))
+# Free memory (in MB) below which workspaces are created on disk.
+WORKSPACE_MIN_FREE_RAM_MB = int(os.environ.get('VM_WORKER_WORKSPACE_MIN_FREE_RAM_MB', 1024))
+
+
+def make_dir(dir_path):
+    """
+        Create the provided directory (and its parents), if it does not exist.
+    :param dir_path: directory to create.
+    :return: dir_path
+    """
+    try:
+        os.makedirs(dir_path)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+    return dir_path
+
+
+def _is_pid_alive(target_pid):
+    """
+        Check if a process with the provided pid exists.
+    :param target_pid: pid to check.
+    :return: True/False
+    """
+    try:
+        os.kill(target_pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
+
+
+def _get_available_memory_mb():
+    """
+        Get available memory of the system.
+    :return: Available memory in MB or None, if it can not be determined.
+    """
+    try:
+        with open('/proc/meminfo', 'r') as fp:
+            for curr_line in fp:
+                if curr_line.startswith('MemAvailable:'):
+                    return int(curr_line.split()[1]) / 1024
+    except (IOError, ValueError, IndexError):
+        pass
+    return None
+
+
+class WorkspaceManager(object):
+    """
+    Creates job workspaces in-process, preferably on a RAM backed mount.
+    Released workspaces are renamed into a trash directory and deleted by a
+    background reaper thread, off the critical path of the job. The thread dies
+    with its process, so processes wait for it to finish before they exit, and
+    workspaces and trash of processes which died are deleted by the daemon.
+    """
+
+    TRASH_DIR_NAME = '.trash'
+    # workspace names are <prefix>.<pid>.<random>, pid is used to find workspaces of dead processes.
+    NAME_SEPARATOR = '.'
+
+    def __init__(self, ram_root, disk_root, min_free_ram_mb):
+        """
+            Create a workspace manager.
+        :param ram_root: RAM backed directory for workspaces.
+        :param disk_root: Directory for workspaces, when there is not enough free memory.
+        :param min_free_ram_mb: Free memory (in MB) below which workspaces are created on disk.
+        :return: None
+        """
+        self.ram_root = ram_root
+        self.disk_root = disk_root
+        self.min_free_ram_mb = min_free_ram_mb
+        self.reaper_queue = Queue.Queue()
+        self.reaper_thread = None
+        self.reaper_pid = None
+
+    def _is_ram_root_usable(self):
+        """
+            Check if the RAM backed root exists and has enough free space.
+        :return: True/False
+        """
+        ram_parent = os.path.dirname(self.ram_root.rstrip('/'))
+        if not os.path.isdir(ram_parent):
+            return False
+        try:
+            fs_stat = os.statvfs(ram_parent)
+        except OSError:
+            return False
+        free_mb = (fs_stat.f_bavail * fs_stat.f_frsize) / (1024 * 1024)
+        available_memory = _get_available_memory_mb()
+        if available_memory is not None:
+            free_mb = min(free_mb, available_memory)
+        return free_mb >= self.min_free_ram_mb
+
+    def _get_root(self):
+        """
+            Get the directory in which new workspaces should be created.
+        :return: directory path
+        """
+        if self._is_ram_root_usable():
+            try:
+                return make_dir(self.ram_root)
+            except OSError as e:
+                log_error("Unable to use:" + self.ram_root + " for workspaces, Error:" + str(e))
+        return make_dir(self.disk_root)
+
+    def _start_reaper(self):
+        """
+            Start the reaper thread of the current process, if not already running.
+        :return: None
+        """
+        if self.reaper_pid != os.getpid() or self.reaper_thread is None or not self.reaper_thread.is_alive():
+            # threads do not survive fork, start a new one.
+            self.reaper_queue = Queue.Queue()
+            self.reaper_thread = threading.Thread(target=self._reap_workspaces)
+            self.reaper_thread.daemon = True
+            self.reaper_thread.start()
+            self.reaper_pid = os.getpid()
+
+    def _reap_workspaces(self):
+        """
+            Reaper thread, deletes released workspaces.
+        :return: None
+        """
+        while True:
+            curr_path = self.reaper_queue.get()
+            shutil.rmtree(curr_path, ignore_errors=True)
+            self.reaper_queue.task_done()
+
+    def create(self, prefix):
+        """
+            Create a new unique workspace.
+        :param prefix: prefix of the workspace name, usually job type and id.
+        :return: path of the workspace.
+        """
+        return tempfile.mkdtemp(prefix=prefix + WorkspaceManager.NAME_SEPARATOR + str(os.getpid()) +
+                                WorkspaceManager.NAME_SEPARATOR, dir=self._get_root())
+
+    def release(self, workspace_path):
+        """
+            Release the provided workspace, it will be deleted in background.
+        :param workspace_path: path of the workspace.
+        :return: None
+        """
+        if workspace_path is None or not os.path.exists(workspace_path):
+            return
+        trash_dir = make_dir(os.path.join(os.path.dirname(workspace_path), WorkspaceManager.TRASH_DIR_NAME))
+        to_delete = workspace_path
+        try:
+            to_delete = tempfile.mkdtemp(prefix=os.path.basename(workspace_path), dir=trash_dir)
+            os.rename(workspace_path, os.path.join(to_delete, 'workspace'))
+        except OSError as e:
+            log_error("Unable to move:" + workspace_path + " to trash, Error:" + str(e))
+        self._start_reaper()
+        self.reaper_queue.put(to_delete)
+
+    def drain(self):
+        """
+            Wait for the workspaces released by this process to be deleted.
+            Should be called before the process exits, the reaper thread dies with it.
+        :return: None
+        """
+        if self.reaper_pid == os.getpid() and self.reaper_thread is not None and self.reaper_thread.is_alive():
+            self.reaper_queue.join()
+
+    def reclaim_stale_workspaces(self, in_background=False):
+        """
+            Delete workspaces (and trash) left behind by processes that are no longer running.
+        :param in_background: flag to indicate that they should be deleted by the reaper thread.
+        :return: None
+        """
+        for curr_root in [self.ram_root, self.disk_root]:
+            for curr_dir in [curr_root, os.path.join(curr_root, WorkspaceManager.TRASH_DIR_NAME)]:
+                if not os.path.isdir(curr_dir):
+                    continue
+                for curr_name in os.listdir(curr_dir):
+                    if curr_name == WorkspaceManager.TRASH_DIR_NAME:
+                        continue
+                    name_parts = curr_name.rsplit(WorkspaceManager.NAME_SEPARATOR, 2)
+                    try:
+                        owner_pid = int(name_parts[1])
+                    except (ValueError, IndexError):
+                        continue
+                    if not _is_pid_alive(owner_pid):
+                        curr_path = os.path.join(curr_dir, curr_name)
+                        log_info("Reclaiming stale workspace:" + curr_path)
+                        if in_background:
+                            self._start_reaper()
+                            self.reaper_queue.put(curr_path)
+                        else:
+                            shutil.rmtree(curr_path, ignore_errors=True)
+
+
+_workspace_manager = None
+
+
+def get_workspace_manager():
+    """
+        Get the workspace manager of the current process.
+    :return: WorkspaceManager
+    """
+    global _workspace_manager
+    if _workspace_manager is None:
+        _workspace_manager = WorkspaceManager(WORKSPACE_RAM_ROOT, WORKSPACE_DISK_ROOT, WORKSPACE_MIN_FREE_RAM_MB)
+    return _workspace_manager
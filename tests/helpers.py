@@ -0,0 +1,111 @@
+"""
+Set up shared by the tests.
+
+The worker runs against the SQLite stand-in of farnsworth and the fake cb-test
+of the benchmarks. This module needs to be imported before test_vm_worker.
+Run the tests with: python -m unittest discover -s tests
+"""
+import os
+import sys
+import tempfile
+import threading
+import unittest
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(REPO_DIR, 'benchmarks'))
+sys.path.insert(0, REPO_DIR)
+# files created by the jobs stay out of the real locations.
+TEST_WORK_DIR = tempfile.mkdtemp(prefix='vm_worker_tests_')
+os.environ.setdefault('VM_WORKER_WORKSPACE_RAM_ROOT', os.path.join(TEST_WORK_DIR, 'workspaces'))
+os.environ.setdefault('VM_WORKER_WORKSPACE_DISK_ROOT', os.path.join(TEST_WORK_DIR, 'workspaces_disk'))
+os.environ.setdefault('VM_WORKER_BINARY_CACHE_DIR', os.path.join(TEST_WORK_DIR, 'binary_cache'))
+
+import fake_cb_test
+import fake_farnsworth
+
+fake_farnsworth.install()
+fake_cb_test.install(quiet=True)
+
+
+def init_database():
+    """
+        Create a fresh database for a test.
+    :return: path of the database file.
+    """
+    db_path = tempfile.mktemp(prefix='vm_worker_test_', suffix='.db')
+    fake_farnsworth.init_database(db_path)
+    return db_path
+
+
+def remove_database(db_path):
+    """
+        Remove the database of a test.
+    :param db_path: path of the database file.
+    :return: None
+    """
+    fake_farnsworth.close_dbs()
+    if os.path.exists(db_path):
+        os.unlink(db_path)
+
+
+class DatabaseTestCase(unittest.TestCase):
+    """
+    Test run against a fresh database, with num_jobs jobs of each of job_types.
+    The jobs are spread over num_cs challenge sets, each with one small binary per patch type.
+    """
+    num_jobs = 0
+    num_cs = 1
+    job_types = []
+
+    def setUp(self):
+        self.db_path = init_database()
+        self.all_cs = []
+        if self.num_jobs > 0:
+            self.all_cs = fake_farnsworth.populate(self.num_jobs, num_cs=self.num_cs, num_cbns=1, blob_size=16,
+                                                   job_types=self.job_types)
+
+    def tearDown(self):
+        remove_database(self.db_path)
+
+
+class StubBinaryTester(object):
+    """
+    BinaryTester whose runs pass, fail and measure perf as scripted by the test.
+    The script is a function of the run index, which returns (is passed, perf dict),
+    runs are numbered across all the instances in the order they are started.
+    """
+    PASS_RESULT = 'pass'
+    FAIL_RESULT = 'fail'
+    CRASH_RESULT = 'crash'
+
+    run_script = None
+    num_runs = 0
+    runs_lock = threading.Lock()
+
+    @staticmethod
+    def reset(run_script):
+        """
+            Start a new script of runs.
+        :param run_script: function of the run index, which returns (is passed, perf dict).
+        :return: None
+        """
+        StubBinaryTester.run_script = staticmethod(run_script)
+        StubBinaryTester.num_runs = 0
+
+    def __init__(self, bin_folder, xml_file, is_pov=False, is_cfe=False, standalone=False, ids_rules=None,
+                 bitflip_ids=False):
+        self.bin_folder = bin_folder
+        self.xml_file = xml_file
+
+    def test_cb_binary(self):
+        with StubBinaryTester.runs_lock:
+            run_index = StubBinaryTester.num_runs
+            StubBinaryTester.num_runs += 1
+        is_passed, perf_dict = StubBinaryTester.run_script(run_index)
+        final_result = StubBinaryTester.PASS_RESULT if is_passed else StubBinaryTester.FAIL_RESULT
+        return 0 if is_passed else 1, (final_result, perf_dict), ''
+
+    @staticmethod
+    def parse_cb_test_out(output_text):
+        final_result, perf_dict = output_text
+        return True, final_result, {'perf': perf_dict}
@@ -0,0 +1,55 @@
+import hashlib
+import os
+import shutil
+import stat
+import tempfile
+import unittest
+import helpers
+from test_vm_worker.binary_cache import BinaryCache
+
+BINARY_BLOB = 'binary'
+BINARY_HASH = hashlib.sha256(BINARY_BLOB).hexdigest()
+
+
+class BinaryCacheTest(unittest.TestCase):
+    """
+    Binaries saved through the cache, which is never changed by the saved binaries.
+    """
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.binary_cache = BinaryCache(os.path.join(self.work_dir, 'cache'), 1024 * 1024)
+        self.entry_path = self.binary_cache._get_entry_path(BINARY_HASH)
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def test_entries_are_read_only(self):
+        self.binary_cache.materialize(os.path.join(self.work_dir, 'bin'), lambda: BINARY_BLOB,
+                                      content_hash=BINARY_HASH)
+        self.assertEqual(stat.S_IMODE(os.stat(self.entry_path).st_mode), BinaryCache.ENTRY_MODE)
+
+    def test_writable_binaries_are_copied(self):
+        target_path = self.binary_cache.materialize(os.path.join(self.work_dir, 'bin'), lambda: BINARY_BLOB,
+                                                    content_hash=BINARY_HASH)
+        with open(target_path, 'w') as fp:
+            fp.write('changed')
+        with open(self.entry_path) as fp:
+            self.assertEqual(fp.read(), BINARY_BLOB)
+
+    def test_read_only_binaries_are_linked(self):
+        target_path = self.binary_cache.materialize(os.path.join(self.work_dir, 'bin'), lambda: BINARY_BLOB,
+                                                    content_hash=BINARY_HASH, is_read_only=True)
+        self.assertTrue(os.path.samefile(target_path, self.entry_path))
+
+    def test_mismatched_binary_is_rejected(self):
+        target_path = os.path.join(self.work_dir, 'bin')
+        self.assertRaises(ValueError, self.binary_cache.materialize, target_path, lambda: 'other binary',
+                          content_hash=BINARY_HASH)
+        self.assertFalse(os.path.exists(target_path))
+        self.assertEqual(filter(lambda curr_file: curr_file.endswith(BinaryCache.ENTRY_SUFFIX),
+                                os.listdir(self.binary_cache.cache_dir)), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,72 @@
+import unittest
+import helpers
+from fake_farnsworth import CBTesterJob, PovTesterJob
+from test_vm_worker.farnsworth_api_wrapper import CRSAPIWrapper
+
+
+class ClaimJobsTest(helpers.DatabaseTestCase):
+    """
+    Claiming of unstarted jobs by the dispatcher.
+    """
+    num_jobs = 10
+    num_cs = 2
+    job_types = ['pov_tester', 'cb_tester']
+
+    def test_claims_up_to_num_jobs(self):
+        claimed_jobs = CRSAPIWrapper.claim_jobs(PovTesterJob, 4)
+        self.assertEqual(len(claimed_jobs), 4)
+        self.assertEqual(PovTesterJob.select().where(PovTesterJob.started_at.is_null(False)).count(), 4)
+
+    def test_claimed_jobs_are_not_claimed_again(self):
+        first_jobs = CRSAPIWrapper.claim_jobs(PovTesterJob, 6)
+        second_jobs = CRSAPIWrapper.claim_jobs(PovTesterJob, 6)
+        self.assertEqual(len(first_jobs), 6)
+        self.assertEqual(len(second_jobs), 4)
+        self.assertEqual(len(set(first_jobs) & set(second_jobs)), 0)
+        self.assertEqual(CRSAPIWrapper.claim_jobs(PovTesterJob, 6), [])
+
+    def test_higher_priority_jobs_are_claimed_first(self):
+        high_priority_ids = [9, 3]
+        PovTesterJob.update(priority=10).where(PovTesterJob.id << high_priority_ids).execute()
+        self.assertEqual(sorted(CRSAPIWrapper.claim_jobs(PovTesterJob, 2)), sorted(high_priority_ids))
+
+    def test_claims_only_jobs_of_target_cs(self):
+        target_cs = self.all_cs[1]
+        claimed_jobs = CRSAPIWrapper.claim_jobs(CBTesterJob, 10, target_cs_id=target_cs.id)
+        self.assertEqual(len(claimed_jobs), 5)
+        for curr_job in CBTesterJob.select().where(CBTesterJob.id << claimed_jobs):
+            self.assertEqual(curr_job.cs_id, target_cs.id)
+
+    def test_claims_only_jobs_of_target_cs_ids(self):
+        claimed_jobs = CRSAPIWrapper.claim_jobs(CBTesterJob, 10, target_cs_ids=[self.all_cs[0].id])
+        self.assertEqual(len(claimed_jobs), 5)
+        self.assertEqual(CRSAPIWrapper.claim_jobs(CBTesterJob, 10, target_cs_ids=[]), [])
+
+    def test_nothing_claimed_for_zero_jobs(self):
+        self.assertEqual(CRSAPIWrapper.claim_jobs(PovTesterJob, 0), [])
+        self.assertEqual(PovTesterJob.select().where(PovTesterJob.started_at.is_null(False)).count(), 0)
+
+
+    def test_unstarted_cs_ids_are_listed_once(self):
+        PovTesterJob.update(priority=10).where(PovTesterJob.id << [1, 4]).execute()
+        CRSAPIWrapper.claim_jobs(PovTesterJob, 1, target_cs_id=self.all_cs[0].id)
+        self.assertEqual(sorted(CRSAPIWrapper.get_unstarted_cs_ids(PovTesterJob)),
+                         sorted(map(lambda curr_cs: curr_cs.id, self.all_cs)))
+
+    def test_fetched_jobs_keep_their_payload(self):
+        curr_job = CRSAPIWrapper.get_cb_tester_job(1)
+        self.assertEqual(curr_job.target_cs.id, curr_job.payload['target_cs_id'])
+        self.assertEqual(curr_job.poll.id, curr_job.payload['poll_id'])
+        for curr_job in CRSAPIWrapper.get_cb_tester_jobs(range(1, 11)) + \
+                list(CRSAPIWrapper.iter_unstarted_jobs(PovTesterJob, page_size=3)):
+            self.assertIsNotNone(curr_job.payload)
+
+    def test_only_blobs_of_cbns_are_deferred(self):
+        curr_cb = CRSAPIWrapper.get_unpatched_cbs(self.all_cs[0])[0]
+        self.assertNotIn('blob', curr_cb._data)
+        self.assertIn('sha256', curr_cb._data)
+        self.assertEqual(len(CRSAPIWrapper.load_deferred_field(curr_cb, 'blob')), 16)
+
+
+if __name__ == '__main__':
+    unittest.main()
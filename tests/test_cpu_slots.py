@@ -0,0 +1,91 @@
+import fcntl
+import multiprocessing
+import os
+import signal
+import subprocess
+import threading
+import time
+import unittest
+import helpers
+from test_vm_worker.cpu_slots import CPUSlotScheduler
+from test_vm_worker.process_lock import open_lock_file
+
+
+def _hold_slot_forever(scheduler, holding_event):
+    scheduler.set_holder(1)
+    scheduler.acquire()
+    with scheduler._lock:
+        holding_event.set()
+        time.sleep(60)
+
+
+def _take_slot_of_dead_holder(scheduler):
+    # done by the pool, once it reaps the worker.
+    scheduler.release_all(1)
+    scheduler.acquire()
+
+
+def _use_slot(scheduler, hold_time):
+    with scheduler.slot():
+        time.sleep(hold_time)
+
+
+class CPUSlotSchedulerTest(unittest.TestCase):
+    """
+    Slots shared by the workers, one of which is killed while holding the lock of the slots.
+    """
+
+    def test_killed_holder_does_not_block_the_others(self):
+        scheduler = CPUSlotScheduler(1, 2)
+        holding_event = multiprocessing.Event()
+        holder_process = multiprocessing.Process(target=_hold_slot_forever, args=(scheduler, holding_event))
+        holder_process.start()
+        self.assertTrue(holding_event.wait(10))
+        os.kill(holder_process.pid, signal.SIGKILL)
+        holder_process.join()
+        acquire_thread = threading.Thread(target=_take_slot_of_dead_holder, args=(scheduler,))
+        acquire_thread.daemon = True
+        acquire_thread.start()
+        acquire_thread.join(10)
+        self.assertFalse(acquire_thread.is_alive())
+        self.assertEqual(list(scheduler._held_slots), [1, 0])
+
+    def test_process_started_while_holding_does_not_keep_the_lock(self):
+        scheduler = CPUSlotScheduler(1, 1)
+        with scheduler._lock:
+            # like a cb-test, which is not started through the launcher.
+            child_process = subprocess.Popen(['sleep', '30'])
+        try:
+            lock_fp = open_lock_file(scheduler._lock.lock_file_path)
+            fcntl.flock(lock_fp.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            lock_fp.close()
+        finally:
+            child_process.kill()
+            child_process.wait()
+
+    def test_waiter_gets_the_slot_once_it_is_released(self):
+        scheduler = CPUSlotScheduler(1, 1)
+        # woken up by the release, not by the timeout.
+        scheduler._lock.wait_timeout = 60
+        scheduler.acquire()
+        threading.Timer(0.1, scheduler.release).start()
+        start_time = time.time()
+        scheduler.acquire()
+        self.assertLess(time.time() - start_time, 5)
+        self.assertEqual(list(scheduler._held_slots), [1])
+
+    def test_all_waiters_are_woken_up(self):
+        scheduler = CPUSlotScheduler(2, 1)
+        scheduler._lock.wait_timeout = 60
+        all_threads = map(lambda _: threading.Thread(target=_use_slot, args=(scheduler, 0.05)), range(8))
+        start_time = time.time()
+        for curr_thread in all_threads:
+            curr_thread.start()
+        for curr_thread in all_threads:
+            curr_thread.join()
+        self.assertLess(time.time() - start_time, 5)
+        self.assertEqual(list(scheduler._held_slots), [0])
+
+
+if __name__ == '__main__':
+    unittest.main()
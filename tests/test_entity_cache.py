@@ -0,0 +1,47 @@
+import os
+import shutil
+import tempfile
+import unittest
+import helpers
+from fake_farnsworth import ChallengeBinaryNode, PatchType
+from test_vm_worker.entity_cache import get_entity_cache
+from test_vm_worker.farnsworth_api_wrapper import CRSAPIWrapper
+
+
+class EntityCacheTest(helpers.DatabaseTestCase):
+    """
+    Caching of binaries, which are created and removed over time.
+    """
+    num_jobs = 2
+    job_types = ['cb_tester']
+
+    def setUp(self):
+        super(EntityCacheTest, self).setUp()
+        self.target_dir = tempfile.mkdtemp()
+        get_entity_cache().invalidate()
+
+    def tearDown(self):
+        get_entity_cache().invalidate()
+        shutil.rmtree(self.target_dir)
+        super(EntityCacheTest, self).tearDown()
+
+    def test_missing_patched_binaries_are_not_cached(self):
+        new_patch_type = PatchType.create(name='new_patch')
+        target_cs = self.all_cs[0]
+        self.assertEqual(CRSAPIWrapper.get_cbs_from_patch_type(target_cs, 'new_patch'), [])
+        ChallengeBinaryNode.create(cs=target_cs, name='patched', blob='patched binary', sha256='patched',
+                                   patch_type=new_patch_type)
+        self.assertEqual(len(CRSAPIWrapper.get_cbs_from_patch_type(target_cs, 'new_patch')), 1)
+
+    def test_removed_binary_invalidates_cached_binaries(self):
+        target_cs = self.all_cs[0]
+        curr_cb = CRSAPIWrapper.get_unpatched_cbs(target_cs)[0]
+        # not in the binary cache, so that its blob is fetched.
+        curr_cb.sha256 = None
+        ChallengeBinaryNode.delete().where(ChallengeBinaryNode.id == curr_cb.id).execute()
+        self.assertRaises(ValueError, CRSAPIWrapper.save_cbn, curr_cb, os.path.join(self.target_dir, 'cb'))
+        self.assertEqual(CRSAPIWrapper.get_unpatched_cbs(target_cs), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,78 @@
+import unittest
+import helpers
+from fake_farnsworth import CBTesterJob, PovTesterJob
+from test_job_dispatcher import StubWorkerPool, _process_job
+from test_vm_worker.cpu_slots import CPUSlotScheduler
+from test_vm_worker.farnsworth_api_wrapper import CRSAPIWrapper
+from test_vm_worker.fleet import FleetCoordinator
+from test_vm_worker.job_dispatcher import JobDispatcher
+
+
+class WorkStealingTest(helpers.DatabaseTestCase):
+    """
+    Taking jobs of the other VMs of the fleet.
+    Our CS have only cb tester jobs, the CS of the other VM have only pov tester jobs.
+    """
+
+    num_jobs = 16
+    num_cs = 8
+    job_types = ['pov_tester', 'cb_tester']
+
+    def setUp(self):
+        super(WorkStealingTest, self).setUp()
+        probe_coordinator = FleetCoordinator('vm1', 1)
+        probe_coordinator._build_ring([('vm2', 1)])
+        self.own_cs_ids = filter(lambda curr_cs_id: probe_coordinator.get_owner(curr_cs_id) == 'vm1',
+                                 map(lambda curr_cs: curr_cs.id, self.all_cs))
+        self.assertTrue(0 < len(self.own_cs_ids) < len(self.all_cs))
+        PovTesterJob.delete().where(PovTesterJob.cs << self.own_cs_ids).execute()
+        CBTesterJob.delete().where(~(CBTesterJob.cs << self.own_cs_ids)).execute()
+        self.num_own_jobs = CBTesterJob.select().count()
+        self.num_unstarted_queries = 0
+        self.get_unstarted_cs_ids = CRSAPIWrapper.get_unstarted_cs_ids
+        CRSAPIWrapper.get_unstarted_cs_ids = staticmethod(self._count_unstarted_cs_ids)
+
+    def tearDown(self):
+        CRSAPIWrapper.get_unstarted_cs_ids = staticmethod(self.get_unstarted_cs_ids)
+        super(WorkStealingTest, self).tearDown()
+
+    def _count_unstarted_cs_ids(self, job_type):
+        self.num_unstarted_queries += 1
+        return self.get_unstarted_cs_ids(job_type)
+
+    def _get_dispatcher(self, steal_grace):
+        fleet_coordinator = FleetCoordinator('vm1', 1, heartbeat_interval=3600, steal_grace=steal_grace)
+        fleet_coordinator.last_heartbeat_time = float('inf')
+        fleet_coordinator._build_ring([('vm2', 1)])
+        return JobDispatcher(StubWorkerPool(), [('pov_tester', PovTesterJob, _process_job),
+                                                ('cb_tester', CBTesterJob, _process_job)],
+                             CPUSlotScheduler(4, 1), 64, strict_priority_job_types=['pov_tester'],
+                             fleet_coordinator=fleet_coordinator)
+
+    def _get_num_started(self, job_type):
+        return job_type.select().where(job_type.started_at.is_null(False)).count()
+
+    def test_own_jobs_of_other_job_types_go_first(self):
+        job_dispatcher = self._get_dispatcher(0)
+        self.assertEqual(job_dispatcher._dispatch(self.num_own_jobs), self.num_own_jobs)
+        self.assertEqual(self._get_num_started(CBTesterJob), self.num_own_jobs)
+        self.assertEqual(self._get_num_started(PovTesterJob), 0)
+
+    def test_jobs_are_stolen_once_all_own_jobs_are_out(self):
+        job_dispatcher = self._get_dispatcher(0)
+        self.assertEqual(job_dispatcher._dispatch(self.num_own_jobs + 2), self.num_own_jobs + 2)
+        self.assertEqual(self._get_num_started(PovTesterJob), 2)
+        self.assertEqual(PovTesterJob.select().where(PovTesterJob.started_at.is_null(False) &
+                                                     (PovTesterJob.cs << self.own_cs_ids)).count(), 0)
+        # once per job type, not once per claim.
+        self.assertEqual(self.num_unstarted_queries, 2)
+
+    def test_jobs_are_not_stolen_within_grace(self):
+        job_dispatcher = self._get_dispatcher(3600)
+        self.assertEqual(job_dispatcher._dispatch(self.num_own_jobs + 2), self.num_own_jobs)
+        self.assertEqual(self._get_num_started(PovTesterJob), 0)
+        self.assertIsNotNone(job_dispatcher.fleet_coordinator.idle_since)
+
+
+if __name__ == '__main__':
+    unittest.main()
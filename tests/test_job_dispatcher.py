@@ -0,0 +1,147 @@
+import threading
+import time
+import unittest
+import helpers
+from peewee import PostgresqlDatabase
+from fake_farnsworth import ChallengeSet, CBTesterJob, NetworkPollSanitizerJob
+from test_vm_worker.cpu_slots import CPUSlotScheduler
+from test_vm_worker.farnsworth_api_wrapper import CRSAPIWrapper
+from test_vm_worker.job_dispatcher import JobDispatcher
+from test_vm_worker.job_leases import JobLease, LeaseManager
+from test_vm_worker.job_notifier import get_job_notifier, install_job_triggers, PostgresJobNotifier
+
+
+class PostgresCBTesterJob(CBTesterJob):
+    """
+    Jobs in a postgres database, which can not be reached.
+    """
+
+    class Meta:
+        database = PostgresqlDatabase('vm_worker', host='/nonexistent')
+
+
+class StubWorkerPool(object):
+    """
+    Worker pool which only records the submitted tasks.
+    """
+
+    def __init__(self):
+        self.all_tasks = []
+
+    def submit(self, job_processor, job_args):
+        self.all_tasks.append((job_processor, job_args))
+        return len(self.all_tasks) - 1
+
+
+def _process_job(job_args):
+    pass
+
+
+class GroupedDispatchTest(helpers.DatabaseTestCase):
+    """
+    Dispatch of job types, whose jobs are run in groups.
+    """
+    # 4 CS with 3 jobs each, jobs of different CS can not be grouped.
+    num_jobs = 12
+    num_cs = 4
+    job_types = ['cb_tester', 'network_poll_sanitizer']
+
+    def setUp(self):
+        super(GroupedDispatchTest, self).setUp()
+        JobLease.create_table(True)
+        self.worker_pool = StubWorkerPool()
+        self.lease_manager = LeaseManager([CBTesterJob], 'vm1')
+
+    def _get_dispatcher(self, max_in_flight):
+        return JobDispatcher(self.worker_pool, [('cb_tester', CBTesterJob, _process_job)], CPUSlotScheduler(4, 1),
+                             max_in_flight, job_group_config={'cb_tester': (CRSAPIWrapper.group_cb_tester_jobs,
+                                                                            _process_job)},
+                             lease_manager=self.lease_manager)
+
+    def test_groups_share_cs_and_patch_type(self):
+        job_groups = CRSAPIWrapper.group_cb_tester_jobs(range(1, 13), 2)
+        self.assertEqual(sorted(map(len, job_groups)), [1] * 4 + [2] * 4)
+        for curr_group in job_groups:
+            all_jobs = list(CBTesterJob.select().where(CBTesterJob.id << curr_group))
+            self.assertEqual(len(set(map(lambda curr_job: (curr_job.target_cs.id, curr_job.patch_type),
+                                         all_jobs))), 1)
+
+    def test_sanitizer_groups_share_cs(self):
+        job_groups = CRSAPIWrapper.group_poll_sanitizer_jobs(range(1, 13), 2)
+        self.assertEqual(sorted(map(len, job_groups)), [1] * 4 + [2] * 4)
+        for curr_group in job_groups:
+            all_raw_polls = CRSAPIWrapper.get_raw_polls(list(NetworkPollSanitizerJob.select()
+                                                             .where(NetworkPollSanitizerJob.id << curr_group)))
+            self.assertEqual(sorted(all_raw_polls.keys()), sorted(curr_group))
+            self.assertEqual(len(set(map(lambda curr_poll: curr_poll.cs.id, all_raw_polls.values()))), 1)
+
+    def test_in_flight_tasks_do_not_exceed_the_slots(self):
+        job_dispatcher = self._get_dispatcher(2)
+        self.assertEqual(job_dispatcher._dispatch(2), 2)
+        self.assertEqual(len(job_dispatcher.in_flight), 2)
+        self.assertEqual(len(self.worker_pool.all_tasks), 2)
+        dispatched_ids = sum(map(lambda curr_task: curr_task[1][0], self.worker_pool.all_tasks), [])
+        self.assertEqual(len(dispatched_ids), 6)
+        self.assertEqual(job_dispatcher.processed_jobs, 6)
+        # the jobs which did not fit are given back, without counting as an attempt.
+        started_ids = map(lambda curr_job: curr_job.id,
+                          CBTesterJob.select().where(CBTesterJob.started_at.is_null(False)))
+        self.assertEqual(sorted(started_ids), sorted(dispatched_ids))
+        self.assertEqual(JobLease.select().where(JobLease.num_attempts > 0).count(), 6)
+        self.assertEqual(JobLease.select().where(JobLease.owner.is_null(False)).count(), 6)
+        # and are dispatched once there are free slots.
+        self.assertEqual(job_dispatcher._dispatch(2), 2)
+        self.assertEqual(CBTesterJob.select().where(CBTesterJob.started_at.is_null(True)).count(), 0)
+
+    def test_leases_are_held_until_results_are_written(self):
+        job_dispatcher = self._get_dispatcher(2)
+        self.assertEqual(job_dispatcher._dispatch(1), 1)
+        job_dispatcher._handle_completed([(0, None)])
+        self.assertEqual(JobLease.select().where(JobLease.owner.is_null(False)).count(), 3)
+        job_dispatcher._handle_flushed([(0, False)])
+        self.assertEqual(JobLease.select().where(JobLease.owner.is_null(False)).count(), 0)
+        self.assertEqual(len(job_dispatcher.unflushed_tasks), 0)
+
+
+class JobNotifyTest(helpers.DatabaseTestCase):
+    """
+    Waking up of idle dispatchers, when jobs are created.
+    """
+
+    def setUp(self):
+        super(JobNotifyTest, self).setUp()
+        self.job_notifier = get_job_notifier([CBTesterJob])
+
+    def tearDown(self):
+        self.job_notifier.close()
+        super(JobNotifyTest, self).tearDown()
+
+    def test_new_job_wakes_up_idle_dispatcher(self):
+        job_dispatcher = JobDispatcher(StubWorkerPool(), [('cb_tester', CBTesterJob, _process_job)],
+                                       CPUSlotScheduler(4, 1), 2, poll_time=30, max_poll_time=30,
+                                       job_notifier=self.job_notifier)
+        job_dispatcher.num_idle_polls = 3
+        target_cs = ChallengeSet.create(name='CS_new')
+        job_creator = threading.Timer(0.1, lambda: CBTesterJob.create(cs=target_cs, worker='cb_tester', payload={}))
+        job_creator.start()
+        start_time = time.time()
+        job_dispatcher._wait_for_jobs()
+        job_creator.join()
+        self.assertLess(time.time() - start_time, 5)
+        self.assertEqual(job_dispatcher.num_idle_polls, 0)
+
+    def test_notify_does_not_block_on_full_pipe(self):
+        # many more notifications than the pipe can hold, with nobody waiting.
+        for _ in range(100000):
+            self.job_notifier.notify()
+        self.assertTrue(self.job_notifier.wait(0))
+
+    def test_postgres_is_polled_without_triggers(self):
+        # nothing would notify the jobs, waiting for notifications would only delay them.
+        self.assertFalse(install_job_triggers([PostgresCBTesterJob]))
+        self.assertIsNone(get_job_notifier([PostgresCBTesterJob], has_job_triggers=False))
+        self.assertIsInstance(get_job_notifier([PostgresCBTesterJob], has_job_triggers=True), PostgresJobNotifier)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,87 @@
+import time
+import unittest
+import helpers
+from fake_farnsworth import PovTesterJob
+from test_vm_worker.farnsworth_api_wrapper import CRSAPIWrapper
+from test_vm_worker.job_leases import JobLease, LeaseManager
+
+
+class JobLeaseReclaimTest(helpers.DatabaseTestCase):
+    """
+    Jobs claimed by a VM or worker which died are run again once their leases expire.
+    """
+
+    num_jobs = 4
+    job_types = ['pov_tester']
+
+    def setUp(self):
+        super(JobLeaseReclaimTest, self).setUp()
+        self.lease_manager = self._get_lease_manager('vm1')
+        JobLease.create_table(True)
+
+    def _get_lease_manager(self, owner_name, lease_duration=0.2):
+        return LeaseManager([PovTesterJob], owner_name, lease_duration=lease_duration, max_attempts=2)
+
+    def _claim(self, curr_lease_manager, num_jobs):
+        job_ids = CRSAPIWrapper.claim_jobs(PovTesterJob, num_jobs)
+        curr_lease_manager.acquire(PovTesterJob, job_ids)
+        return job_ids
+
+    def _get_started_ids(self):
+        return set(map(lambda curr_job: curr_job.id,
+                       PovTesterJob.select().where(PovTesterJob.started_at.is_null(False))))
+
+    def test_unexpired_leases_are_not_reclaimed(self):
+        self.lease_manager = self._get_lease_manager('vm1', lease_duration=60)
+        job_ids = self._claim(self.lease_manager, 2)
+        self.assertEqual(self._get_lease_manager('vm2').reclaim(), 0)
+        self.assertEqual(self._get_started_ids(), set(job_ids))
+
+    def test_expired_leases_are_reclaimed_by_another_vm(self):
+        job_ids = self._claim(self.lease_manager, 2)
+        time.sleep(0.3)
+        self.assertEqual(self._get_lease_manager('vm2').reclaim(), 2)
+        self.assertEqual(self._get_started_ids(), set())
+        # the jobs can be claimed again.
+        self.assertEqual(sorted(self._claim(self._get_lease_manager('vm2'), 4)),
+                         sorted(job_ids + list(set(range(1, 5)) - set(job_ids))))
+
+    def test_renewed_leases_are_not_reclaimed(self):
+        self._claim(self.lease_manager, 2)
+        time.sleep(0.15)
+        self.lease_manager.renew()
+        time.sleep(0.1)
+        self.assertEqual(self.lease_manager.reclaim(), 0)
+
+    def test_completed_jobs_are_not_reclaimed(self):
+        job_ids = self._claim(self.lease_manager, 2)
+        CRSAPIWrapper.complete_jobs(PovTesterJob, job_ids[:1])
+        time.sleep(0.3)
+        self.assertEqual(self.lease_manager.reclaim(), 1)
+        self.assertEqual(self._get_started_ids(), set(job_ids[:1]))
+
+    def test_released_leases_are_not_reclaimed(self):
+        job_ids = self._claim(self.lease_manager, 2)
+        CRSAPIWrapper.complete_jobs(PovTesterJob, job_ids)
+        self.lease_manager.release(PovTesterJob, job_ids)
+        time.sleep(0.3)
+        self.assertEqual(self.lease_manager.reclaim(), 0)
+
+    def test_failed_jobs_are_reclaimed_right_away(self):
+        job_ids = self._claim(self._get_lease_manager('vm1', lease_duration=60), 1)
+        self.lease_manager.release(PovTesterJob, job_ids, should_retry=True)
+        self.assertEqual(self.lease_manager.reclaim(), 1)
+        self.assertEqual(self._get_started_ids(), set())
+
+    def test_jobs_are_given_up_after_max_attempts(self):
+        job_ids = self._claim(self.lease_manager, 1)
+        time.sleep(0.3)
+        self.assertEqual(self.lease_manager.reclaim(), 1)
+        self.assertEqual(self._claim(self.lease_manager, 1), job_ids)
+        time.sleep(0.3)
+        self.assertEqual(self.lease_manager.reclaim(), 0)
+        self.assertIsNotNone(PovTesterJob.get(PovTesterJob.id == job_ids[0]).completed_at)
+
+
+if __name__ == '__main__':
+    unittest.main()
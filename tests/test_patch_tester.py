@@ -0,0 +1,79 @@
+import os
+import shutil
+import tempfile
+import unittest
+from helpers import StubBinaryTester
+from test_vm_worker.cb_tester import patch_tester
+from test_vm_worker.cb_tester.patch_tester import PatchTester
+from test_vm_worker.time_budget import job_budget
+
+
+def _get_perf(curr_value):
+    return {'rss': curr_value, 'flt': curr_value, 'utime': curr_value, 'cpu_clock': curr_value,
+            'task_clock': curr_value, 'file_size': 4096.0}
+
+
+class PatchTesterStopRuleTest(unittest.TestCase):
+    """
+    Adaptive number of runs of a poll: runs stop once the 95% confidence interval
+    of the perf measures is within the tolerance, the poll fails or the budget is used up.
+    """
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.poll_xml_path = os.path.join(self.work_dir, 'poll.xml')
+        with open(self.poll_xml_path, 'w') as fp:
+            fp.write('<pov></pov>')
+        self.orig_binary_tester = patch_tester.BinaryTester
+        patch_tester.BinaryTester = StubBinaryTester
+
+    def tearDown(self):
+        patch_tester.BinaryTester = self.orig_binary_tester
+        shutil.rmtree(self.work_dir)
+
+    def _test(self, run_script, num_threads=1):
+        StubBinaryTester.reset(run_script)
+        curr_tester = PatchTester(self.work_dir, self.poll_xml_path, None, num_threads=num_threads)
+        curr_tester.test()
+        return curr_tester
+
+    def test_stable_perf_stops_after_min_runs(self):
+        curr_tester = self._test(lambda run_index: (True, _get_perf(100.0)))
+        self.assertTrue(curr_tester.are_polls_ok())
+        self.assertEqual(len(curr_tester.test_results), PatchTester.MIN_TEST_TIME)
+        self.assertEqual(StubBinaryTester.num_runs, PatchTester.MIN_TEST_TIME)
+
+    def test_noisy_perf_runs_until_max_runs(self):
+        curr_tester = self._test(lambda run_index: (True, _get_perf(100.0 if run_index % 2 == 0 else 200.0)))
+        self.assertTrue(curr_tester.are_polls_ok())
+        self.assertEqual(len(curr_tester.test_results), PatchTester.MAX_TEST_TIME)
+
+    def test_runs_stop_once_perf_converges(self):
+        # two noisy runs, then the mean settles within the tolerance.
+        curr_tester = self._test(lambda run_index: (True, _get_perf([100.0, 120.0][run_index] if run_index < 2
+                                                                    else 110.0)))
+        self.assertTrue(PatchTester.MIN_TEST_TIME < len(curr_tester.test_results) < PatchTester.MAX_TEST_TIME)
+        self.assertTrue(curr_tester._is_perf_converged())
+
+    def test_failed_run_stops_testing(self):
+        curr_tester = self._test(lambda run_index: (run_index != 2, _get_perf(100.0 if run_index % 2 == 0
+                                                                              else 200.0)))
+        self.assertFalse(curr_tester.are_polls_ok())
+        self.assertEqual(len(curr_tester.test_results), 3)
+
+    def test_expired_budget_stops_testing(self):
+        with job_budget('cb_tester') as curr_budget:
+            curr_budget.deadline = 0
+            curr_tester = self._test(lambda run_index: (True, _get_perf(100.0 if run_index % 2 == 0 else 200.0)))
+        self.assertTrue(curr_tester.are_polls_ok())
+        self.assertEqual(len(curr_tester.test_results), PatchTester.MIN_TEST_TIME)
+
+    def test_non_adaptive_runs_fixed_times(self):
+        StubBinaryTester.reset(lambda run_index: (True, _get_perf(100.0)))
+        curr_tester = PatchTester(self.work_dir, self.poll_xml_path, None, adaptive=False)
+        curr_tester.test()
+        self.assertEqual(len(curr_tester.test_results), PatchTester.NUM_TEST_TIME)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,89 @@
+import time
+import unittest
+import helpers
+from helpers import StubBinaryTester
+from fake_farnsworth import PovTesterJob, PovTestResult
+from test_vm_worker import pov_tester
+from test_vm_worker.pov_tester import NUM_THROWS, SUCCESS_THRESHOLD
+from test_vm_worker.time_budget import job_budget, TIMEOUT_RESULT
+
+
+class PovEarlyStopTest(helpers.DatabaseTestCase):
+    """
+    PoV throws stop as soon as the remaining throws can not change whether the pov reaches the threshold.
+    """
+
+    num_jobs = 1
+    job_types = ['pov_tester']
+
+    def setUp(self):
+        super(PovEarlyStopTest, self).setUp()
+        self.orig_binary_tester = pov_tester.BinaryTester
+        pov_tester.BinaryTester = StubBinaryTester
+
+    def tearDown(self):
+        pov_tester.BinaryTester = self.orig_binary_tester
+        super(PovEarlyStopTest, self).tearDown()
+
+    def _throw(self, run_script, num_threads=1):
+        StubBinaryTester.reset(run_script)
+        all_args = [('bin_dir', 'pov_file', None)] * NUM_THROWS
+        return pov_tester._throw_povs(all_args, num_threads, 'test')
+
+    def _run_job(self, run_script):
+        StubBinaryTester.reset(run_script)
+        curr_job = PovTesterJob.get()
+        pov_tester.process_povtester_job((curr_job.id, 1, True))
+        return PovTestResult.get(PovTestResult.exploit == curr_job.target_exploit)
+
+    def test_stops_once_threshold_is_reached(self):
+        all_results = self._throw(lambda run_index: (True, {}))
+        self.assertEqual(len(all_results), SUCCESS_THRESHOLD)
+
+    def test_stops_once_threshold_can_not_be_reached(self):
+        all_results = self._throw(lambda run_index: (False, {}))
+        self.assertEqual(len(all_results), NUM_THROWS - SUCCESS_THRESHOLD + 1)
+
+    def test_all_throws_when_outcome_is_open(self):
+        # passes on the last throw only, the outcome is open till then.
+        all_results = self._throw(lambda run_index: (run_index >= NUM_THROWS - SUCCESS_THRESHOLD, {}))
+        self.assertEqual(len(all_results), NUM_THROWS)
+
+    def test_multi_threaded_throws_stop_early(self):
+        all_results = self._throw(lambda run_index: (True, {}), num_threads=2)
+        self.assertTrue(SUCCESS_THRESHOLD <= len(all_results) < NUM_THROWS)
+
+    def test_throws_started_before_stop_are_counted(self):
+        # slow throws, so that others are still running when the outcome is settled.
+        all_results = self._throw(lambda run_index: (time.sleep(0.05) or True, {}), num_threads=3)
+        self.assertTrue(SUCCESS_THRESHOLD <= len(all_results) < NUM_THROWS)
+        self.assertEqual(len(all_results), StubBinaryTester.num_runs)
+
+    def test_expired_budget_stops_throws(self):
+        with job_budget('pov_tester') as curr_budget:
+            curr_budget.deadline = 0
+            all_results = self._throw(lambda run_index: (run_index % 2 == 0, {}))
+        self.assertEqual(len(all_results), 1)
+        self.assertTrue(curr_budget.is_timed_out())
+
+    def test_early_stopped_result_records_the_throws_done(self):
+        curr_result = self._run_job(lambda run_index: (True, {}))
+        self.assertEqual(curr_result.num_success, SUCCESS_THRESHOLD)
+        self.assertEqual(curr_result.test_feedback, 'throws:' + str(SUCCESS_THRESHOLD) + '/' + str(NUM_THROWS))
+        self.assertIsNotNone(PovTesterJob.get().completed_at)
+
+    def test_early_stopped_result_does_not_outrank_measured_result(self):
+        curr_result = self._run_job(lambda run_index: (True, {}))
+        curr_job = PovTesterJob.get()
+        PovTestResult.create(exploit=curr_job.target_exploit, cs_fielding=curr_job.target_cs_fielding,
+                             ids_fielding=curr_job.target_ids_fielding, num_success=9,
+                             test_feedback='throws:10/10')
+        best_result = PovTestResult.best(curr_job.target_cs_fielding, curr_job.target_ids_fielding)
+        self.assertNotEqual(best_result.id, curr_result.id)
+
+    def test_timed_out_result_is_marked(self):
+        self.assertEqual(pov_tester._get_test_feedback(3, True), TIMEOUT_RESULT + ',throws:3/' + str(NUM_THROWS))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,63 @@
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+import helpers
+from test_vm_worker.profiling import Profiler, create_sampling_state
+
+
+def _busy_loop(run_time):
+    end_time = time.time() + run_time
+    while time.time() < end_time:
+        pass
+
+
+def _threaded_job(run_time):
+    busy_thread = threading.Thread(target=_busy_loop, args=(run_time,))
+    busy_thread.start()
+    busy_thread.join()
+
+
+class ProfilerTest(unittest.TestCase):
+    """
+    Profiles of jobs, which run their work in threads.
+    """
+
+    def setUp(self):
+        self.profile_dir = tempfile.mkdtemp()
+        self.profiler = Profiler(self.profile_dir, 1, 0.001)
+
+    def tearDown(self):
+        self.profiler.stop_sampling()
+        shutil.rmtree(self.profile_dir)
+
+    def test_cprofile_includes_threads_of_job(self):
+        self.profiler.run('cb_tester', _threaded_job, 0.05)
+        all_functions = map(lambda curr_key: curr_key[2], self.profiler.job_stats['cb_tester'].stats.keys())
+        self.assertIn('_busy_loop', all_functions)
+
+    def test_samples_include_all_threads(self):
+        self.profiler.default_job_type = 'daemon'
+        self.profiler.start_sampling()
+        _threaded_job(0.2)
+        self.profiler.stop_sampling()
+        all_stacks = self.profiler.job_samples['daemon'].keys()
+        self.assertTrue(any(map(lambda curr_stack: curr_stack.endswith(':_busy_loop'), all_stacks)))
+
+    def test_sampling_follows_shared_state(self):
+        sampling_state = create_sampling_state()
+        self.profiler.sampling_state = sampling_state
+        self.profiler.toggle_sampling()
+        self.assertEqual(sampling_state.value, 1)
+        # a worker which is signalled twice for the same state keeps sampling.
+        for _ in range(2):
+            self.profiler.sync_sampling()
+            self.assertTrue(self.profiler.is_sampling)
+        sampling_state.value = 0
+        self.profiler.sync_sampling()
+        self.assertFalse(self.profiler.is_sampling)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,92 @@
+import unittest
+import helpers
+from fake_farnsworth import CBTesterJob, TesterResult
+from test_vm_worker.farnsworth_api_wrapper import CRSAPIWrapper
+from test_vm_worker.result_sink import ResultSink
+
+
+class FailingResultSink(ResultSink):
+    """
+    Result sink whose writes fail, while is_failing is set.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(FailingResultSink, self).__init__(*args, **kwargs)
+        self.is_failing = True
+        self.num_writes = 0
+
+    def _write(self):
+        self.num_writes += 1
+        if self.is_failing:
+            raise IOError('DB is down')
+        super(FailingResultSink, self)._write()
+
+
+class ResultSinkTest(helpers.DatabaseTestCase):
+    """
+    Buffering of results, while they can not be written.
+    """
+    num_jobs = 4
+    job_types = ['cb_tester']
+
+    def setUp(self):
+        super(ResultSinkTest, self).setUp()
+        self.result_sink = FailingResultSink(100, 0, max_pending=4, retry_delay=60)
+
+    def _add_result(self, job_id):
+        curr_job = CBTesterJob.get(id=job_id)
+        return self.result_sink.add(TesterResult, job=curr_job, error_code=0, result='pass') and \
+            self.result_sink.complete_job(curr_job)
+
+    def test_failed_results_are_kept_and_written_later(self):
+        self.assertTrue(self._add_result(1))
+        self.assertFalse(self.result_sink.flush())
+        self.assertEqual(self.result_sink.num_pending, 2)
+        self.result_sink.is_failing = False
+        self.assertTrue(self.result_sink.flush())
+        self.assertEqual(TesterResult.select().count(), 1)
+        self.assertTrue(CBTesterJob.get(id=1).is_completed())
+
+    def test_failed_results_are_not_retried_before_delay(self):
+        self.assertTrue(self._add_result(1))
+        self.assertFalse(self.result_sink.flush())
+        self.result_sink.flush_if_due()
+        self.assertFalse(self.result_sink.flush(force=False))
+        self.assertEqual(self.result_sink.num_writes, 1)
+
+    def test_results_are_refused_once_buffer_is_full(self):
+        self.assertTrue(self._add_result(1))
+        self.assertTrue(self._add_result(2))
+        # the job of a refused result is not completed, so that it is run again.
+        self.assertFalse(self._add_result(3))
+        self.assertEqual(self.result_sink.num_pending, 4)
+        self.result_sink.is_failing = False
+        self.assertTrue(self.result_sink.flush())
+        self.assertEqual(TesterResult.select().count(), 2)
+        self.assertFalse(CBTesterJob.get(id=3).is_completed())
+        # and there is room again.
+        self.assertTrue(self._add_result(3))
+
+    def test_result_is_refused_along_with_completion(self):
+        self.assertTrue(self._add_result(1))
+        self.assertTrue(self.result_sink.add(TesterResult, job=CBTesterJob.get(id=2), error_code=0, result='pass'))
+        # room for the result, but not for the completion.
+        self.assertFalse(self.result_sink.complete_job_with_result(CBTesterJob.get(id=3), TesterResult, job=3,
+                                                                   error_code=0, result='pass'))
+        self.assertEqual(self.result_sink.num_pending, 3)
+        self.result_sink.is_failing = False
+        self.assertTrue(self.result_sink.flush())
+        self.assertEqual(TesterResult.select().where(TesterResult.job == 3).count(), 0)
+        self.assertTrue(self.result_sink.complete_job_with_result(CBTesterJob.get(id=3), TesterResult, job=3,
+                                                                  error_code=0, result='pass'))
+        self.assertTrue(self.result_sink.flush())
+        self.assertTrue(CBTesterJob.get(id=3).is_completed())
+
+    def test_update_testjob_completed_reports_write(self):
+        curr_job = CRSAPIWrapper.get_cb_tester_job(4)
+        self.assertTrue(CRSAPIWrapper.update_testjob_completed(curr_job, 0, 'pass', '', '', None))
+        self.assertTrue(CBTesterJob.get(id=4).is_completed())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,166 @@
+import os
+import socket
+import subprocess
+import time
+import unittest
+import helpers
+from fake_farnsworth import CBTesterJob, TesterResult
+from test_vm_worker import time_budget
+from test_vm_worker.farnsworth_api_wrapper import CRSAPIWrapper
+from test_vm_worker.launcher import _ProcessWatchdog, ProcessLauncher
+from test_vm_worker.time_budget import JobBudget, job_budget, get_throw_timeout, is_budget_expired, \
+    on_throw_timeout, get_task_time_limit, get_num_rounds, TIMEOUT_RESULT, TIMEOUT_ERROR_CODE
+
+
+def _assert_group_killed(test_case, target_process):
+    test_case.assertEqual(target_process.wait(), -9)
+    # nothing of the group is left running.
+    time.sleep(0.1)
+    all_processes = map(lambda curr_line: curr_line.split(None, 1),
+                        subprocess.check_output(['ps', '-eo', 'stat=,args=']).splitlines())
+    test_case.assertEqual(filter(lambda curr_process: curr_process[1].startswith('sleep 31.5') and
+                                 not curr_process[0].startswith('Z'), all_processes), [])
+
+
+class JobBudgetTest(unittest.TestCase):
+    """
+    Time budgets of jobs and of the cb-test runs of the jobs.
+    """
+
+    def test_throw_timeout_is_capped_by_job_deadline(self):
+        curr_budget = JobBudget('cb_tester', 1, 300)
+        self.assertTrue(0 < curr_budget.get_throw_timeout() <= 1)
+        curr_budget = JobBudget('cb_tester', 600, 5)
+        self.assertEqual(curr_budget.get_throw_timeout(), 5)
+
+    def test_no_limits(self):
+        curr_budget = JobBudget('cb_tester', 0, 0)
+        self.assertIsNone(curr_budget.get_throw_timeout())
+        self.assertFalse(curr_budget.is_expired())
+
+    def test_expired_budget_kills_new_throws_right_away(self):
+        curr_budget = JobBudget('cb_tester', 0.01, 300)
+        time.sleep(0.02)
+        self.assertTrue(curr_budget.is_expired())
+        self.assertEqual(curr_budget.get_throw_timeout(), time_budget.MIN_THROW_TIMEOUT)
+
+    def test_timeouts_are_counted_per_job(self):
+        with job_budget('cb_tester') as curr_budget:
+            self.assertFalse(curr_budget.is_timed_out())
+            on_throw_timeout()
+            self.assertTrue(curr_budget.is_timed_out())
+            self.assertEqual(curr_budget.get_thread_timeouts(), 1)
+        with job_budget('cb_tester') as next_budget:
+            self.assertFalse(next_budget.is_timed_out())
+        self.assertFalse(is_budget_expired())
+        self.assertEqual(get_throw_timeout(), time_budget.THROW_TIME_BUDGET or None)
+
+    def test_task_time_limit_grows_with_jobs(self):
+        single_limit = get_task_time_limit('cb_tester')
+        self.assertEqual(get_task_time_limit('cb_tester', 4) - single_limit,
+                         3 * time_budget.get_job_time_budget('cb_tester'))
+        self.assertIsNone(get_task_time_limit('unknown_job_type'))
+
+    def test_task_time_limit_grows_with_rounds(self):
+        # 5 jobs run by 2 threads take 3 rounds.
+        self.assertEqual(get_num_rounds(5, 2), 3)
+        self.assertEqual(get_num_rounds(1, 4), 1)
+        self.assertEqual(get_task_time_limit('network_poll_sanitizer', 5, 2),
+                         get_task_time_limit('network_poll_sanitizer', 3))
+        self.assertEqual(get_task_time_limit('network_poll_sanitizer', 4, 8),
+                         get_task_time_limit('network_poll_sanitizer'))
+
+    def test_sequential_group_gets_budget_of_every_job(self):
+        # jobs of a cb_tester group are run one after the other, whatever the threads of the task.
+        self.assertEqual(get_task_time_limit('cb_tester', 8, 4),
+                         8 * time_budget.get_job_time_budget('cb_tester') + time_budget.JOB_STOP_GRACE)
+
+
+class ProcessWatchdogTest(unittest.TestCase):
+    """
+    cb-test runs are killed along with their children by the launcher.
+    """
+
+    def setUp(self):
+        self.client_sock, self.launcher_sock = socket.socketpair()
+
+    def tearDown(self):
+        self.client_sock.close()
+        self.launcher_sock.close()
+
+    def _run(self, timeout):
+        # the child of the shell is in the process group too.
+        target_process = subprocess.Popen(['/bin/sh', '-c', 'sleep 31.5; true'], preexec_fn=os.setsid,
+                                          close_fds=True)
+        process_watchdog = _ProcessWatchdog(self.launcher_sock, target_process.pid, timeout)
+        process_watchdog.start()
+        return target_process, process_watchdog
+
+    def test_run_is_killed_on_timeout(self):
+        start_time = time.time()
+        target_process, process_watchdog = self._run(0.2)
+        _assert_group_killed(self, target_process)
+        process_watchdog.join()
+        self.assertTrue(process_watchdog.is_timed_out)
+        self.assertLess(time.time() - start_time, 5)
+
+    def test_run_is_killed_when_client_dies(self):
+        target_process, process_watchdog = self._run(None)
+        self.client_sock.close()
+        _assert_group_killed(self, target_process)
+        process_watchdog.join()
+        self.assertFalse(process_watchdog.is_timed_out)
+
+
+class DeadlinePopenTest(unittest.TestCase):
+    """
+    cb-test runs started by the worker itself, when there is no launcher, are killed along with their children too.
+    """
+
+    def setUp(self):
+        self.throw_time_budget = time_budget.THROW_TIME_BUDGET
+        time_budget.THROW_TIME_BUDGET = 0.2
+
+    def tearDown(self):
+        time_budget.THROW_TIME_BUDGET = self.throw_time_budget
+
+    def test_run_is_killed_on_timeout(self):
+        start_time = time.time()
+        with job_budget('cb_tester') as curr_budget:
+            target_process = ProcessLauncher().popen(['/bin/sh', '-c', 'sleep 31.5; true'], close_fds=True)
+            _assert_group_killed(self, target_process)
+            self.assertTrue(target_process.is_timed_out)
+            self.assertEqual(curr_budget.num_timeouts, 1)
+        self.assertLess(time.time() - start_time, 5)
+
+    def test_run_finishing_in_time_is_not_killed(self):
+        with job_budget('cb_tester') as curr_budget:
+            target_process = ProcessLauncher().popen(['true'])
+            self.assertEqual(target_process.wait(), 0)
+            self.assertFalse(target_process.is_timed_out)
+            self.assertEqual(curr_budget.num_timeouts, 0)
+
+
+class CompleteTimedOutJobsTest(helpers.DatabaseTestCase):
+    """
+    Jobs of tasks stopped by the daemon are completed with a timeout result.
+    """
+    num_jobs = 3
+    job_types = ['cb_tester']
+
+    def test_only_unfinished_jobs_are_completed(self):
+        all_ids = map(lambda curr_job: curr_job.id, CBTesterJob.select().order_by(CBTesterJob.id))
+        CRSAPIWrapper.complete_jobs(CBTesterJob, all_ids[:1])
+        completed_ids = CRSAPIWrapper.complete_timed_out_jobs(CBTesterJob, all_ids, TIMEOUT_ERROR_CODE,
+                                                              TIMEOUT_RESULT, 'Stopped after 10 seconds')
+        self.assertEqual(sorted(completed_ids), all_ids[1:])
+        self.assertEqual(CBTesterJob.select().where(CBTesterJob.completed_at.is_null(True)).count(), 0)
+        all_results = list(TesterResult.select().order_by(TesterResult.job))
+        self.assertEqual(map(lambda curr_result: curr_result.job, all_results), all_ids[1:])
+        for curr_result in all_results:
+            self.assertEqual(curr_result.result, TIMEOUT_RESULT)
+            self.assertEqual(curr_result.error_code, TIMEOUT_ERROR_CODE)
+
+
+if __name__ == '__main__':
+    unittest.main()
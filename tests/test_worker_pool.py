@@ -0,0 +1,76 @@
+import os
+import signal
+import unittest
+import helpers
+from fake_farnsworth import CBTesterJob, TesterResult
+from test_vm_worker.result_sink import get_result_sink
+from test_vm_worker.worker_pool import WarmWorkerPool
+
+
+def _run_task(task_arg):
+    if task_arg == 'die':
+        os.kill(os.getpid(), signal.SIGKILL)
+    if task_arg == 'fail':
+        raise ValueError('failed')
+    if task_arg == 'buffer':
+        get_result_sink().add(TesterResult, job=CBTesterJob.get(id=1), error_code=0, result='pass')
+
+
+class WarmWorkerPoolTest(helpers.DatabaseTestCase):
+    """
+    Tasks run by the warm workers, including the ones whose worker dies.
+    """
+    num_jobs = 1
+    job_types = ['cb_tester']
+
+    def setUp(self):
+        super(WarmWorkerPoolTest, self).setUp()
+        self.worker_pool = None
+
+    def tearDown(self):
+        if self.worker_pool is not None:
+            self.worker_pool.shutdown()
+        super(WarmWorkerPoolTest, self).tearDown()
+
+    def _run_all(self, all_task_args, num_workers=2, max_jobs_per_worker=0):
+        self.worker_pool = WarmWorkerPool(num_workers, max_jobs_per_worker=max_jobs_per_worker)
+        task_args = dict(map(lambda curr_arg: (self.worker_pool.submit(_run_task, curr_arg), curr_arg),
+                             all_task_args))
+        all_errors = {}
+        while self.worker_pool.num_pending() > 0:
+            for task_id, task_error in self.worker_pool.wait_completed(timeout=10):
+                all_errors[task_id] = task_error
+        self.assertEqual(sorted(all_errors.keys()), sorted(task_args.keys()))
+        return map(lambda task_id: (task_args[task_id], all_errors[task_id]), sorted(all_errors.keys()))
+
+    def test_all_tasks_finish(self):
+        all_results = self._run_all(['ok'] * 10 + ['fail'])
+        self.assertEqual(all_results[:10], [('ok', None)] * 10)
+        self.assertEqual(all_results[10], ('fail', 'failed'))
+
+    def test_task_of_dead_worker_is_failed(self):
+        all_results = self._run_all(['ok', 'die', 'ok', 'ok', 'die', 'ok'])
+        self.assertEqual(all_results, [('ok', None), ('die', 'Worker died'), ('ok', None), ('ok', None),
+                                       ('die', 'Worker died'), ('ok', None)])
+
+    def test_no_task_is_lost_when_workers_are_recycled(self):
+        all_results = self._run_all(['ok'] * 12, max_jobs_per_worker=2)
+        self.assertEqual(all_results, [('ok', None)] * 12)
+
+    def test_only_one_task_is_handed_to_a_worker(self):
+        self.worker_pool = WarmWorkerPool(2)
+        for _ in range(5):
+            self.worker_pool.submit(_run_task, 'ok')
+        self.assertEqual(len(self.worker_pool.running_tasks), 2)
+        self.assertEqual(len(self.worker_pool.backlog), 3)
+
+    def test_tasks_are_reported_once_results_are_written(self):
+        self._run_all(['ok', 'die', 'buffer'], num_workers=1)
+        # results are written by the idle worker at the latest on exit.
+        self.worker_pool.shutdown()
+        self.assertEqual(dict(self.worker_pool.drain_flushed_tasks()), {0: False, 1: True, 2: False})
+        self.assertEqual(TesterResult.select().count(), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
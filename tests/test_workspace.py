@@ -0,0 +1,62 @@
+import os
+import shutil
+import tempfile
+import unittest
+import helpers
+from test_vm_worker.workspace import WorkspaceManager, make_dir
+
+
+def _get_dead_pid():
+    curr_pid = os.fork()
+    if curr_pid == 0:
+        os._exit(0)
+    os.waitpid(curr_pid, 0)
+    return curr_pid
+
+
+class WorkspaceTrashTest(unittest.TestCase):
+    """
+    Deletion of released workspaces and of workspaces left behind by dead processes.
+    """
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.workspace_manager = WorkspaceManager(os.path.join(self.work_dir, 'ram'),
+                                                  os.path.join(self.work_dir, 'disk'), 0)
+        self.trash_dir = os.path.join(self.work_dir, 'ram', WorkspaceManager.TRASH_DIR_NAME)
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def _create_workspace(self, owner_pid, in_trash=False):
+        curr_root = self.trash_dir if in_trash else os.path.join(self.work_dir, 'ram')
+        curr_path = make_dir(os.path.join(curr_root, 'cb_tester_1.' + str(owner_pid) + '.abc'))
+        with open(os.path.join(curr_path, 'binary'), 'w') as fp:
+            fp.write('binary')
+        return curr_path
+
+    def test_released_workspaces_are_deleted_on_drain(self):
+        all_paths = map(lambda _: self.workspace_manager.create('cb_tester_1'), range(5))
+        for curr_path in all_paths:
+            self.workspace_manager.release(curr_path)
+            self.assertFalse(os.path.exists(curr_path))
+        self.workspace_manager.drain()
+        self.assertEqual(os.listdir(self.trash_dir), [])
+
+    def test_workspaces_of_dead_processes_are_reclaimed(self):
+        dead_pid = _get_dead_pid()
+        stale_paths = [self._create_workspace(dead_pid), self._create_workspace(dead_pid, in_trash=True)]
+        live_path = self._create_workspace(os.getpid())
+        self.workspace_manager.reclaim_stale_workspaces()
+        self.assertFalse(any(map(os.path.exists, stale_paths)))
+        self.assertTrue(os.path.exists(live_path))
+
+    def test_workspaces_of_dead_processes_are_reclaimed_in_background(self):
+        stale_path = self._create_workspace(_get_dead_pid(), in_trash=True)
+        self.workspace_manager.reclaim_stale_workspaces(in_background=True)
+        self.workspace_manager.drain()
+        self.assertFalse(os.path.exists(stale_path))
+
+
+if __name__ == '__main__':
+    unittest.main()